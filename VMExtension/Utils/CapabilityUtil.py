@@ -0,0 +1,229 @@
+#
+# Persistent cache of node capability probes
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Keeps what we learned about the node (distro, version, cgroup version, tool
+paths and package state) in a JSON file, so warm handler invocations don't
+probe again.
+
+The cache is thrown away when its fingerprint changes. The fingerprint is
+built from the mtime and size of the release files and the package database,
+and the PATH. All of these can be read without spawning a process.
+Installing a package changes the package database, so call save() after
+installing to record the new state under the new fingerprint.
+
+The cgroup version is the only entry a reboot can change, a mount at boot
+decides it, so it alone is dropped when the boot id differs from the one
+saved with it. The first handler run after a boot keeps the rest.
+
+Example cache file:
+{
+  "fingerprint": {...},
+  "boot_id": "...",
+  "distro": ["centos", "7.5.1804"],
+  "cgroup_version": 1,
+  "commands": {"cgexec": "/usr/bin/cgexec", "iostat": null},
+  "packages": {"libunwind": true}
+}
+"""
+
+
+import json
+import os
+import platform
+import threading
+
+FingerprintFiles = [
+    '/etc/os-release',
+    '/etc/redhat-release',
+    '/etc/SuSE-release',
+    '/etc/lsb-release',
+    '/var/lib/dpkg/status',
+    '/var/lib/rpm/Packages',
+    '/var/lib/rpm/rpmdb.sqlite',
+]
+BootIdFile = '/proc/sys/kernel/random/boot_id'
+DefaultPath = '/usr/sbin:/usr/bin:/sbin:/bin'
+
+# os-release IDs mapped to the names platform.dist() used to return
+OsReleaseIds = {
+    'rhel': 'redhat',
+    'sles': 'suse',
+    'sled': 'suse',
+    'opensuse': 'suse',
+    'opensuse-leap': 'suse',
+}
+
+def _read_os_release():
+    values = {}
+    try:
+        with open('/etc/os-release', 'r') as F:
+            for line in F:
+                if '=' in line:
+                    key, value = line.rstrip('\n').split('=', 1)
+                    values[key] = value.strip('"\'')
+    except IOError:
+        pass
+    return values
+
+def probe_distro():
+    """
+    Return (name, version) the way platform.dist() reports them, falling
+    back to /etc/os-release on Pythons where platform.dist() was removed.
+    """
+    if hasattr(platform, 'dist'):
+        distro = platform.dist()
+        if distro[0]:
+            return distro[0].lower(), distro[1]
+    values = _read_os_release()
+    name = values.get('ID', '').lower()
+    return OsReleaseIds.get(name, name), values.get('VERSION_ID', '')
+
+def probe_cgroup_version():
+    if os.path.isfile('/sys/fs/cgroup/cgroup.controllers'):
+        return 2
+    if os.path.isdir('/sys/fs/cgroup') or os.path.isdir('/cgroup'):
+        return 1
+    return 0
+
+def _search_path():
+    return os.environ.get('PATH', DefaultPath)
+
+def fingerprint():
+    files = {}
+    for path in FingerprintFiles:
+        try:
+            st = os.stat(path)
+            files[path] = [st.st_mtime, st.st_size]
+        except OSError:
+            pass
+    return {'files': files, 'path': _search_path()}
+
+def boot_id():
+    try:
+        with open(BootIdFile, 'r') as F:
+            return F.read().strip()
+    except IOError:
+        return None
+
+class NodeCapabilities:
+    def __init__(self, cache_file, log):
+        self._cache_file = cache_file
+        self._log = log
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._data = self._load()
+
+    def _load(self):
+        try:
+            with open(self._cache_file, 'r') as F:
+                data = json.load(F)
+            if data.get('fingerprint') == json.loads(json.dumps(fingerprint())):
+                if data.get('boot_id') != boot_id() and data.pop('cgroup_version', None) is not None:
+                    self._dirty = True
+                return data
+            self._log("Node capability cache {0} is stale".format(self._cache_file))
+        except (IOError, OSError, ValueError):
+            pass
+        self._dirty = True
+        return {'commands': {}, 'packages': {}}
+
+    def save(self):
+        with self._lock:
+            self._data['fingerprint'] = fingerprint()
+            self._data['boot_id'] = boot_id()
+            dirname = os.path.dirname(self._cache_file)
+            try:
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                tmp = self._cache_file + '.tmp'
+                with open(tmp, 'w') as F:
+                    json.dump(self._data, F)
+                os.rename(tmp, self._cache_file)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                self._log("Failed to save node capability cache {0}: {1}".format(self._cache_file, e))
+
+    def save_if_changed(self):
+        if self._dirty:
+            self.save()
+
+    def _get(self, key, probe):
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = probe()
+                self._dirty = True
+            return self._data[key]
+
+    def distro(self):
+        name, version = self._get('distro', lambda: list(probe_distro()))
+        return name, version
+
+    def cgroup_version(self):
+        """
+        1 or 2, or 0 while no hierarchy is there. 0 is not cached, CentOS 6
+        has no /cgroup until _mount_cgroup() creates it.
+        """
+        with self._lock:
+            version = self._data.get('cgroup_version')
+            if not version:
+                version = probe_cgroup_version()
+                if version:
+                    self._data['cgroup_version'] = version
+                    self._dirty = True
+            return version
+
+    def forget(self, key):
+        """
+        Drop a cached probe, it is done again on the next call.
+        """
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._dirty = True
+
+    def find_command(self, cmd):
+        """
+        Return the full path of cmd on the PATH, or None. Only hits are
+        cached: a missing tool may be installed by us in the same run.
+        """
+        with self._lock:
+            path = self._data['commands'].get(cmd)
+            if path and os.path.isfile(path):
+                return path
+            path = None
+            for dirname in _search_path().split(os.pathsep):
+                candidate = os.path.join(dirname, cmd)
+                if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                    path = candidate
+                    break
+            if path:
+                self._data['commands'][cmd] = path
+                self._dirty = True
+            return path
+
+    def package_installed(self, pkg):
+        with self._lock:
+            return self._data['packages'].get(pkg, False)
+
+    def set_package_installed(self, pkg, installed):
+        with self._lock:
+            if self._data['packages'].get(pkg) != installed:
+                self._data['packages'][pkg] = installed
+                self._dirty = True
@@ -0,0 +1,319 @@
+#
+# Per service cgroups for the node manager daemon
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Every supervised service runs in a cgroup of its own, <parent>/<name>, so
+its CPU, memory and IO use can be bounded and is accounted separately from
+the jobs on the node.
+
+On the unified (v2) hierarchy the group is created under /sys/fs/cgroup and
+the cpu, memory and io controllers are enabled on the way down. On v1 the
+group is created in each of the cpu, cpuacct, memory and blkio hierarchies,
+wherever /proc/self/mounts says they are mounted (/sys/fs/cgroup/<controller>,
+or /cgroup on CentOS 6).
+
+The limits are given in v2 terms and translated for v1:
+
+  CpuQuota    CPUs the service may use, e.g. 0.5     cpu.max / cpu.cfs_quota_us
+  CpuPeriod   the quota period in microseconds       cpu.max / cpu.cfs_period_us
+  CpuWeight   1-10000, 100 is the default share      cpu.weight / cpu.shares
+  MemoryHigh  bytes, throttled and reclaimed above   memory.high / memory.soft_limit_in_bytes
+  MemoryMax   bytes, OOM killed above                memory.max / memory.limit_in_bytes
+  IoWeight    1-10000, 100 is the default share      io.weight / blkio.weight
+
+A limit left out is reset to the kernel default, so a limit removed from the
+settings does not stay on a group created by a previous daemon, e.g.
+"ResourceLimits": {"nodeagent": {"CpuQuota": 1, "MemoryMax": 1073741824}}
+"""
+
+
+import errno
+import os
+
+CgroupRoot = '/sys/fs/cgroup'
+MountsFile = '/proc/self/mounts'
+V1Controllers = ('cpu', 'cpuacct', 'memory', 'blkio')
+V2Controllers = ('cpu', 'memory', 'io')
+DefaultCpuPeriod = 100000
+DefaultWeight = 100
+
+def _read(path):
+    try:
+        with open(path, 'r') as F:
+            return F.read()
+    except (IOError, OSError):
+        return None
+
+def _write(path, value):
+    with open(path, 'w') as F:
+        F.write(str(value))
+
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _keyed_values(text):
+    """
+    Parse "key value" lines, as in cpu.stat or memory.events.
+    """
+    values = {}
+    for line in (text or '').splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            values[fields[0]] = int(fields[1])
+    return values
+
+def _int(text):
+    try:
+        return int(text.strip())
+    except (AttributeError, ValueError):
+        return None
+
+def _join(procs_file):
+    """
+    Move the calling process into the group of procs_file. Runs in a child
+    between fork and exec, so it ignores errors, the parent checks with
+    contains().
+    """
+    try:
+        fd = os.open(procs_file, os.O_WRONLY)
+        try:
+            os.write(fd, str(os.getpid()).encode('ascii'))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def _proc_cgroups(pid):
+    """
+    Map the controllers of each hierarchy of pid, a tuple that is empty for
+    v2, to its group path, or None if there is no such process.
+    """
+    text = _read('/proc/{0}/cgroup'.format(pid))
+    if text is None:
+        return None
+    groups = {}
+    for line in text.splitlines():
+        fields = line.split(':', 2)
+        if len(fields) == 3:
+            groups[tuple(c for c in fields[1].split(',') if c)] = fields[2]
+    return groups
+
+def limits_from_settings(settings):
+    settings = settings or {}
+    limits = {}
+    if settings.get('CpuQuota') is not None:
+        limits['CpuQuota'] = float(settings['CpuQuota'])
+    limits['CpuPeriod'] = int(settings.get('CpuPeriod', DefaultCpuPeriod))
+    for key in ('CpuWeight', 'IoWeight'):
+        limits[key] = max(1, min(10000, int(settings.get(key, DefaultWeight))))
+    for key in ('MemoryHigh', 'MemoryMax'):
+        if settings.get(key) is not None:
+            limits[key] = int(settings[key])
+    return limits
+
+def v1_mounts(mounts_file=None):
+    """
+    Map each v1 controller we use to the mount point of its hierarchy.
+    """
+    mounts = {}
+    for line in (_read(mounts_file or MountsFile) or '').splitlines():
+        fields = line.split()
+        if len(fields) < 4 or fields[2] != 'cgroup':
+            continue
+        for option in fields[3].split(','):
+            if option in V1Controllers:
+                mounts.setdefault(option, fields[1])
+    return mounts
+
+def format_usage(usage):
+    parts = []
+    if usage.get('cpu_usec') is not None:
+        parts.append('cpu {0:.1f}s'.format(usage['cpu_usec'] / 1e6))
+    if usage.get('memory_bytes') is not None:
+        parts.append('memory {0:.1f}MB'.format(usage['memory_bytes'] / 1048576.0))
+    if usage.get('io_read_bytes') is not None:
+        parts.append('io read {0:.1f}MB write {1:.1f}MB'.format(
+            usage['io_read_bytes'] / 1048576.0, usage['io_write_bytes'] / 1048576.0))
+    if usage.get('memory_high_events'):
+        parts.append('memory.high hit {0} times'.format(usage['memory_high_events']))
+    if usage.get('oom_kills'):
+        parts.append('{0} OOM kills'.format(usage['oom_kills']))
+    return ', '.join(parts)
+
+class CgroupV2:
+    def __init__(self, parent, name, log, root=None):
+        self._root = root or CgroupRoot
+        self._parent = os.path.join(self._root, parent)
+        self.path = os.path.join(self._parent, name)
+        self._relative = '/' + os.path.join(parent, name)
+        self._log = log
+
+    def describe(self):
+        return self.path
+
+    def create(self):
+        available = (_read(os.path.join(self._root, 'cgroup.controllers')) or '').split()
+        enable = ' '.join('+' + c for c in V2Controllers if c in available)
+        _mkdir(self._parent)
+        # Only groups without processes of their own can pass controllers down
+        for group in (self._root, self._parent):
+            if not enable:
+                break
+            try:
+                _write(os.path.join(group, 'cgroup.subtree_control'), enable)
+            except (IOError, OSError) as e:
+                self._log("Failed to enable the {0} controllers in {1}: {2}".format(enable, group, e))
+        _mkdir(self.path)
+
+    def apply(self, limits):
+        quota = limits.get('CpuQuota')
+        period = limits['CpuPeriod']
+        values = [
+            ('cpu.max', '{0} {1}'.format(int(quota * period) if quota else 'max', period)),
+            ('cpu.weight', limits['CpuWeight']),
+            ('memory.high', limits.get('MemoryHigh', 'max')),
+            ('memory.max', limits.get('MemoryMax', 'max')),
+            ('io.weight', 'default {0}'.format(limits['IoWeight'])),
+        ]
+        for name, value in values:
+            try:
+                _write(os.path.join(self.path, name), value)
+            except (IOError, OSError) as e:
+                self._log("Failed to set {0} of {1} to {2}: {3}".format(name, self.path, value, e))
+
+    def attach(self, pid):
+        _write(os.path.join(self.path, 'cgroup.procs'), pid)
+
+    def join(self):
+        _join(os.path.join(self.path, 'cgroup.procs'))
+
+    def contains(self, pid):
+        return (_proc_cgroups(pid) or {}).get(()) == self._relative
+
+    def usage(self):
+        usage = {}
+        cpu = _keyed_values(_read(os.path.join(self.path, 'cpu.stat')))
+        usage['cpu_usec'] = cpu.get('usage_usec')
+        usage['memory_bytes'] = _int(_read(os.path.join(self.path, 'memory.current')))
+        events = _keyed_values(_read(os.path.join(self.path, 'memory.events')))
+        usage['memory_high_events'] = events.get('high')
+        usage['oom_kills'] = events.get('oom_kill')
+        io = _read(os.path.join(self.path, 'io.stat'))
+        if io is not None:
+            usage['io_read_bytes'] = usage['io_write_bytes'] = 0
+            for line in io.splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition('=')
+                    if key in ('rbytes', 'wbytes') and value.isdigit():
+                        usage['io_read_bytes' if key == 'rbytes' else 'io_write_bytes'] += int(value)
+        return usage
+
+class CgroupV1:
+    def __init__(self, parent, name, log, mounts=None):
+        self._mounts = mounts if mounts is not None else v1_mounts()
+        self._paths = dict((controller, os.path.join(mount, parent, name)) for controller, mount in self._mounts.items())
+        self._relative = '/' + os.path.join(parent, name)
+        self._log = log
+
+    def describe(self):
+        return ', '.join(sorted(set(self._paths.values())))
+
+    def create(self):
+        if not self._paths:
+            raise OSError(errno.ENOENT, "No cgroup v1 hierarchy is mounted")
+        for path in set(self._paths.values()):
+            _mkdir(path)
+
+    def _set(self, controller, name, value):
+        if controller not in self._paths:
+            return
+        path = os.path.join(self._paths[controller], name)
+        try:
+            _write(path, value)
+        except (IOError, OSError) as e:
+            self._log("Failed to set {0} to {1}: {2}".format(path, value, e))
+
+    def apply(self, limits):
+        quota = limits.get('CpuQuota')
+        self._set('cpu', 'cpu.cfs_period_us', limits['CpuPeriod'])
+        self._set('cpu', 'cpu.cfs_quota_us', int(quota * limits['CpuPeriod']) if quota else -1)
+        # The v2 defaults, weight 100, correspond to 1024 shares and a blkio weight of 500
+        self._set('cpu', 'cpu.shares', max(2, limits['CpuWeight'] * 1024 // DefaultWeight))
+        self._set('memory', 'memory.soft_limit_in_bytes', limits.get('MemoryHigh', -1))
+        self._set('memory', 'memory.limit_in_bytes', limits.get('MemoryMax', -1))
+        self._set('blkio', 'blkio.weight', max(10, min(1000, limits['IoWeight'] * 5)))
+
+    def attach(self, pid):
+        for path in set(self._paths.values()):
+            _write(os.path.join(path, 'cgroup.procs'), pid)
+
+    def join(self):
+        for path in set(self._paths.values()):
+            _join(os.path.join(path, 'cgroup.procs'))
+
+    def contains(self, pid):
+        groups = _proc_cgroups(pid) or {}
+        for controller in self._paths:
+            if not any(controller in controllers and path == self._relative for controllers, path in groups.items()):
+                return False
+        return True
+
+    def _read(self, controller, name):
+        if controller not in self._paths:
+            return None
+        return _read(os.path.join(self._paths[controller], name))
+
+    def usage(self):
+        usage = {}
+        cpu_nsec = _int(self._read('cpuacct', 'cpuacct.usage'))
+        usage['cpu_usec'] = cpu_nsec // 1000 if cpu_nsec is not None else None
+        usage['memory_bytes'] = _int(self._read('memory', 'memory.usage_in_bytes'))
+        usage['oom_kills'] = _keyed_values(self._read('memory', 'memory.oom_control')).get('oom_kill')
+        io = self._read('blkio', 'blkio.throttle.io_service_bytes')
+        if io is not None:
+            usage['io_read_bytes'] = usage['io_write_bytes'] = 0
+            for line in io.splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[1] in ('Read', 'Write') and fields[2].isdigit():
+                    usage['io_read_bytes' if fields[1] == 'Read' else 'io_write_bytes'] += int(fields[2])
+        return usage
+
+def create(version, parent, name, limits, log):
+    """
+    Create or reuse the cgroup parent/name and apply limits. Returns None,
+    after logging why, when it can't be created.
+    """
+    if version == 2:
+        group = CgroupV2(parent, name, log)
+    elif version == 1:
+        group = CgroupV1(parent, name, log)
+    else:
+        return None
+    try:
+        group.create()
+    except (IOError, OSError) as e:
+        log("Failed to create the cgroup for {0}: {1}".format(name, e))
+        return None
+    group.apply(limits)
+    return group
@@ -51,22 +51,40 @@ Example HeartBeat
 Example Status Report:
 [{"version":"1.0","timestampUTC":"2014-05-29T04:20:13Z","status":{"name":"Chef Extension Handler","operation":"chef-client-run","status":"success","code":0,"formattedMessage":{"lang":"en-US","message":"Chef-client run success"}}}]
 
+StatusReporter merges the states of several components (e.g. supervised
+processes) into one report, the worst state in "status" and one entry per
+component in "substatus", and writes it behind the callers: updates within
+the debounce window are coalesced, reports are at least min_interval apart,
+and error states are written at once.
+
 """
 
 
 import os
 import os.path
 import sys
-import imp
 import base64
+import hashlib
 import json
 import time
 import logging
+import threading
+import subprocess
 from os.path import join
 from Utils.WAAgentUtil import waagent
-from waagent import LoggerInit
+from Utils.LogUtil import Compressor, RotatingHandler, RotatingLog
+from Utils.SeqUtil import current_seq_no
 
 DateTimeFormat = "%Y-%m-%dT%H:%M:%SZ"
+ExtensionLogFile = "/var/log/hpcacmagent.log"
+# Kept next to mrseq, see Utils/SeqUtil.py
+SeqIndexFile = "seqindex.json"
+# Clear text protected settings by (seq, thumbprint, sha256 of the ciphertext)
+DecryptedSettingsCache = {}
+# Status values from the least to the most severe
+StatusSeverity = ['success', 'transitioning', 'warning', 'error']
+# 'always' fsyncs every status file, 'terminal' only error reports and the last one
+FsyncPolicies = ('never', 'terminal', 'always')
 
 class HandlerContext:
     def __init__(self,name):
@@ -79,30 +97,21 @@ class HandlerUtility:
         self._log = log
         self._error = error
         self._short_name = short_name
-        logging.basicConfig(filename="/var/log/hpcacmagent.log", filemode='a', format='%(asctime)s,%(name)s %(levelname)s %(message)s', datefmt='%H:%M:%S', level=logging.DEBUG)
+        self._status_lock = threading.Lock()
+        self._most_recent_seq = None
+        root = logging.getLogger()
+        if not any(isinstance(h, RotatingHandler) for h in root.handlers):
+            # Every handler invocation appends to the same file, so it is rotated as a shared log
+            handler = RotatingHandler(RotatingLog(ExtensionLogFile, compressor=Compressor(log), log=log, shared=True))
+            handler.setFormatter(logging.Formatter('%(asctime)s,%(name)s %(levelname)s %(message)s', '%H:%M:%S'))
+            root.addHandler(handler)
+            root.setLevel(logging.DEBUG)
 
     def _get_log_prefix(self):
         return '[%s-%s]' %(self._context._name, self._context._version)
 
     def _get_current_seq_no(self, config_folder):
-        seq_no = -1
-        cur_seq_no = -1
-        freshest_time = None
-        for subdir, dirs, files in os.walk(config_folder):
-            for file in files:
-                try:
-                    cur_seq_no = int(os.path.basename(file).split('.')[0])
-                    if(freshest_time == None):
-                        freshest_time = os.path.getmtime(join(config_folder,file))
-                        seq_no = cur_seq_no
-                    else:
-                        current_file_m_time = os.path.getmtime(join(config_folder,file))
-                        if(current_file_m_time > freshest_time):
-                            freshest_time=current_file_m_time
-                            seq_no = cur_seq_no
-                except ValueError:
-                    continue
-        return seq_no
+        return current_seq_no(config_folder, SeqIndexFile)
 
     def log(self, message):
         logging.getLogger(self._get_log_prefix()).info(message)
@@ -123,30 +132,51 @@ class HandlerUtility:
             self.error("JSON error processing settings file:" + ctxt)
         else:
             handlerSettings = config['runtimeSettings'][0]['handlerSettings']
-            if handlerSettings.has_key('protectedSettings') and \
-                    handlerSettings.has_key("protectedSettingsCertThumbprint") and \
-                    handlerSettings['protectedSettings'] is not None and \
-                    handlerSettings["protectedSettingsCertThumbprint"] is not None:
+            if handlerSettings.get('protectedSettings') is not None and \
+                    handlerSettings.get('protectedSettingsCertThumbprint') is not None:
                 protectedSettings = handlerSettings['protectedSettings']
                 thumb=handlerSettings['protectedSettingsCertThumbprint']
-                cert=waagent.LibDir+'/'+thumb+'.crt'
-                pkey=waagent.LibDir+'/'+thumb+'.prv'
-                waagent.SetFileContents('/tmp/kk', protectedSettings)
-                cleartxt=None
-                cleartxt=waagent.RunGetOutput("base64 -d /tmp/kk | openssl smime  -inform DER -decrypt -recip " +  cert + "  -inkey " + pkey )[1]
-                os.remove("/tmp/kk")
-                if cleartxt == None:
-                    self.error("OpenSSh decode error using  thumbprint " + thumb )
-                    do_exit(1,operation,'error','1', operation + ' Failed')
+                cleartxt = self._decrypt_protected_settings(thumb, protectedSettings)
                 jctxt=''
                 try:
                     jctxt=json.loads(cleartxt)
                 except:
-                    self.error('JSON exception decoding ' + cleartxt)
+                    self.error('JSON exception decoding protected settings')
                 handlerSettings['protectedSettings']=jctxt
                 self.log('Config decoded correctly.')
         return config
 
+    def _decrypt_protected_settings(self, thumb, protectedSettings):
+        """
+        Decrypt the base64 encoded PKCS#7 protected settings with the
+        certificate 'thumb'. The data goes to openssl through a pipe, nothing
+        is written to disk, and the clear text is cached for the process.
+        """
+        ciphertext = protectedSettings.encode('ascii') if not isinstance(protectedSettings, bytes) else protectedSettings
+        key = (self._context._seq_no, thumb, hashlib.sha256(ciphertext).hexdigest())
+        if key in DecryptedSettingsCache:
+            return DecryptedSettingsCache[key]
+        cert=waagent.LibDir+'/'+thumb+'.crt'
+        pkey=waagent.LibDir+'/'+thumb+'.prv'
+        try:
+            der = base64.b64decode(ciphertext)
+        except (TypeError, ValueError) as e:
+            self.error("Protected settings are not valid base64: " + str(e))
+            return ''
+        try:
+            openssl = subprocess.Popen(['openssl', 'smime', '-inform', 'DER', '-decrypt', '-recip', cert, '-inkey', pkey],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            cleartxt, err = openssl.communicate(der)
+        except OSError as e:
+            self.error("Failed to run openssl: " + str(e))
+            return ''
+        if openssl.returncode != 0:
+            self.error("OpenSSL decode error using thumbprint " + thumb + ": " + err.decode('utf-8', 'replace'))
+            return ''
+        cleartxt = cleartxt.decode('utf-8')
+        DecryptedSettingsCache[key] = cleartxt
+        return cleartxt
+
     def do_parse_context(self,operation,logfile='extension.log'):
         if not logfile:
             logfile="extension.log"
@@ -211,17 +241,17 @@ class HandlerUtility:
 
     def _change_log_file(self):
         self.log("Change log file to " + self._context._log_file)
-        LoggerInit(self._context._log_file,'/dev/stdout')
+        waagent.LoggerInit(self._context._log_file,'/dev/stdout')
         self._log = waagent.Log
         self._error = waagent.Error
 
     def set_verbose_log(self, verbose):
         if(verbose == "1" or verbose == 1):
             self.log("Enable verbose log")
-            LoggerInit(self._context._log_file, '/dev/stdout', verbose=True)
+            waagent.LoggerInit(self._context._log_file, '/dev/stdout', verbose=True)
         else:
             self.log("Disable verbose log")
-            LoggerInit(self._context._log_file, '/dev/stdout', verbose=False)
+            waagent.LoggerInit(self._context._log_file, '/dev/stdout', verbose=False)
 
     def is_seq_smaller(self):
         return int(self._context._seq_no) <= self._get_most_recent_seq()
@@ -240,12 +270,14 @@ class HandlerUtility:
         self.save_seq()
 
     def _get_most_recent_seq(self):
-        if(os.path.isfile('mrseq')):
-            seq = waagent.GetFileContents('mrseq')
-            if(seq):
-                return int(seq)
-
-        return -1
+        # mrseq only changes through _set_most_recent_seq, read it once per process
+        if self._most_recent_seq is None:
+            self._most_recent_seq = -1
+            if(os.path.isfile('mrseq')):
+                seq = waagent.GetFileContents('mrseq')
+                if(seq):
+                    self._most_recent_seq = int(seq)
+        return self._most_recent_seq
 
     def is_current_config_seq_greater_inused(self):
         return int(self._context._seq_no) > self._get_most_recent_seq()
@@ -258,8 +290,9 @@ class HandlerUtility:
 
     def _set_most_recent_seq(self,seq):
         waagent.SetFileContents('mrseq', str(seq))
+        self._most_recent_seq = int(seq)
 
-    def do_status_report(self, operation, status, status_code, message):
+    def do_status_report(self, operation, status, status_code, message, substatus=None, fsync=False):
         self.log("{0},{1},{2},{3}".format(operation, status, status_code, message))
         tstamp=time.strftime(DateTimeFormat, time.gmtime())
         stat = [{
@@ -276,12 +309,28 @@ class HandlerUtility:
                 }
             }
         }]
+        if substatus:
+            stat[0]["status"]["substatus"] = substatus
         stat_rept = json.dumps(stat)
         if self._context._status_file:
-            tmp = "%s.tmp" %(self._context._status_file)
-            with open(tmp,'w+') as f:
-                f.write(stat_rept)
-            os.rename(tmp, self._context._status_file)
+            with self._status_lock:
+                # The daemon and the handler commands may write at the same time, each uses its own temp file
+                tmp = "%s.%d.tmp" %(self._context._status_file, os.getpid())
+                with open(tmp,'w+') as f:
+                    f.write(stat_rept)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.rename(tmp, self._context._status_file)
+                if fsync:
+                    dirfd = os.open(os.path.dirname(self._context._status_file) or '.', os.O_RDONLY)
+                    try:
+                        os.fsync(dirfd)
+                    finally:
+                        os.close(dirfd)
+
+    def status_reporter(self, debounce=0.5, min_interval=2, fsync='terminal'):
+        return StatusReporter(self.do_status_report, self.log, debounce, min_interval, fsync)
 
     def do_heartbeat_report(self, heartbeat_file,status,code,message):
         # heartbeat
@@ -314,3 +363,124 @@ class HandlerUtility:
     def get_public_settings(self):
         return self.get_handler_settings().get('publicSettings')
 
+
+class StatusReporter:
+    """
+    write(operation, status, code, message, substatus, fsync) writes one
+    status file, e.g. HandlerUtility.do_status_report. A background thread
+    writes the merged state debounce seconds after the last update, at most
+    max_delay after the first pending one, and never sooner than
+    min_interval after the previous write.
+    """
+    def __init__(self, write, log, debounce=0.5, min_interval=2, fsync='terminal', max_delay=None):
+        if fsync not in FsyncPolicies:
+            raise ValueError("unknown fsync policy {0}".format(fsync))
+        self._write = write
+        self._log = log
+        self._debounce = float(debounce)
+        self._min_interval = float(min_interval)
+        self._max_delay = float(max_delay) if max_delay is not None else max(self._debounce * 4, self._min_interval)
+        self._fsync = fsync
+        self._components = {}
+        self._order = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # One writer at a time, flushes from update() and the thread are serialized
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._first_pending = None
+        self._last_update = None
+        self._last_write = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='status-reporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, component, operation, status, code, message, terminal=None):
+        """
+        Record the state of a component. Terminal states (errors by default)
+        are written before update() returns.
+        """
+        if terminal is None:
+            terminal = status == 'error'
+        now = time.time()
+        with self._lock:
+            if component not in self._components:
+                self._order.append(component)
+            self._components[component] = (operation, status, code, message)
+            self._dirty = True
+            self._last_update = now
+            if self._first_pending is None:
+                self._first_pending = now
+            self._cond.notify()
+        if terminal:
+            self.flush(fsync=self._fsync != 'never')
+
+    def _merged(self):
+        worst = None
+        substatus = []
+        for component in self._order:
+            operation, status, code, message = self._components[component]
+            substatus.append({
+                "name": component,
+                "status": status,
+                "code": code,
+                "formattedMessage": {"lang": "en-US", "message": message},
+            })
+            if worst is None or StatusSeverity.index(status) > StatusSeverity.index(worst[1]):
+                worst = (component, status, code, message)
+        component, status, code, message = worst
+        operation = self._components[component][0]
+        if message:
+            message = "{0}: {1}".format(component, message)
+        return operation, status, code, message, substatus
+
+    def flush(self, fsync=None):
+        if fsync is None:
+            fsync = self._fsync == 'always'
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                report = self._merged()
+                self._dirty = False
+                self._first_pending = None
+            try:
+                self._write(*report, fsync=fsync)
+            except Exception as e:
+                self._log("Failed to write status: {0}".format(e))
+            with self._lock:
+                self._last_write = time.time()
+
+    def _due(self):
+        """
+        Seconds until the pending state should be written, or None when
+        nothing is pending.
+        """
+        if not self._dirty:
+            return None
+        due = min(self._last_update + self._debounce, self._first_pending + self._max_delay)
+        due = max(due, self._last_write + self._min_interval)
+        return due - time.time()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed:
+                    wait = self._due()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self):
+        """
+        Stop the thread and write whatever is pending.
+        """
+        with self._lock:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush(fsync=self._fsync != 'never')
@@ -0,0 +1,362 @@
+#
+# Conditional, incremental sync of the #HPC hosts entries from the head node
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+HostsSync polls HostsFileUri on a thread of the daemon and keeps the #HPC
+entries of the hosts file equal to the list the head node serves:
+
+{"ManagedEntry": true, "HostEntries": [{"Name": "node1", "Address": "10.0.0.5"}, ...]}
+
+Every request after the first is conditional. The ETag and Last-Modified of
+the last response are sent back as If-None-Match and If-Modified-Since, so
+an unchanged list costs a 304 without a body. With an ETag the request also
+offers delta encoding (RFC 3229, "A-IM: hpc-hosts-delta"). A server that
+still knows that version may answer 226 with only the changes,
+
+{"Added": [{"Name": "node7", "Address": "10.0.0.11"}], "Removed": ["node3"]}
+
+and any server may ignore the offer and send the full list. Bodies are
+requested gzipped.
+
+The poll interval adapts to the changes: it halves down to MinInterval
+after a change and grows by half up to MaxInterval while nothing changes,
+failures double it. Each wait is randomized by +-Jitter, and the first poll
+waits a random part of Jitter * Interval, so nodes started together don't
+poll together. A Retry-After from an overloaded server is honored, e.g.
+
+"HostsSync": {"Uri": "https://headnode/HpcLinux/api/hostsfile", "Interval": 120}
+
+wake() polls early, e.g. when the node's addresses change: the node may
+have been down or moved, so the list it has may be stale. The poll waits
+a random part of Jitter * MinInterval, so the nodes of a subnet that all
+see the same change don't poll together.
+
+The entries are written through HostsUtil, which rewrites the file only when
+its content changes. Uri and Interval default to HostsFileUri and
+HostsFetchInterval of nodemanager.json.
+
+The node manager fetches the full list itself while nodemanager.json has a
+HostsFileUri, and its writes would race ours. While the daemon syncs,
+claim_config() moves the key aside to HostsSyncUri, so the node manager
+started after it leaves the hosts file alone. release_config() puts it back
+when HostsSync is turned off.
+"""
+
+
+import collections
+import gzip
+import io
+import json
+import os
+import random
+import ssl
+import threading
+
+try:
+    import urllib2 as request
+    from urllib2 import HTTPError
+except ImportError:
+    import urllib.request as request
+    from urllib.error import HTTPError
+
+from Utils import HostsUtil
+
+DeltaIm = 'hpc-hosts-delta'
+Defaults = {
+    'Interval': 120,
+    'Jitter': 0.2,
+    'Timeout': 30,
+}
+# Relative to Interval unless given
+MinIntervalFactor = 0.25
+MaxIntervalFactor = 5
+ThreadJoinTimeoutInSeconds = 5
+# nodemanager.json keys, the node manager fetches the hosts file while it has HostsFileUri
+ConfigUriKey = 'HostsFileUri'
+ClaimedUriKey = 'HostsSyncUri'
+
+def _read_config(config_file):
+    try:
+        with open(config_file, 'r') as F:
+            return json.load(F)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _move_config_key(config_file, source, target, log, replace):
+    """
+    Rename a key of the JSON config file. An existing target is replaced
+    if replace is set, and kept otherwise. Returns False when the file could
+    not be rewritten.
+    """
+    config = _read_config(config_file)
+    if source not in config:
+        return True
+    value = config.pop(source)
+    if replace or target not in config:
+        config[target] = value
+    tmp = config_file + '.tmp'
+    try:
+        with open(tmp, 'w') as F:
+            json.dump(config, F, indent=2)
+        os.chmod(tmp, os.stat(config_file).st_mode & 0o7777)
+        os.rename(tmp, config_file)
+    except (IOError, OSError) as e:
+        log("Failed to move {0} to {1} in {2}: {3}".format(source, target, config_file, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    log("Moved {0} to {1} in {2}".format(source, target, config_file))
+    return True
+
+def claim_config(config_file, log):
+    """
+    Stop the node manager from fetching the hosts file. Returns False when
+    it could not be stopped, the daemon must not sync then.
+    """
+    # A reinstalled nodemanager.json brings the key back, it is the newer value
+    return _move_config_key(config_file, ConfigUriKey, ClaimedUriKey, log, True)
+
+def release_config(config_file, log):
+    return _move_config_key(config_file, ClaimedUriKey, ConfigUriKey, log, False)
+
+def _retry_after(headers):
+    """
+    Retry-After in seconds, only the delta-seconds form is used.
+    """
+    try:
+        return max(0, int(headers.get('Retry-After', '')))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _decode(headers, body):
+    if (headers.get('Content-Encoding') or '').lower() == 'gzip':
+        body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+    return json.loads(body.decode('utf-8'))
+
+def parse_entries(items):
+    """
+    (entries, skipped): an OrderedDict of name to address, and the number of
+    items that were not valid entries.
+    """
+    entries = collections.OrderedDict()
+    skipped = 0
+    for item in items or []:
+        name = item.get('Name') if isinstance(item, dict) else None
+        addr = item.get('Address') if isinstance(item, dict) else None
+        if HostsUtil.is_valid_entry(addr, name):
+            entries[str(name)] = str(addr)
+        else:
+            skipped += 1
+    return entries, skipped
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+class HostsSync:
+    def __init__(self, uri, hosts_path, log, interval=None, min_interval=None, max_interval=None,
+                 jitter=None, timeout=None, verify=True, rand=None):
+        self.uri = uri
+        self.hosts_path = hosts_path
+        self._log = log
+        self.interval = float(interval or Defaults['Interval'])
+        self.min_interval = float(min_interval or self.interval * MinIntervalFactor)
+        self.max_interval = float(max_interval or self.interval * MaxIntervalFactor)
+        self.jitter = max(0.0, min(1.0, float(Defaults['Jitter'] if jitter is None else jitter)))
+        self.timeout = float(timeout or Defaults['Timeout'])
+        self._rand = rand or random.Random()
+        handlers = []
+        if not verify and hasattr(ssl, '_create_unverified_context'):
+            # The head node certificate is often self-signed
+            handlers.append(request.HTTPSHandler(context=ssl._create_unverified_context()))
+        self._opener = request.build_opener(*handlers)
+        # The entries last applied and the validators they came with
+        self._entries = None
+        self._managed = True
+        self._etag = None
+        self._last_modified = None
+        self._file_state = None
+        self.stats = dict((key, 0) for key in ('requests', 'not_modified', 'full', 'delta', 'errors', 'bytes'))
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls, settings, hosts_path, log, config_file=None):
+        """
+        The HostsSync for publicSettings 'HostsSync', or None when it is not
+        set, is disabled with "Enabled": false or has no Uri.
+        """
+        if settings is None or not settings.get('Enabled', True):
+            return None
+        config = _read_config(config_file) if config_file else {}
+        uri = settings.get('Uri') or config.get(ConfigUriKey) or config.get(ClaimedUriKey)
+        if not uri:
+            log("HostsSync is set but there is no Uri or HostsFileUri, not syncing the hosts file")
+            return None
+        return cls(uri, hosts_path, log,
+                   interval=settings.get('Interval') or config.get('HostsFetchInterval'),
+                   min_interval=settings.get('MinInterval'),
+                   max_interval=settings.get('MaxInterval'),
+                   jitter=settings.get('Jitter'),
+                   timeout=settings.get('Timeout'),
+                   verify=settings.get('VerifyCertificate', True))
+
+    def _request(self):
+        """
+        (status, headers, body) of one conditional request, body is None for
+        a 304.
+        """
+        req = request.Request(self.uri)
+        req.add_header('Accept', 'application/json')
+        req.add_header('Accept-Encoding', 'gzip')
+        if self._entries is not None:
+            if self._etag:
+                req.add_header('If-None-Match', self._etag)
+                req.add_header('A-IM', DeltaIm)
+            if self._last_modified:
+                req.add_header('If-Modified-Since', self._last_modified)
+        self.stats['requests'] += 1
+        try:
+            response = self._opener.open(req, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                return 304, e.info(), None
+            raise
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        self.stats['bytes'] += len(body)
+        return response.getcode(), response.info(), body
+
+    def _apply(self, entries):
+        hosts = HostsUtil.HostsFile.load(self.hosts_path)
+        hosts.replace(HostsUtil.HpcTag, [(addr, name) for name, addr in entries.items()])
+        written = hosts.save()
+        self._file_state = _file_state(self.hosts_path)
+        return written
+
+    def sync_once(self):
+        """
+        Fetch the entries once and apply them. Returns whether they changed.
+        Raises on a failed request or an invalid payload.
+        """
+        status, headers, body = self._request()
+        if status == 304:
+            self.stats['not_modified'] += 1
+            # Somebody else rewrote the file, put the entries back
+            if self._managed and self._file_state != _file_state(self.hosts_path) and self._apply(self._entries):
+                self._log("Restored the #HPC entries of {0}".format(self.hosts_path))
+            return False
+        payload = _decode(headers, body)
+        if status == 226 and (headers.get('IM') or '').strip() == DeltaIm and self._entries is not None:
+            added, skipped = parse_entries(payload.get('Added'))
+            entries = collections.OrderedDict(self._entries)
+            for name in payload.get('Removed') or []:
+                entries.pop(name, None)
+            entries.update(added)
+            self.stats['delta'] += 1
+            kind = 'delta of {0} added and {1} removed'.format(len(added), len(payload.get('Removed') or []))
+        elif status == 200:
+            if not payload.get('ManagedEntry', True):
+                if self._managed:
+                    self._log("The head node doesn't manage the hosts file entries")
+                self._managed = False
+                self._entries = collections.OrderedDict()
+                self._etag, self._last_modified = headers.get('ETag'), headers.get('Last-Modified')
+                return False
+            entries, skipped = parse_entries(payload.get('HostEntries'))
+            self._managed = True
+            self.stats['full'] += 1
+            kind = 'full list'
+        else:
+            raise ValueError("unexpected status {0}".format(status))
+        if skipped:
+            self._log("Skipped {0} invalid hosts entries from {1}".format(skipped, self.uri))
+        changed = entries != self._entries
+        written = self._apply(entries) if changed or self._file_state != _file_state(self.hosts_path) else False
+        self._entries = entries
+        self._etag, self._last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if written:
+            self._log("Synced {0} hosts entries from {1}, {2}".format(len(entries), self.uri, kind))
+        return changed
+
+    def next_interval(self, outcome, retry_after=None):
+        """
+        Adapt the interval to the outcome of a poll, 'changed', 'unchanged'
+        or 'error', and return the randomized wait before the next one.
+        """
+        if outcome == 'changed':
+            self.interval = max(self.min_interval, self.interval / 2)
+        elif outcome == 'unchanged':
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+        wait = self.interval * self._rand.uniform(1 - self.jitter, 1 + self.jitter)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        return wait
+
+    def _poll(self):
+        try:
+            return self.next_interval('changed' if self.sync_once() else 'unchanged')
+        except HTTPError as e:
+            self.stats['errors'] += 1
+            self._log("Failed to fetch the hosts entries from {0}: {1}".format(self.uri, e))
+            return self.next_interval('error', _retry_after(e.info()) if e.code in (429, 503) else None)
+        except Exception as e:
+            self.stats['errors'] += 1
+            self._log("Failed to sync the hosts entries from {0}: {1}".format(self.uri, e))
+            return self.next_interval('error')
+
+    def _run(self):
+        wait = self._rand.uniform(0, self.jitter * self.interval)
+        while True:
+            woken = self._wake.wait(wait)
+            if self._stop.is_set():
+                return
+            if woken:
+                self._wake.clear()
+                if self._stop.wait(self._rand.uniform(0, self.jitter * self.min_interval)):
+                    return
+            wait = self._poll()
+
+    def wake(self):
+        """
+        Poll soon instead of after the current interval, safe to call from
+        any thread.
+        """
+        self._wake.set()
+
+    def start(self):
+        self._log("Syncing the hosts file from {0} every {1:.0f} seconds or so".format(self.uri, self.interval))
+        self._thread = threading.Thread(target=self._run, name='hosts-sync')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(ThreadJoinTimeoutInSeconds)
@@ -0,0 +1,264 @@
+#
+# Indexed model of the hosts file
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+The entries we manage in the hosts file are single name lines tagged with a
+comment, "<address> <name> #HPC" for the cluster nodes and "#HPCD" for the
+addresses of this node. Every other line belongs to somebody else and is
+kept as it is.
+
+HostsFile.load() reads the file once and keeps its text. The tagged lines
+are found with one compiled multiline pattern per operation, so removing or
+listing tens of thousands of entries runs in the regex engine instead of a
+Python loop over the lines. A tag with few entries, like #HPCD next to
+thousands of #HPC, is found faster by searching for the tag itself and
+matching only the lines around the hits. The map from name to entries is
+built from one pass when lookup() or add() first needs it.
+
+add(), remove() and replace() can be batched: entries that stay keep their
+line and position, new ones are appended. save() renders the file and
+replaces it atomically only when the SHA-256 of the content differs from
+what was loaded, so a batch that changes nothing never rewrites the file.
+"""
+
+
+import hashlib
+import os
+import re
+
+HpcTag = 'HPC'
+HpcdTag = 'HPCD'
+HpcTags = (HpcTag, HpcdTag)
+# The file is read and written as latin-1, which maps every byte to itself
+Encoding = 'latin-1'
+# Up to this many occurrences of the tags, the lines are found around them
+SparseHits = 64
+
+def _entry_pattern(tags):
+    """
+    Tagged lines with their newline, the groups are address, name and tag.
+    Only whitespace other than newlines may separate the fields.
+    """
+    return re.compile(r'^([0-9A-Fa-f.:]+)[ \t\r\f\v]+([^\s#]+)[ \t\r\f\v]+#({0})[ \t\r\f\v]*(?:\n|\Z)'.format(
+        '|'.join(sorted(tags, key=len, reverse=True))), re.M)
+
+_patterns = {}
+
+def entry_pattern(tags):
+    tags = tuple(sorted(tags))
+    if tags not in _patterns:
+        _patterns[tags] = _entry_pattern(tags)
+    return _patterns[tags]
+
+_valid_address = re.compile(r'^[0-9A-Fa-f.:]+$')
+# Printable ASCII but for '#'
+_valid_name = re.compile(r'^[!"$-~]+$')
+
+def is_valid_entry(addr, name):
+    """
+    Whether an entry for addr and name would be read back by the patterns,
+    entries from elsewhere must be checked before they are added.
+    """
+    try:
+        return bool(addr and name and _valid_address.match(addr) and _valid_name.match(name))
+    except TypeError:
+        return False
+
+def format_entry(addr, name, tag):
+    return '{0:24}{1:30}#{2}\n'.format(addr, name, tag)
+
+class HostsFile:
+    def __init__(self, path, text=''):
+        self.path = path
+        self._text = text
+        # (address, name, tag) appended after the loaded lines
+        self._added = []
+        self._index = None
+        self._digest = hashlib.sha256(text.encode(Encoding)).hexdigest()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as F:
+            return cls(path, F.read().decode(Encoding))
+
+    def _build_index(self):
+        index = {}
+        for addr, name, tag in entry_pattern(HpcTags).findall(self._text):
+            index.setdefault(name, []).append((addr, tag))
+        for addr, name, tag in self._added:
+            index.setdefault(name, []).append((addr, tag))
+        return index
+
+    def lookup(self, name):
+        """
+        (address, tag) of the entries for name.
+        """
+        if self._index is None:
+            self._index = self._build_index()
+        return list(self._index.get(name, []))
+
+    def _sparse_matches(self, tags):
+        """
+        The matches of the tagged lines, or None when the tags occur too
+        often for a literal search to beat the pattern.
+        """
+        text = self._text
+        if sum(text.count('#' + tag) for tag in tags) > SparseHits:
+            return None
+        pattern = entry_pattern(tags)
+        matches = {}
+        for tag in tags:
+            pos = text.find('#' + tag)
+            while pos != -1:
+                start = text.rfind('\n', 0, pos) + 1
+                if start not in matches:
+                    matches[start] = pattern.match(text, start)
+                pos = text.find('#' + tag, pos + 1)
+        return [matches[start] for start in sorted(matches) if matches[start]]
+
+    def _loaded(self, tags):
+        """
+        (address, name, tag) of the entries in the text with one of tags.
+        """
+        matches = self._sparse_matches(tags)
+        if matches is None:
+            return entry_pattern(tags).findall(self._text)
+        return [m.groups() for m in matches]
+
+    def entries(self, tag):
+        """
+        (address, name) of the entries with tag, in file order.
+        """
+        return [(addr, name) for addr, name, _ in self._loaded((tag,))] + \
+               [(addr, name) for addr, name, t in self._added if t == tag]
+
+    def add(self, addr, name, tag):
+        """
+        Add an entry unless it is there already. Returns whether it was added.
+        """
+        if (addr, tag) in self.lookup(name):
+            return False
+        self._added.append((addr, name, tag))
+        self._index.setdefault(name, []).append((addr, tag))
+        return True
+
+    def _cut(self, tags, keep):
+        """
+        Remove the lines with one of tags whose flag in keep, a list in file
+        order like _loaded(tags), is False, or all of them when keep is None.
+        Returns the number removed.
+        """
+        matches = self._sparse_matches(tags)
+        if keep is None:
+            keep = [False] * len(matches) if matches is not None else []
+        if matches is None:
+            if not any(keep):
+                self._text, removed = entry_pattern(tags).subn('', self._text)
+                return removed
+            matches = entry_pattern(tags).finditer(self._text)
+        pieces = []
+        last = 0
+        for kept, m in zip(keep, matches):
+            if not kept:
+                pieces.append(self._text[last:m.start()])
+                last = m.end()
+        if pieces:
+            pieces.append(self._text[last:])
+            self._text = ''.join(pieces)
+            self._index = None
+        return len(pieces) - 1 if pieces else 0
+
+    def remove(self, tags=HpcTags, names=None):
+        """
+        Remove the entries with one of tags, only those for names if given.
+        Returns the number removed.
+        """
+        if names is None:
+            removed = self._cut(tags, None)
+        else:
+            names = set(names)
+            removed = self._cut(tags, [name not in names for _, name, _ in self._loaded(tags)])
+        kept = [e for e in self._added if e[2] not in tags or (names is not None and e[1] not in names)]
+        removed += len(self._added) - len(kept)
+        self._added = kept
+        if removed:
+            self._index = None
+        return removed
+
+    def replace(self, tag, pairs):
+        """
+        Make the (address, name) pairs the only entries with tag. Returns the
+        number of entries added and removed.
+        """
+        pairs = [tuple(pair) for pair in pairs]
+        loaded = [(addr, name) for addr, name, _ in self._loaded((tag,))]
+        added = [(addr, name) for addr, name, t in self._added if t == tag]
+        # The usual case, and a list compare is much cheaper than the sets
+        if loaded + added == pairs:
+            return 0
+        wanted = set(pairs)
+        seen = set()
+        keep = []
+        for key in loaded:
+            # Only the first of duplicate entries stays
+            kept = key in wanted and key not in seen
+            if kept:
+                seen.add(key)
+            keep.append(kept)
+        removed = self._cut((tag,), keep) if not all(keep) else 0
+        appended = []
+        for pair in pairs:
+            if pair not in seen:
+                seen.add(pair)
+                appended.append(pair)
+        self._added = [e for e in self._added if e[2] != tag] + [pair + (tag,) for pair in appended]
+        self._index = None
+        return removed + len(set(added).symmetric_difference(appended))
+
+    def render(self):
+        text = self._text
+        if self._added:
+            if text and not text.endswith('\n'):
+                text += '\n'
+            text += ''.join(format_entry(addr, name, tag) for addr, name, tag in self._added)
+        return text
+
+    def save(self, mode=0o644):
+        """
+        Write the file if its content changed. Returns whether it was written.
+        """
+        content = self.render().encode(Encoding)
+        digest = hashlib.sha256(content).hexdigest()
+        if digest == self._digest:
+            return False
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'wb') as F:
+                F.write(content)
+            os.chmod(tmp, mode)
+            os.rename(tmp, self.path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._digest = digest
+        self._text = content.decode(Encoding)
+        self._added = []
+        return True
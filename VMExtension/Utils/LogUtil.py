@@ -0,0 +1,360 @@
+#
+# Size and age bounded log files
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+RotatingLog appends to a file and rotates it into a timestamped segment
+(nodemanager.txt.20180102T030405) when it grows over MaxBytes or gets older
+than MaxAge seconds. Rotation is a rename, the segments are gzipped later by
+a Compressor thread running at low priority, and the oldest segments are
+deleted while all files of the log take more than TotalBytes.
+
+Several processes may append to the same log (e.g. the handler log), a
+rotation is done under an flock on the active file and the other writers
+reopen the path when they notice the rename.
+
+TailBuffer keeps the last bytes written to a stream in memory, for crash
+reports that need the last lines of output without reading the logs back.
+
+The limits can be set from publicSettings, e.g.
+"LogRotation": {"MaxBytes": 10485760, "MaxAge": 86400, "TotalBytes": 104857600, "Compress": true}
+"""
+
+
+import collections
+import errno
+import fcntl
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+Defaults = {
+    'MaxBytes': 50 * 1024 * 1024,
+    'MaxAge': 7 * 24 * 3600,
+    'TotalBytes': 500 * 1024 * 1024,
+    'Compress': True,
+}
+CompressedSuffix = '.gz'
+# Temporary files of a compressor that died are removed after this many seconds
+StaleTempInSeconds = 3600
+
+def _segment_suffix(name, prefix):
+    """
+    The timestamp part of a segment name, or None if name is not a segment
+    of the log whose file name is prefix.
+    """
+    if not name.startswith(prefix + '.') or not name[len(prefix) + 1:len(prefix) + 2].isdigit():
+        return None
+    return name[len(prefix) + 1:]
+
+class Compressor:
+    """
+    Gzips rotated segments one at a time on a background thread. The thread
+    lowers its own priority where the platform allows it, so compression
+    only uses otherwise idle CPU.
+    """
+    def __init__(self, log, nice=19):
+        self._log = log
+        self._nice = nice
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, path, on_done):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-compressor')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((path, on_done))
+
+    def _lower_priority(self):
+        # On Linux the nice value is per thread, setpriority() needs the native
+        # thread id and nice() called from this thread only changes this thread
+        get_native_id = getattr(threading, 'get_native_id', None)
+        try:
+            if get_native_id is not None and hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, get_native_id(), self._nice)
+            else:
+                increment = self._nice - os.nice(0)
+                if increment > 0:
+                    os.nice(increment)
+        except OSError:
+            pass
+
+    def _run(self):
+        self._lower_priority()
+        while True:
+            path, on_done = self._queue.get()
+            try:
+                compress(path)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    self._log("Failed to compress {0}: {1}".format(path, e))
+            try:
+                on_done()
+            except Exception as e:
+                self._log("Failed to clean up after compressing {0}: {1}".format(path, e))
+
+def compress(path):
+    """
+    Replace path with path.gz. The data is written to a temporary file first
+    so a half-written archive never has the final name.
+    """
+    target = path + CompressedSuffix
+    tmp = '{0}.{1}.tmp'.format(target, os.getpid())
+    try:
+        with open(path, 'rb') as src:
+            dest = gzip.open(tmp, 'wb', 6)
+            try:
+                shutil.copyfileobj(src, dest, 256 * 1024)
+            finally:
+                dest.close()
+        shutil.copystat(path, tmp)
+        os.rename(tmp, target)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(path)
+
+class RotatingLog:
+    def __init__(self, path, max_bytes=None, max_age=None, total_bytes=None, compressor=None, log=None, shared=False):
+        """
+        Set shared when other processes append to the same path, every write
+        then checks whether one of them rotated the file.
+        """
+        self.path = path
+        self._shared = shared
+        self._max_bytes = int(max_bytes if max_bytes is not None else Defaults['MaxBytes'])
+        self._max_age = float(max_age if max_age is not None else Defaults['MaxAge'])
+        self._total_bytes = int(total_bytes if total_bytes is not None else Defaults['TotalBytes'])
+        self._compressor = compressor
+        self._log = log or (lambda msg: None)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._created = None
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._open()
+        # Segments a previous process rotated but did not get to compress
+        if self._compressor is not None:
+            for segment in self._segments():
+                if not segment.endswith(CompressedSuffix) and not segment.endswith('.tmp'):
+                    self._compressor.submit(segment, self.prune)
+
+    @classmethod
+    def from_settings(cls, path, settings, compressor=None, log=None, shared=False):
+        settings = settings or {}
+        if not settings.get('Compress', Defaults['Compress']):
+            compressor = None
+        return cls(path, settings.get('MaxBytes'), settings.get('MaxAge'), settings.get('TotalBytes'), compressor, log, shared)
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        st = os.fstat(self._file.fileno())
+        self._size = st.st_size
+        self._inode = st.st_ino
+        # The creation time isn't recorded, the age of a non-empty file counts from when it was opened
+        self._created = time.time() if st.st_size else None
+
+    def _reopen_if_rotated(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+        if st is None or st.st_ino != self._inode:
+            self._file.close()
+            self._open()
+
+    def _needs_rotation(self, now):
+        if self._size == 0:
+            return False
+        if self._size >= self._max_bytes:
+            return True
+        return self._created is not None and now - self._created >= self._max_age
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with self._lock:
+            now = time.time()
+            if self._shared:
+                self._reopen_if_rotated()
+                self._size = os.fstat(self._file.fileno()).st_size
+            if self._needs_rotation(now):
+                self._rotate(now)
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            if self._created is None:
+                self._created = now
+
+    def _rotate(self, now):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._reopen_if_rotated()
+            if not self._needs_rotation(now):
+                return
+            base = '{0}.{1}'.format(self.path, time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)))
+            segment = base
+            suffix = 0
+            while os.path.exists(segment) or os.path.exists(segment + CompressedSuffix):
+                suffix += 1
+                segment = '{0}.{1}'.format(base, suffix)
+            os.rename(self.path, segment)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._open()
+        if self._compressor is not None:
+            self._compressor.submit(segment, self.prune)
+        else:
+            self.prune()
+
+    def _segments(self):
+        dirname = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path)
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        # The timestamps sort in time order
+        return [os.path.join(dirname, name) for name in sorted(names) if _segment_suffix(name, prefix)]
+
+    def prune(self):
+        """
+        Delete the oldest segments while the log takes more than TotalBytes.
+        """
+        now = time.time()
+        segments = []
+        total = 0
+        for path in self._segments():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if path.endswith('.tmp'):
+                if now - st.st_mtime > StaleTempInSeconds:
+                    self._remove(path)
+                continue
+            segments.append((path, st.st_size))
+            total += st.st_size
+        try:
+            total += os.stat(self.path).st_size
+        except OSError:
+            pass
+        for path, size in segments:
+            if total <= self._total_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self._log("Failed to remove {0}: {1}".format(path, e))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class RotatingHandler(logging.Handler):
+    """
+    A logging handler writing to a RotatingLog.
+    """
+    def __init__(self, rotating_log):
+        logging.Handler.__init__(self)
+        self._rotating_log = rotating_log
+
+    def emit(self, record):
+        try:
+            self._rotating_log.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self._rotating_log.close()
+        logging.Handler.close(self)
+
+class TailBuffer:
+    """
+    The last max_bytes bytes written, kept as a deque of chunks. Memory stays
+    bounded whatever the size of the writes.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._chunks = collections.deque()
+        self._size = 0
+        self._truncated = False
+
+    def write(self, data):
+        if len(data) >= self._max_bytes:
+            self._chunks.clear()
+            self._truncated = self._truncated or len(data) > self._max_bytes or self._size > 0
+            data = data[-self._max_bytes:]
+            self._size = 0
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self._max_bytes:
+            excess = self._size - self._max_bytes
+            first = self._chunks[0]
+            self._truncated = True
+            if len(first) <= excess:
+                self._chunks.popleft()
+                self._size -= len(first)
+            else:
+                self._chunks[0] = first[excess:]
+                self._size -= excess
+
+    def clear(self):
+        self._chunks.clear()
+        self._size = 0
+        self._truncated = False
+
+    def lines(self, max_lines=None):
+        """
+        The buffered output as text lines, the last max_lines of them. A
+        line cut by the size limit is left out.
+        """
+        data = b''.join(self._chunks)
+        if self._truncated and b'\n' in data:
+            data = data[data.index(b'\n') + 1:]
+        lines = data.decode('utf-8', 'replace').splitlines()
+        if max_lines is not None:
+            lines = lines[-max_lines:] if max_lines > 0 else []
+        return lines
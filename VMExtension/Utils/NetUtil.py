@@ -0,0 +1,381 @@
+#
+# Network interfaces and addresses from rtnetlink, and their changes
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+read_snapshot() lists the links and the IPv4 and IPv6 addresses of the node
+with two rtnetlink dumps, RTM_GETLINK and RTM_GETADDR, however many
+interfaces there are. Where netlink sockets are not available it falls back
+to /sys/class/net for the links, SIOCGIFADDR per interface for the primary
+IPv4 address and /proc/net/if_inet6 for IPv6.
+
+A Monitor subscribes to the link and address groups (RTMGRP_LINK,
+RTMGRP_IPV4_IFADDR, RTMGRP_IPV6_IFADDR) and keeps the last snapshot until an
+event says it changed, so asking for the addresses costs nothing while the
+network is stable. attach() puts it on the supervisor's EventLoop and calls
+back once a burst of events has settled; wait_for_nics() waits for the
+first usable address without polling.
+"""
+
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import struct
+import time
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_OPERSTATE = 16
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_DADFAILED = 0x08
+IFA_F_TENTATIVE = 0x40
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+RT_SCOPE_UNIVERSE = 0
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+# IF_OPER_* of the kernel, by value
+OperStates = ('unknown', 'notpresent', 'down', 'lowerlayerdown', 'testing', 'dormant', 'up')
+# The scopes of /proc/net/if_inet6 as rtnetlink scopes
+Inet6Scopes = {0x00: RT_SCOPE_UNIVERSE, 0x40: 200, 0x20: 253, 0x10: 254}
+
+SysNetDir = '/sys/class/net'
+ProcInet6File = '/proc/net/if_inet6'
+RecvBufferSize = 65536
+MonitorBufferSize = 256 * 1024
+SettleInSeconds = 1
+
+Link = collections.namedtuple('Link', 'index name flags operstate mac mtu')
+Address = collections.namedtuple('Address', 'index ifname family address prefixlen scope flags')
+
+class Snapshot:
+    def __init__(self, links, addresses, source):
+        """
+        links and addresses are lists of Link and Address, source says
+        where they were read from, 'netlink' or 'sysfs'.
+        """
+        self.links = links
+        self.addresses = addresses
+        self.source = source
+
+    def usable(self, loopback=False):
+        """
+        The global addresses that are not tentative or failed, of the links
+        that are up, IPv4 before IPv6.
+        """
+        up = dict((link.index, link) for link in self.links if link.flags & IFF_UP)
+        usable = [addr for addr in self.addresses
+                  if addr.index in up
+                  and (loopback or not up[addr.index].flags & IFF_LOOPBACK)
+                  and addr.scope == RT_SCOPE_UNIVERSE
+                  and not addr.flags & (IFA_F_TENTATIVE | IFA_F_DADFAILED)]
+        return sorted(usable, key=lambda addr: addr.family != socket.AF_INET)
+
+    def nics(self, loopback=False):
+        """
+        (interface name, address) of the usable addresses.
+        """
+        return [(addr.ifname, addr.address) for addr in self.usable(loopback)]
+
+def diff(old, new):
+    """
+    (added, removed) addresses between two snapshots, in "ifname address/prefix".
+    """
+    describe = lambda s: set('{0} {1}/{2}'.format(a.ifname, a.address, a.prefixlen) for a in (s.addresses if s else []))
+    before, after = describe(old), describe(new)
+    return sorted(after - before), sorted(before - after)
+
+def _align(length):
+    return (length + 3) & ~3
+
+def _messages(data):
+    """
+    (type, body) of the netlink messages in data.
+    """
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type = struct.unpack_from('=IH', data, offset)
+        if length < 16:
+            break
+        yield msg_type, data[offset + 16:offset + length]
+        offset += _align(length)
+
+def _attributes(data, offset):
+    attrs = {}
+    while offset + 4 <= len(data):
+        length, attr_type = struct.unpack_from('=HH', data, offset)
+        if length < 4:
+            break
+        # The top bits are the nested and byte order flags
+        attrs[attr_type & 0x3fff] = data[offset + 4:offset + length]
+        offset += _align(length)
+    return attrs
+
+def _parse_link(body):
+    _, _, index, flags = struct.unpack_from('=BxHiI', body)
+    attrs = _attributes(body, 16)
+    name = attrs.get(IFLA_IFNAME, b'').split(b'\0', 1)[0].decode('latin-1')
+    operstate = struct.unpack('=B', attrs[IFLA_OPERSTATE][:1])[0] if IFLA_OPERSTATE in attrs else 0
+    mac = ':'.join('{0:02x}'.format(b) for b in bytearray(attrs.get(IFLA_ADDRESS, b'')))
+    mtu = struct.unpack('=I', attrs[IFLA_MTU][:4])[0] if IFLA_MTU in attrs else None
+    return Link(index, name, flags, OperStates[operstate] if operstate < len(OperStates) else 'unknown', mac, mtu)
+
+def _parse_address(body, names):
+    family, prefixlen, flags, scope, index = struct.unpack_from('=BBBBI', body)
+    if family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    attrs = _attributes(body, 8)
+    # IFA_ADDRESS is the peer on a point to point link, IFA_LOCAL our end
+    raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+    if raw is None:
+        return None
+    if IFA_FLAGS in attrs:
+        flags = struct.unpack('=I', attrs[IFA_FLAGS][:4])[0]
+    return Address(index, names.get(index, ''), family, socket.inet_ntop(family, raw), prefixlen, scope, flags)
+
+def _dump(sock, msg_type, payload, seq):
+    sock.send(struct.pack('=IHHII', 16 + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+    bodies = []
+    while True:
+        for reply_type, body in _messages(sock.recv(RecvBufferSize)):
+            if reply_type == NLMSG_DONE:
+                return bodies
+            if reply_type == NLMSG_ERROR:
+                code = -struct.unpack_from('=i', body)[0]
+                if code:
+                    raise OSError(code, os.strerror(code))
+                continue
+            bodies.append((reply_type, body))
+
+def read_netlink():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        links = [_parse_link(body) for reply_type, body in _dump(sock, RTM_GETLINK, struct.pack('=BxHiII', 0, 0, 0, 0, 0), 1)
+                 if reply_type == RTM_NEWLINK]
+        names = dict((link.index, link.name) for link in links)
+        addresses = [_parse_address(body, names) for reply_type, body in _dump(sock, RTM_GETADDR, struct.pack('=BBBBI', 0, 0, 0, 0, 0), 2)
+                     if reply_type == RTM_NEWADDR]
+    finally:
+        sock.close()
+    return Snapshot(links, [addr for addr in addresses if addr is not None], 'netlink')
+
+def _read(path):
+    try:
+        with open(path, 'r') as F:
+            return F.read().strip()
+    except (IOError, OSError):
+        return None
+
+def _ifreq(sock, request, name):
+    try:
+        return fcntl.ioctl(sock.fileno(), request, struct.pack('256s', name.encode('latin-1')[:15]))
+    except IOError as e:
+        # No IPv4 address on the interface, or it went away since the listdir
+        if e.errno in (errno.EADDRNOTAVAIL, errno.ENODEV, errno.ENXIO):
+            return None
+        raise
+
+def read_sysfs(net_dir=None, inet6_file=None):
+    net_dir = net_dir or SysNetDir
+    links = []
+    for name in sorted(os.listdir(net_dir)):
+        path = os.path.join(net_dir, name)
+        try:
+            index = int(_read(os.path.join(path, 'ifindex')))
+            flags = int(_read(os.path.join(path, 'flags')), 16)
+        except (TypeError, ValueError):
+            continue
+        mtu = _read(os.path.join(path, 'mtu'))
+        links.append(Link(index, name, flags, _read(os.path.join(path, 'operstate')) or 'unknown',
+                          _read(os.path.join(path, 'address')) or '', int(mtu) if mtu else None))
+    addresses = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for link in links:
+            addr = _ifreq(sock, SIOCGIFADDR, link.name)
+            if addr is None:
+                continue
+            mask = _ifreq(sock, SIOCGIFNETMASK, link.name)
+            prefixlen = bin(struct.unpack('!I', mask[20:24])[0]).count('1') if mask else 32
+            addresses.append(Address(link.index, link.name, socket.AF_INET, socket.inet_ntoa(addr[20:24]), prefixlen,
+                                     RT_SCOPE_UNIVERSE if not link.flags & IFF_LOOPBACK else 254, 0))
+    finally:
+        sock.close()
+    for line in (_read(inet6_file or ProcInet6File) or '').splitlines():
+        fields = line.split()
+        if len(fields) != 6:
+            continue
+        raw = bytes(bytearray(int(fields[0][i:i + 2], 16) for i in range(0, 32, 2)))
+        addresses.append(Address(int(fields[1], 16), fields[5], socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, raw),
+                                 int(fields[2], 16), Inet6Scopes.get(int(fields[3], 16), 253), int(fields[4], 16)))
+    return Snapshot(links, addresses, 'sysfs')
+
+def read_snapshot():
+    if hasattr(socket, 'AF_NETLINK'):
+        try:
+            return read_netlink()
+        except (IOError, OSError, socket.error, struct.error, ValueError):
+            pass
+    return read_sysfs()
+
+class Monitor:
+    def __init__(self, sock):
+        self._sock = sock
+        self._snapshot = None
+        self._timer = None
+        # Without events the cached snapshot can't be trusted
+        self._watching = True
+
+    @classmethod
+    def open(cls, log=None):
+        """
+        A Monitor subscribed to link and address changes, or None, after
+        logging why, when netlink is not available.
+        """
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        except (AttributeError, socket.error) as e:
+            if log:
+                log("Can't watch the network interfaces: {0}".format(e))
+            return None
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MonitorBufferSize)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            sock.setblocking(False)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.fcntl(sock.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        except (IOError, OSError, socket.error) as e:
+            sock.close()
+            if log:
+                log("Can't watch the network interfaces: {0}".format(e))
+            return None
+        return cls(sock)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def read_events(self):
+        """
+        Read the pending events. Returns whether the links or addresses may
+        have changed, the snapshot is read again on the next snapshot().
+        """
+        changed = False
+        while True:
+            try:
+                data = self._sock.recv(RecvBufferSize)
+            except (IOError, OSError, socket.error) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.ENOBUFS:
+                    # Events were dropped, only a new dump tells what changed
+                    changed = True
+                    continue
+                raise
+            if not data:
+                break
+            for msg_type, _ in _messages(data):
+                if msg_type in (RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR):
+                    changed = True
+        if changed:
+            self._snapshot = None
+        return changed
+
+    def snapshot(self):
+        # Subscribed before the dump, so no change between the two is missed
+        if self._snapshot is None or not self._watching:
+            self._snapshot = read_snapshot()
+        return self._snapshot
+
+    def attach(self, loop, on_change, log, settle=SettleInSeconds):
+        """
+        Watch on an EventLoop, on_change(old, new) is called with the
+        snapshots once no event came for settle seconds. The loop doesn't
+        guard its callbacks, errors are logged here.
+        """
+        state = {'last': None}
+        try:
+            state['last'] = self.snapshot()
+        except Exception as e:
+            log("Failed to read the network interfaces: {0}".format(e))
+        def settled():
+            self._timer = None
+            try:
+                new = self.snapshot()
+                old, state['last'] = state['last'], new
+                on_change(old, new)
+            except Exception as e:
+                log("Failed to read the network interfaces: {0}".format(e))
+        def readable():
+            try:
+                changed = self.read_events()
+            except Exception as e:
+                # The socket would stay readable, stop watching and read the snapshot every time
+                log("Failed to read the network events, no longer watching them: {0}".format(e))
+                loop.remove_reader(self.fileno())
+                self._watching = False
+                changed = True
+            if changed:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = loop.call_later(settle, settled)
+        loop.add_reader(self.fileno(), readable)
+
+    def close(self):
+        self._sock.close()
+
+def wait_for_nics(timeout, log=None):
+    """
+    The usable (interface name, address) once there is one, or [] after
+    timeout seconds.
+    """
+    monitor = Monitor.open(log)
+    if monitor is None:
+        return read_snapshot().nics()
+    deadline = time.time() + timeout
+    try:
+        while True:
+            nics = monitor.snapshot().nics()
+            remaining = deadline - time.time()
+            if nics or remaining <= 0:
+                return nics
+            select.select([monitor], [], [], remaining)
+            monitor.read_events()
+    finally:
+        monitor.close()
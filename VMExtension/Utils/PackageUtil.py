@@ -0,0 +1,356 @@
+#
+# OS package installation for the supported distros
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Installs a batch of OS packages in one package manager transaction.
+
+Before running the package manager we wait, up to a bounded timeout, for
+the lock held by other package manager instances (waagent, cloud-init,
+unattended upgrades) to be released, instead of failing and sleeping
+blindly. The result is reported per package:
+
+    pm = get_package_manager('ubuntu', waagent.Log, waagent.RunGetOutput)
+    outcomes = pm.install(['sysstat', 'libunwind8-dev'])
+    # {'sysstat': 'present', 'libunwind8-dev': 'installed'}
+
+When a local repository is given, the package manager resolves packages
+against that directory only and never touches the network. The directory
+holds .rpm files with createrepo metadata (repodata/repomd.xml) on yum and
+zypper, or .deb files with a Packages index (dpkg-scanpackages) on apt.
+"""
+
+
+import atexit
+import fcntl
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+Present = 'present'
+Installed = 'installed'
+Failed = 'failed'
+# struct flock, l_start and l_len are 64 bits with large file support
+FlockFormat = 'hhqqi'
+
+class PackageManagerBusy(Exception):
+    pass
+
+def _pid_alive(pid):
+    if pid <= 0 or pid == os.getpid():
+        return False
+    return os.path.isdir(os.path.join('/proc', str(pid)))
+
+def _fcntl_lock_held(path):
+    """
+    Return True if another process holds an fcntl lock on the file. F_GETLK
+    only reports the holder, taking a test lock would make apt fail with
+    "Could not get lock" while we held it.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        query = struct.pack(FlockFormat, fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+        return struct.unpack(FlockFormat, fcntl.fcntl(fd, fcntl.F_GETLK, query))[0] != fcntl.F_UNLCK
+    finally:
+        os.close(fd)
+
+def _pidfile_lock_held(path):
+    try:
+        with open(path, 'r') as F:
+            pid = int(F.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return False
+    return _pid_alive(pid)
+
+class PackageManager:
+    """
+    A distro's package manager defines query_command(pkgs), the command
+    listing which of pkgs are installed, parse_installed(output, pkgs) and
+    install_command(pkgs).
+    """
+    # Files locked with fcntl by the package manager while it runs
+    lock_files = []
+    # Pid files written by the package manager front end while it runs
+    pid_files = []
+    # Package names that differ from the rpm name used by callers
+    name_map = {}
+    # Index files one of which a local repository must contain
+    local_metadata_files = []
+    LocalRepoName = 'hpcacm-local'
+
+    def __init__(self, log, run_get_output, lock_timeout=300, lock_poll_interval=2, local_repo=None):
+        self._log = log
+        self._run_get_output = run_get_output
+        self._lock_timeout = lock_timeout
+        self._lock_poll_interval = lock_poll_interval
+        self._local_repo = None
+        self._local_conf_dir = None
+        if local_repo:
+            if not self.has_local_metadata(local_repo):
+                raise Exception("local package repository {0} has none of {1}".format(local_repo, ", ".join(self.local_metadata_files)))
+            self._local_repo = os.path.abspath(local_repo)
+            self._log("Resolve packages only against local repository {0}".format(self._local_repo))
+
+    @classmethod
+    def has_local_metadata(cls, repo_dir):
+        for name in cls.local_metadata_files:
+            if os.path.isfile(os.path.join(repo_dir, name)):
+                return True
+        return False
+
+    def _get_local_conf_dir(self):
+        """
+        Private directory for the repo definition pointing at the local
+        repository, so the system repo configuration is left untouched.
+        """
+        if self._local_conf_dir is None:
+            self._local_conf_dir = tempfile.mkdtemp(prefix='hpcacm-pkg-')
+            atexit.register(shutil.rmtree, self._local_conf_dir, True)
+            self.prepare_local_repo(self._local_conf_dir)
+        return self._local_conf_dir
+
+    def prepare_local_repo(self, conf_dir):
+        pass
+
+    def package_name(self, pkg):
+        return self.name_map.get(pkg, pkg)
+
+    def lock_holder(self):
+        for path in self.lock_files:
+            if _fcntl_lock_held(path):
+                return path
+        for path in self.pid_files:
+            if _pidfile_lock_held(path):
+                return path
+        return None
+
+    def wait_for_lock(self):
+        deadline = time.time() + self._lock_timeout
+        holder = self.lock_holder()
+        if holder is None:
+            return
+        self._log("Package manager lock {0} is held, waiting up to {1} seconds".format(holder, self._lock_timeout))
+        while holder is not None:
+            if time.time() >= deadline:
+                raise PackageManagerBusy("package manager lock {0} still held after {1} seconds".format(holder, self._lock_timeout))
+            time.sleep(self._lock_poll_interval)
+            holder = self.lock_holder()
+        self._log("Package manager lock released")
+
+    def installed_packages(self, pkgs):
+        """
+        Return the subset of pkgs that is installed, with one query process.
+        """
+        if not pkgs:
+            return set()
+        retcode, output = self._run_get_output(self.query_command(pkgs), False)
+        return self.parse_installed(output, pkgs)
+
+    def on_failure(self, retcode, output):
+        """
+        Hook for distro specific recovery, return True to retry the
+        transaction once more.
+        """
+        return False
+
+    def install(self, pkgs):
+        """
+        Install the missing packages in one transaction and return a dict from
+        each requested name to Present, Installed or Failed.
+        """
+        names = {}
+        for pkg in pkgs:
+            names[pkg] = self.package_name(pkg)
+        present = self.installed_packages(list(set(names.values())))
+        outcomes = {}
+        missing = []
+        for pkg in pkgs:
+            if names[pkg] in present:
+                outcomes[pkg] = Present
+            elif names[pkg] not in missing:
+                missing.append(names[pkg])
+        if missing:
+            if not self._transaction(missing) and len(missing) > 1:
+                # apt and zypper abort the whole transaction on one bad
+                # package, so retry the packages one by one
+                for name in missing:
+                    self._transaction([name])
+            present = self.installed_packages(missing)
+            for pkg in pkgs:
+                if pkg not in outcomes:
+                    outcomes[pkg] = Installed if names[pkg] in present else Failed
+        for pkg in pkgs:
+            self._log("package {0} ({1}): {2}".format(pkg, names[pkg], outcomes[pkg]))
+        return outcomes
+
+    def _transaction(self, pkgs, max_lock_retries=3):
+        retried = False
+        lock_retries = 0
+        while True:
+            self.wait_for_lock()
+            if self._local_repo:
+                self._get_local_conf_dir()
+            cmd = self.install_command(pkgs)
+            self._log("The command to install {0}: {1}".format(" ".join(pkgs), cmd))
+            retcode, output = self._run_get_output(cmd, False)
+            if retcode == 0:
+                return True
+            self._log("package installation failed {0}:\n {1}".format(retcode, output))
+            if self.lock_holder() is not None and lock_retries < max_lock_retries:
+                # Someone grabbed the lock between our check and the run
+                lock_retries += 1
+                continue
+            if not retried and self.on_failure(retcode, output):
+                retried = True
+                continue
+            return False
+
+class YumPackageManager(PackageManager):
+    lock_files = ['/var/lib/rpm/.rpm.lock']
+    pid_files = ['/var/run/yum.pid']
+    local_metadata_files = ['repodata/repomd.xml']
+
+    def prepare_local_repo(self, conf_dir):
+        with open(os.path.join(conf_dir, self.LocalRepoName + '.repo'), 'w') as F:
+            F.write("[{0}]\nname={0}\nbaseurl=file://{1}\nenabled=1\ngpgcheck=0\n".format(self.LocalRepoName, self._local_repo))
+
+    def query_command(self, pkgs):
+        return "rpm -q --qf '%{{NAME}}\\n' {0}".format(" ".join(pkgs))
+
+    def parse_installed(self, output, pkgs):
+        return set(line.strip() for line in output.splitlines()) & set(pkgs)
+
+    def install_command(self, pkgs):
+        if self._local_repo:
+            return "yum -y --noplugins --setopt=reposdir={0} --disablerepo='*' --enablerepo={1} install {2}".format(
+                self._get_local_conf_dir(), self.LocalRepoName, " ".join(pkgs))
+        return "yum -y install " + " ".join(pkgs)
+
+class AptPackageManager(PackageManager):
+    lock_files = ['/var/lib/dpkg/lock-frontend', '/var/lib/dpkg/lock', '/var/lib/apt/lists/lock']
+    name_map = {
+        'python-devel': 'python-dev',
+    }
+    local_metadata_files = ['Packages', 'Packages.gz']
+
+    def _apt_options(self):
+        conf_dir = self._get_local_conf_dir()
+        return "-o Dir::Etc::SourceList={0} -o Dir::Etc::SourceParts=/dev/null -o Dir::State::Lists={1} -o APT::Get::List-Cleanup=0".format(
+            os.path.join(conf_dir, 'sources.list'), os.path.join(conf_dir, 'lists'))
+
+    def prepare_local_repo(self, conf_dir):
+        os.makedirs(os.path.join(conf_dir, 'lists', 'partial'))
+        with open(os.path.join(conf_dir, 'sources.list'), 'w') as F:
+            F.write("deb [trusted=yes] file:{0} ./\n".format(self._local_repo))
+        retcode, output = self._run_get_output("apt-get {0} update".format(self._apt_options()), False)
+        if retcode != 0:
+            raise Exception("failed to index local package repository {0}: {1}".format(self._local_repo, output))
+
+    def query_command(self, pkgs):
+        return "dpkg-query -W -f='${{Package}} ${{Status}}\\n' {0}".format(" ".join(pkgs))
+
+    def parse_installed(self, output, pkgs):
+        installed = set()
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) >= 4 and fields[-1] == 'installed':
+                installed.add(fields[0].split(':')[0])
+        return installed & set(pkgs)
+
+    def install_command(self, pkgs):
+        if self._local_repo:
+            return "apt-get -y {0} install {1}".format(self._apt_options(), " ".join(pkgs))
+        return "apt-get -y install " + " ".join(pkgs)
+
+class ZypperPackageManager(PackageManager):
+    lock_files = ['/var/lib/rpm/.rpm.lock']
+    pid_files = ['/var/run/zypp.pid', '/run/zypp.pid']
+    OpenSuseRepo = 'http://download.opensuse.org/distribution/13.2/repo/oss/suse/'
+
+    local_metadata_files = ['repodata/repomd.xml']
+
+    def __init__(self, *args, **kwargs):
+        PackageManager.__init__(self, *args, **kwargs)
+        self._gpg_auto_import = False
+        if self._local_repo:
+            return
+        if not os.path.isdir('/etc/zypp/repos.d') or not os.listdir('/etc/zypp/repos.d'):
+            self._add_opensuse_repo()
+
+    def prepare_local_repo(self, conf_dir):
+        with open(os.path.join(conf_dir, self.LocalRepoName + '.repo'), 'w') as F:
+            F.write("[{0}]\nname={0}\nbaseurl=dir:{1}\ntype=rpm-md\nenabled=1\nautorefresh=1\ngpgcheck=0\n".format(self.LocalRepoName, self._local_repo))
+
+    def _add_opensuse_repo(self):
+        self._run_get_output("zypper ar {0} opensuse".format(self.OpenSuseRepo), False)
+        self._gpg_auto_import = True
+
+    def query_command(self, pkgs):
+        return "rpm -q --qf '%{{NAME}}\\n' {0}".format(" ".join(pkgs))
+
+    def parse_installed(self, output, pkgs):
+        return set(line.strip() for line in output.splitlines()) & set(pkgs)
+
+    def install_command(self, pkgs):
+        if self._local_repo:
+            return "zypper -n --no-gpg-checks --reposd-dir {0} install --force-resolution -l {1}".format(
+                self._get_local_conf_dir(), " ".join(pkgs))
+        if self._gpg_auto_import:
+            return "zypper -n --gpg-auto-import-keys install --force-resolution -l " + " ".join(pkgs)
+        return "zypper -n install --force-resolution -l " + " ".join(pkgs)
+
+    def on_failure(self, retcode, output):
+        # 104: ZYPPER_EXIT_INF_CAP_NOT_FOUND, the repos don't provide a package
+        if retcode == 104 and not self._local_repo:
+            self._add_opensuse_repo()
+            return True
+        return False
+
+def get_package_manager_class(distro_name):
+    if distro_name == "centos" or distro_name == "redhat":
+        return YumPackageManager
+    elif distro_name == "ubuntu":
+        return AptPackageManager
+    elif distro_name == "suse":
+        return ZypperPackageManager
+    else:
+        raise Exception("Unsupported Linux Distro.")
+
+def find_local_repo(repo_root, distro_name, distro_version):
+    """
+    Return the directory under repo_root with package metadata for this
+    distro, trying <repo_root>/<distro><major version> before repo_root.
+    """
+    cls = get_package_manager_class(distro_name)
+    candidates = [repo_root]
+    if distro_version:
+        candidates.insert(0, os.path.join(repo_root, '{0}{1}'.format(distro_name, distro_version.split('.')[0])))
+    for candidate in candidates:
+        if cls.has_local_metadata(candidate):
+            return candidate
+    return None
+
+def get_package_manager(distro_name, log, run_get_output, lock_timeout=300, local_repo=None):
+    cls = get_package_manager_class(distro_name)
+    return cls(log, run_get_output, lock_timeout, local_repo=local_repo)
@@ -0,0 +1,170 @@
+#
+# Locked pid files and process identity from /proc
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+A daemon owns its pid file by holding an flock on it for its whole life,
+the kernel drops the lock when the process dies however it dies. The file
+records "<pid> <start time>", the start time being field 22 of
+/proc/<pid>/stat, so a reused pid is told apart from the daemon.
+
+owner() only reports a pid when the file is locked, the recorded start time
+matches the running process and, optionally, its /proc cmdline matches.
+Nothing is spawned for these checks.
+"""
+
+
+import errno
+import fcntl
+import os
+import time
+
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def process_start_time(pid):
+    """
+    The start time of pid in clock ticks since boot, or None if there is no
+    such process.
+    """
+    try:
+        with open('/proc/{0}/stat'.format(int(pid)), 'rb') as F:
+            stat = F.read()
+    except (IOError, OSError):
+        return None
+    # The command name may contain spaces and parentheses, the fields after it don't
+    fields = stat[stat.rindex(b')') + 2:].split()
+    return int(fields[19])
+
+def process_cmdline(pid):
+    """
+    The arguments of pid as a list of strings, or None.
+    """
+    try:
+        with open('/proc/{0}/cmdline'.format(int(pid)), 'rb') as F:
+            cmdline = F.read()
+    except (IOError, OSError):
+        return None
+    return [arg.decode('utf-8', 'replace') for arg in cmdline.split(b'\0') if arg]
+
+def read_pid_file(path):
+    """
+    Return (pid, start_time) recorded in path, or None.
+    """
+    try:
+        with open(path, 'r') as F:
+            fields = F.read().split()
+        return int(fields[0]), int(fields[1]) if len(fields) > 1 else None
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def is_locked(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return True
+        raise
+    finally:
+        os.close(fd)
+
+def owner(path, matches=None):
+    """
+    The pid of the live process owning the pid file, or None. matches is
+    called with the process's argument list to check what it is running.
+    """
+    if not is_locked(path):
+        return None
+    recorded = read_pid_file(path)
+    if recorded is None:
+        return None
+    pid, start_time = recorded
+    if start_time is None or process_start_time(pid) != start_time:
+        return None
+    if matches is not None:
+        cmdline = process_cmdline(pid)
+        if not cmdline or not matches(cmdline):
+            return None
+    return pid
+
+def wait_released(path, timeout, interval=0.05):
+    """
+    Wait up to timeout seconds for the owner of path to exit.
+    """
+    deadline = time.time() + timeout
+    while is_locked(path):
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+class FileLock:
+    """
+    An exclusive flock held until release(), not inherited by children.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, timeout=None):
+        """
+        Wait for the lock, at most timeout seconds unless it is None. Return
+        False if it could not be taken in time.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        _set_cloexec(fd)
+        deadline = time.time() + (timeout or 0)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if timeout is None else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES) or time.time() >= deadline:
+                    os.close(fd)
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        return False
+                    raise
+                time.sleep(0.05)
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def fileno(self):
+        return self._fd
+
+class PidFile(FileLock):
+    """
+    The daemon's pid file, locked for the life of the process.
+    """
+    def acquire(self, timeout=0):
+        if not FileLock.acquire(self, timeout):
+            return False
+        pid = os.getpid()
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, '{0} {1}\n'.format(pid, process_start_time(pid)).encode('ascii'))
+        return True
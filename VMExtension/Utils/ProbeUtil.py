@@ -0,0 +1,317 @@
+#
+# Liveness and readiness probes for supervised services
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Probes run on the supervisor's EventLoop with non-blocking sockets, so a
+hung service can't stall the loop. Settings, as given in publicSettings:
+
+"LivenessProbes": {
+  "nodemanager": {"Type": "http", "Url": "http://127.0.0.1:40000/", "Period": 10},
+  "nodeagent": {"Type": "file", "Path": "/opt/NodeAgent/heartbeat", "MaxAge": 60}
+}
+
+Common keys: Period (seconds between checks), Timeout (seconds per check),
+FailureThreshold (consecutive failures before the service is restarted)
+and InitialDelay (seconds after the service started before the first check).
+
+A tcp probe only proves that something listens: the kernel completes the
+connection from the listen backlog even while the server is hung. An http
+probe waits for the response within Timeout, it passes on a 2xx or 3xx
+status, or on any status with "AnyStatus": true.
+
+"ReadinessProbes" takes the same probe settings plus ReadyTimeout, they
+decide when a freshly started service counts as up, e.g. a listening port
+or a ready file written after the start:
+
+"ReadinessProbes": {
+  "nodeagent": {"Type": "file", "Path": "/opt/NodeAgent/ready", "ReadyTimeout": 60}
+}
+"""
+
+
+import errno
+import os
+import re
+import socket
+import time
+
+class Probe:
+    """
+    Settings common to the probe types. A type defines describe() and
+    check(loop, done), which starts one check and calls done(ok, detail)
+    when it completes.
+    """
+    Defaults = {
+        'Period': 10,
+        'Timeout': 5,
+        'FailureThreshold': 3,
+        'InitialDelay': 60,
+    }
+
+    def __init__(self, settings):
+        self.period = float(settings.get('Period', self.Defaults['Period']))
+        self.timeout = float(settings.get('Timeout', self.Defaults['Timeout']))
+        self.failure_threshold = int(settings.get('FailureThreshold', self.Defaults['FailureThreshold']))
+        self.initial_delay = float(settings.get('InitialDelay', self.Defaults['InitialDelay']))
+
+    def cancel(self, loop):
+        pass
+
+class TcpProbe(Probe):
+    def __init__(self, settings):
+        Probe.__init__(self, settings)
+        self.host = settings.get('Host', '127.0.0.1')
+        self.port = int(settings['Port'])
+        self._sock = None
+
+    def describe(self):
+        return 'tcp {0}:{1}'.format(self.host, self.port)
+
+    def check(self, loop, done):
+        self.cancel(loop)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        err = self._sock.connect_ex((self.host, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.cancel(loop)
+            done(False, 'connect to {0}:{1}: {2}'.format(self.host, self.port, os.strerror(err)))
+            return
+        sock = self._sock
+        def on_connect():
+            loop.remove_writer(sock.fileno())
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                self.cancel(loop)
+                done(False, 'connect to {0}:{1}: {2}'.format(self.host, self.port, os.strerror(err)))
+            else:
+                self.connected(loop, sock, done)
+        loop.add_writer(sock.fileno(), on_connect)
+
+    def connected(self, loop, sock, done):
+        self.cancel(loop)
+        done(True, '')
+
+    def cancel(self, loop):
+        if self._sock is not None:
+            loop.remove_writer(self._sock.fileno())
+            loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+class HttpProbe(TcpProbe):
+    """
+    Plain HTTP GET, any 2xx or 3xx status is healthy, any status at all with
+    AnyStatus.
+    """
+    def __init__(self, settings):
+        m = re.match(r'^http://([^/:]+)(?::(\d+))?(/.*)?$', settings['Url'])
+        if not m:
+            raise ValueError("unsupported probe url {0}".format(settings['Url']))
+        settings = dict(settings)
+        settings['Host'] = m.group(1)
+        settings['Port'] = int(m.group(2) or 80)
+        TcpProbe.__init__(self, settings)
+        self.path = m.group(3) or '/'
+        self.any_status = bool(settings.get('AnyStatus', False))
+
+    def describe(self):
+        return 'http {0}:{1}{2}'.format(self.host, self.port, self.path)
+
+    def connected(self, loop, sock, done):
+        request = 'GET {0} HTTP/1.0\r\nHost: {1}\r\nConnection: close\r\n\r\n'.format(self.path, self.host)
+        try:
+            sock.send(request.encode('ascii'))
+        except socket.error as e:
+            self.cancel(loop)
+            done(False, 'send: {0}'.format(e))
+            return
+        response = []
+        def on_read():
+            try:
+                data = sock.recv(4096)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.cancel(loop)
+                done(False, 'recv: {0}'.format(e))
+                return
+            response.append(data)
+            head = b''.join(response)
+            if data and b'\r\n' not in head:
+                return
+            self.cancel(loop)
+            m = re.match(br'^HTTP/\d\.\d (\d{3})', head)
+            if not m:
+                done(False, 'invalid http response')
+            elif self.any_status or 200 <= int(m.group(1)) < 400:
+                done(True, '')
+            else:
+                done(False, 'http status {0}'.format(int(m.group(1))))
+        loop.add_reader(sock.fileno(), on_read)
+
+class FileProbe(Probe):
+    """
+    The service touches a heartbeat file, it is healthy while the file is
+    younger than MaxAge seconds.
+    """
+    def __init__(self, settings):
+        Probe.__init__(self, settings)
+        self.path = settings['Path']
+        self.max_age = float(settings.get('MaxAge', 60))
+        self.newer_than = None
+
+    def describe(self):
+        return 'file {0}'.format(self.path)
+
+    def check(self, loop, done):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            done(False, 'stat {0}: {1}'.format(self.path, e.strerror))
+            return
+        age = time.time() - mtime
+        if self.newer_than is not None and mtime < self.newer_than:
+            done(False, '{0} was written before the service started'.format(self.path))
+        elif age > self.max_age:
+            done(False, '{0} not updated for {1:.0f} seconds'.format(self.path, age))
+        else:
+            done(True, '')
+
+ProbeTypes = {
+    'tcp': TcpProbe,
+    'http': HttpProbe,
+    'file': FileProbe,
+}
+
+# Readiness is polled quickly right after start
+ReadinessDefaults = {
+    'Period': 0.5,
+    'Timeout': 2,
+    'InitialDelay': 0,
+    'MaxAge': 365 * 24 * 3600,
+}
+
+def probe_from_settings(settings, defaults=None):
+    if not settings:
+        return None
+    merged = dict(defaults or {})
+    merged.update(settings)
+    probe_type = merged.get('Type', 'tcp').lower()
+    if probe_type not in ProbeTypes:
+        raise ValueError("unknown probe type {0}".format(probe_type))
+    return ProbeTypes[probe_type](merged)
+
+class ProbeRunner:
+    """
+    Runs a probe on the loop, one check at a time, each bounded by the
+    probe's timeout. Subclasses define _result(ok, detail), what to do with
+    the results.
+    """
+    def __init__(self, loop, probe):
+        self._loop = loop
+        self._probe = probe
+        self._timer = None
+        self._generation = 0
+
+    def stop(self):
+        self._generation += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._probe.cancel(self._loop)
+
+    def _schedule(self, delay):
+        generation = self._generation
+        self._timer = self._loop.call_later(delay, lambda: self._run(generation))
+
+    def _run(self, generation):
+        if generation != self._generation:
+            return
+        state = {'done': False}
+        def finish(ok, detail):
+            if state['done'] or generation != self._generation:
+                return
+            state['done'] = True
+            timeout.cancel()
+            self._probe.cancel(self._loop)
+            self._result(ok, detail)
+        timeout = self._loop.call_later(self._probe.timeout,
+                                        lambda: finish(False, 'timed out after {0:g} seconds'.format(self._probe.timeout)))
+        self._probe.check(self._loop, finish)
+
+class LivenessMonitor(ProbeRunner):
+    """
+    Runs a probe every probe.period seconds while the service is up and calls
+    on_failure(detail) after probe.failure_threshold consecutive failures.
+    """
+    def __init__(self, loop, probe, log, on_failure):
+        ProbeRunner.__init__(self, loop, probe)
+        self._log = log
+        self._on_failure = on_failure
+        self._failures = 0
+
+    def start(self):
+        self.stop()
+        self._failures = 0
+        self._schedule(self._probe.initial_delay)
+
+    def _result(self, ok, detail):
+        if ok:
+            self._failures = 0
+        else:
+            self._failures += 1
+            self._log("Liveness probe {0} failed ({1}/{2}): {3}".format(
+                self._probe.describe(), self._failures, self._probe.failure_threshold, detail))
+            if self._failures >= self._probe.failure_threshold:
+                self.stop()
+                self._on_failure('{0}: {1}'.format(self._probe.describe(), detail))
+                return
+        self._schedule(self._probe.period)
+
+class ReadinessMonitor(ProbeRunner):
+    """
+    Checks a probe every probe.period seconds after the service started until
+    it succeeds, then calls on_ready(). Gives up after ready_timeout seconds
+    and calls on_timeout(detail). A file probe only counts a ready file
+    written after the service started.
+    """
+    def __init__(self, loop, probe, ready_timeout, on_ready, on_timeout):
+        ProbeRunner.__init__(self, loop, probe)
+        self._ready_timeout = ready_timeout
+        self._on_ready = on_ready
+        self._on_timeout = on_timeout
+        self._deadline = None
+
+    def start(self, start_time):
+        self.stop()
+        self._deadline = start_time + self._ready_timeout
+        if isinstance(self._probe, FileProbe):
+            self._probe.newer_than = start_time
+        self._schedule(self._probe.initial_delay)
+
+    def _result(self, ok, detail):
+        if ok:
+            self.stop()
+            self._on_ready()
+        elif time.time() >= self._deadline:
+            self.stop()
+            self._on_timeout('{0}: {1}'.format(self._probe.describe(), detail))
+        else:
+            self._schedule(self._probe.period)
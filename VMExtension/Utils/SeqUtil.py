@@ -0,0 +1,132 @@
+#
+# Discovery of the current configuration sequence number
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+The current sequence number is the one of the most recently modified
+<seq>.settings file in the config folder. Finding it means a stat of every
+file, and the folder only grows over the life of a VM.
+
+The agent adds a new settings file for every new configuration, which
+changes the folder's mtime, so the result is kept in a small index file
+keyed on the folder's path, inode and mtime. While the key matches, the
+lookup is one stat and one small read.
+
+Rewriting an existing settings file in place is not supported: it leaves
+the folder's mtime alone, so the index keeps the old answer until the next
+file is added. Only a stat of every file would catch it, because the
+rewritten file becomes the newest one, and that stat is what the index
+avoids. The agent adds a file for a new configuration and never rewrites
+one.
+
+A folder modified within RacyIntervalInSeconds of the scan is not indexed:
+with coarse timestamps a file added in the same tick would not change the
+mtime again.
+"""
+
+
+import json
+import os
+import time
+
+IndexVersion = 1
+RacyIntervalInSeconds = 2
+
+try:
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+def _entries(folder):
+    """
+    Yield (name, is_file, mtime) for the entries of folder, using scandir
+    where available so the type check needs no extra stat.
+    """
+    if _scandir is not None:
+        for entry in _scandir(folder):
+            try:
+                if entry.is_file():
+                    yield entry.name, True, entry.stat().st_mtime
+                else:
+                    yield entry.name, False, None
+            except OSError:
+                continue
+        return
+    for name in os.listdir(folder):
+        try:
+            st = os.stat(os.path.join(folder, name))
+        except OSError:
+            continue
+        yield name, os.path.isfile(os.path.join(folder, name)), st.st_mtime
+
+def scan_seq_no(config_folder):
+    """
+    One pass over config_folder, returns the sequence number of the most
+    recently modified file named <seq>.*, or -1.
+    """
+    seq_no = -1
+    freshest_time = None
+    for name, is_file, mtime in _entries(config_folder):
+        if not is_file:
+            continue
+        try:
+            cur_seq_no = int(name.split('.')[0])
+        except ValueError:
+            continue
+        if freshest_time is None or mtime > freshest_time:
+            freshest_time = mtime
+            seq_no = cur_seq_no
+    return seq_no
+
+def _folder_key(config_folder):
+    st = os.stat(config_folder)
+    return [os.path.abspath(config_folder), st.st_ino, st.st_mtime], st.st_mtime
+
+def current_seq_no(config_folder, index_file=None):
+    """
+    The current sequence number, from index_file when the folder did not
+    change since it was written. A settings file rewritten in place is not
+    noticed, see the module docstring.
+    """
+    if not index_file:
+        return scan_seq_no(config_folder)
+    try:
+        key, mtime = _folder_key(config_folder)
+    except OSError:
+        return -1
+    try:
+        with open(index_file, 'r') as F:
+            index = json.load(F)
+        if index.get('version') == IndexVersion and index.get('key') == key:
+            return index['seq_no']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    seq_no = scan_seq_no(config_folder)
+    if time.time() - mtime > RacyIntervalInSeconds:
+        tmp = '{0}.{1}.tmp'.format(index_file, os.getpid())
+        try:
+            with open(tmp, 'w') as F:
+                json.dump({'version': IndexVersion, 'key': key, 'seq_no': seq_no}, F)
+            os.rename(tmp, index_file)
+        except (IOError, OSError):
+            pass
+    return seq_no
@@ -0,0 +1,217 @@
+#
+# Dependency-aware step executor
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Runs a small DAG of named steps on a pool of worker threads.
+
+A step starts as soon as all the steps it depends on have succeeded. Steps
+that share a lock name never run at the same time, which is how steps that
+drive the OS package manager are kept serialized while file copies overlap
+with them. A step whose dependency failed is skipped.
+
+Example:
+    graph = StepGraph(waagent.Log, max_workers=4)
+    graph.add('cleanup_hosts', cleanup_host_entries)
+    graph.add('packages', _install_packages, lock='pkg')
+    graph.add('psutils', _install_psutils, deps=['packages'], lock='pkg')
+    graph.add('nodeagent_files', _install_nodeagent_files)
+    graph.add('log_dir', _create_log_dir)
+    graph.add('nodemanager_files', _install_nodemanager_files, deps=['log_dir'])
+    failed = graph.run()
+"""
+
+
+import threading
+import time
+import traceback
+
+StatusPending = 'pending'
+StatusRunning = 'running'
+StatusSucceeded = 'succeeded'
+StatusFailed = 'failed'
+StatusSkipped = 'skipped'
+
+class Step:
+    def __init__(self, name, func, deps, lock):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.lock = lock
+        # The step that held the same lock right before this one
+        self.lock_predecessor = None
+        self.status = StatusPending
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+
+    def elapsed(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+class StepGraph:
+    def __init__(self, log, max_workers=4):
+        self._log = log
+        self._max_workers = max(1, max_workers)
+        self._steps = []
+        self._by_name = {}
+        self._cond = threading.Condition()
+        self._held_locks = set()
+        self._last_holder = {}
+        self._origin = None
+
+    def add(self, name, func, deps=None, lock=None):
+        if name in self._by_name:
+            raise ValueError("duplicate step {0}".format(name))
+        deps = list(deps or [])
+        for dep in deps:
+            if dep not in self._by_name:
+                raise ValueError("step {0} depends on unknown step {1}".format(name, dep))
+        step = Step(name, func, deps, lock)
+        self._steps.append(step)
+        self._by_name[name] = step
+        return step
+
+    def get(self, name):
+        return self._by_name[name]
+
+    def _deps_state(self, step):
+        """
+        Return StatusSucceeded if the step may run, StatusSkipped if any
+        dependency did not succeed, or StatusPending if it has to wait.
+        """
+        for dep in step.deps:
+            status = self._by_name[dep].status
+            if status in (StatusFailed, StatusSkipped):
+                return StatusSkipped
+            if status != StatusSucceeded:
+                return StatusPending
+        return StatusSucceeded
+
+    def _next_ready(self):
+        # Called with self._cond held
+        for step in self._steps:
+            if step.status != StatusPending:
+                continue
+            state = self._deps_state(step)
+            if state == StatusSkipped:
+                step.status = StatusSkipped
+                step.error = 'dependency failed'
+                self._log("Step {0} skipped: dependency failed".format(step.name))
+                self._cond.notify_all()
+                continue
+            if state == StatusSucceeded and (step.lock is None or step.lock not in self._held_locks):
+                return step
+        return None
+
+    def _finished(self):
+        for step in self._steps:
+            if step.status in (StatusPending, StatusRunning):
+                return False
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                step = None
+                while True:
+                    if self._finished():
+                        return
+                    step = self._next_ready()
+                    if step is not None:
+                        break
+                    self._cond.wait(1)
+                step.status = StatusRunning
+                if step.lock is not None:
+                    self._held_locks.add(step.lock)
+                    step.lock_predecessor = self._last_holder.get(step.lock)
+                    self._last_holder[step.lock] = step.name
+                step.start_time = time.time()
+            self._log("Step {0} started".format(step.name))
+            try:
+                step.func()
+                status = StatusSucceeded
+            except Exception as e:
+                step.error = str(e)
+                self._log("Step {0} error: {1}\n{2}".format(step.name, e, traceback.format_exc()))
+                status = StatusFailed
+            with self._cond:
+                step.end_time = time.time()
+                step.status = status
+                if step.lock is not None:
+                    self._held_locks.discard(step.lock)
+                self._cond.notify_all()
+            self._log("Step {0} {1} in {2:.2f}s".format(step.name, status, step.elapsed()))
+
+    def run(self):
+        """
+        Run all the steps and return the list of steps that failed. Skipped
+        steps are not included; they only fail because a dependency did.
+        """
+        self._origin = time.time()
+        workers = []
+        for i in range(min(self._max_workers, len(self._steps))):
+            worker = threading.Thread(target=self._worker, name="step-worker-{0}".format(i))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        self._log(self.report())
+        return [step for step in self._steps if step.status == StatusFailed]
+
+    def critical_path(self):
+        """
+        Walk back from the step that finished last through the dependency
+        (or lock predecessor) that finished last, giving the chain that
+        bounded the total time.
+        """
+        finished = [s for s in self._steps if s.end_time is not None]
+        if not finished:
+            return []
+        step = max(finished, key=lambda s: s.end_time)
+        path = [step]
+        while True:
+            names = list(step.deps)
+            if step.lock_predecessor:
+                names.append(step.lock_predecessor)
+            preds = [self._by_name[n] for n in names if self._by_name[n].end_time is not None]
+            if not preds:
+                break
+            step = max(preds, key=lambda s: s.end_time)
+            path.append(step)
+        path.reverse()
+        return path
+
+    def report(self):
+        lines = ["Step summary:"]
+        for step in self._steps:
+            offset = 0.0
+            if step.start_time is not None and self._origin is not None:
+                offset = step.start_time - self._origin
+            line = "  {0:24} {1:10} start +{2:.2f}s took {3:.2f}s".format(step.name, step.status, offset, step.elapsed())
+            if step.error:
+                line += " ({0})".format(step.error)
+            lines.append(line)
+        path = self.critical_path()
+        if path:
+            total = path[-1].end_time - self._origin
+            lines.append("Critical path ({0:.2f}s): {1}".format(total, " -> ".join(s.name for s in path)))
+        return "\n".join(lines)
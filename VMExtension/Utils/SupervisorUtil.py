@@ -0,0 +1,688 @@
+#
+# Supervision helpers for the node manager daemon
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+RestartPolicy decides how long to wait before restarting a child that
+exited:
+  * the first restart after a stable run happens after InitialDelay
+    (immediately by default);
+  * every further restart waits BaseDelay * Multiplier^n seconds, capped at
+    MaxDelay, with +/- Jitter (a fraction) added;
+  * a child that ran for StableUptime seconds is considered healthy again
+    and the backoff starts over;
+  * CrashLoopThreshold exits within CrashLoopWindow seconds put the child in
+    the crash loop state, where it is restarted only every CrashLoopDelay
+    seconds until it runs stably again.
+
+All of these can be set from publicSettings, e.g.
+"RestartPolicy": {"MaxDelay": 120, "CrashLoopThreshold": 10}
+
+Supervisor runs any number of Services on one EventLoop in the calling
+thread. Child exits are learned from SIGCHLD through the signal wakeup fd,
+restarts and checks are timers on the same loop, so no thread blocks in
+wait() and no polling sleep is needed.
+
+The output of the services goes through pipes owned by the supervisor,
+which writes it to the objects returned by open_log(path), e.g. rotating
+logs. A slow log never blocks the loop for long: the pipes are read in
+chunks whenever they are readable.
+
+The last TailBytes of each pipe are kept in memory, so an exit report can
+carry the last lines the service wrote, and with snapshot_dir set every
+unexpected exit leaves a snapshot file with the exit status and both tails.
+
+A service with a readiness probe counts as started as soon as the probe
+succeeds (ready_timeout bounds the wait), a service without one after
+StartupCheckInSeconds. on_ready() callbacks fire once, when every service
+has started for the first time, unless a service exits or is not ready in
+time before that, then the on_failure() callbacks fire once instead.
+
+A service given a cgroup (see Utils/CgroupUtil.py) is moved into it right
+after it is spawned, and every UsageReportIntervalInSeconds the usage
+counters of the running ones are logged and put in their status message.
+A service given a Placement (see Utils/TopologyUtil.py) gets it applied in
+the child before exec, on every start.
+"""
+
+
+import errno
+import fcntl
+import heapq
+import os
+import random
+import select
+import signal
+import subprocess
+import time
+
+from Utils.CgroupUtil import format_usage
+from Utils.LogUtil import TailBuffer
+from Utils.ProbeUtil import LivenessMonitor, ReadinessMonitor
+
+try:
+    from subprocess import SubprocessError
+except ImportError:
+    # Python 2 re-raises the child's exception, a failed preexec_fn included
+    SubprocessError = OSError
+
+DateTimeFormat = "%Y-%m-%dT%H:%M:%SZ"
+
+class RestartPolicy:
+    Defaults = {
+        'InitialDelay': 0,
+        'BaseDelay': 2,
+        'Multiplier': 2,
+        'MaxDelay': 60,
+        'Jitter': 0.2,
+        'StableUptime': 600,
+        'CrashLoopThreshold': 5,
+        'CrashLoopWindow': 600,
+        'CrashLoopDelay': 300,
+    }
+
+    def __init__(self, **settings):
+        for key, value in self.Defaults.items():
+            setattr(self, '_' + key, float(settings.get(key, value)))
+        self._failures = 0
+        self._exit_times = []
+        self._crash_loop = False
+
+    @classmethod
+    def from_settings(cls, settings, **defaults):
+        merged = dict(defaults)
+        for key in cls.Defaults:
+            if settings and key in settings:
+                merged[key] = settings[key]
+        return cls(**merged)
+
+    def in_crash_loop(self):
+        return self._crash_loop
+
+    def failures(self):
+        return self._failures
+
+    def _jitter(self, delay):
+        if delay <= 0 or self._Jitter <= 0:
+            return delay
+        return max(0.0, delay * (1 + random.uniform(-self._Jitter, self._Jitter)))
+
+    def next_delay(self, uptime, now=None):
+        """
+        Record an exit after the child ran for 'uptime' seconds and return
+        the number of seconds to wait before restarting it.
+        """
+        if now is None:
+            now = time.time()
+        if uptime >= self._StableUptime:
+            self._failures = 0
+            self._exit_times = []
+            self._crash_loop = False
+        self._failures += 1
+        self._exit_times = [t for t in self._exit_times if now - t < self._CrashLoopWindow]
+        self._exit_times.append(now)
+        if len(self._exit_times) >= self._CrashLoopThreshold:
+            self._crash_loop = True
+        if self._crash_loop:
+            return self._jitter(self._CrashLoopDelay)
+        if self._failures == 1:
+            return self._InitialDelay
+        # The exponent is capped so the delay can't overflow, MaxDelay bounds it anyway
+        delay = self._BaseDelay * (self._Multiplier ** min(self._failures - 2, 32))
+        return self._jitter(min(delay, self._MaxDelay))
+
+class Timer:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop:
+    """
+    A minimal select() based loop with timers, readers, writers and SIGCHLD
+    delivery. It has to run in the main thread because it uses
+    signal.set_wakeup_fd().
+    """
+    def __init__(self, log):
+        self._log = log
+        self._timers = []
+        self._seq = 0
+        self._readers = {}
+        self._writers = {}
+        self._stopping = False
+        self._child_handlers = []
+        self._signal_handlers = {}
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._pending_signals = set()
+
+    def call_later(self, delay, callback):
+        timer = Timer(time.time() + max(0, delay), callback)
+        self._seq += 1
+        heapq.heappush(self._timers, (timer.when, self._seq, timer))
+        return timer
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+    def on_child_exit(self, callback):
+        self._child_handlers.append(callback)
+
+    def on_signal(self, signum, callback):
+        self._signal_handlers[signum] = callback
+
+    def stop(self):
+        self._stopping = True
+
+    def _handle_signal(self, signum, frame):
+        # The wakeup fd interrupts select(), the work happens in the loop
+        self._pending_signals.add(signum)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 512):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                timer.callback()
+
+    def _dispatch_signals(self):
+        signals, self._pending_signals = self._pending_signals, set()
+        for signum in signals:
+            if signum == signal.SIGCHLD:
+                for callback in self._child_handlers:
+                    callback()
+            elif signum in self._signal_handlers:
+                self._signal_handlers[signum]()
+
+    def run(self):
+        signal.set_wakeup_fd(self._wakeup_w)
+        signal.signal(signal.SIGCHLD, self._handle_signal)
+        for signum in self._signal_handlers:
+            signal.signal(signum, self._handle_signal)
+        # Children may have exited before the handler was installed
+        self._pending_signals.add(signal.SIGCHLD)
+        while not self._stopping:
+            timeout = None
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.time())
+            if self._pending_signals:
+                timeout = 0
+            fds = [self._wakeup_r] + list(self._readers.keys())
+            try:
+                readable, writable = select.select(fds, list(self._writers.keys()), [], timeout)[0:2]
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable, writable = [], []
+            for fd in readable:
+                if fd == self._wakeup_r:
+                    self._drain_wakeup()
+                elif fd in self._readers:
+                    self._readers[fd]()
+            for fd in writable:
+                if fd in self._writers:
+                    self._writers[fd]()
+            self._dispatch_signals()
+            self._run_timers()
+
+class Service:
+    """
+    A supervised child. args is executed directly, without a shell, so
+    signals sent to the service reach the real process.
+    """
+    def __init__(self, name, args, work_dir, stdout_file, stderr_file, policy, liveness_probe=None,
+                 readiness_probe=None, ready_timeout=60, cgroup=None, placement=None, env=None):
+        self.name = name
+        self.args = args
+        self.work_dir = work_dir
+        self.stdout_file = stdout_file
+        self.stderr_file = stderr_file
+        self.policy = policy
+        self.liveness_probe = liveness_probe
+        self.liveness = None
+        self.readiness_probe = readiness_probe
+        self.ready_timeout = ready_timeout
+        self.readiness = None
+        self.cgroup = cgroup
+        self.placement = placement
+        self.env = env
+        self.stdout_log = None
+        self.stderr_log = None
+        self.stdout_tail = None
+        self.stderr_tail = None
+        self.pipes = {}
+        self.kill_reason = None
+        self.process = None
+        self.start_time = None
+        self.state = 'stopped'
+        # The status last reported for the service
+        self.status = None
+
+class Supervisor:
+    # Seconds a child without a readiness probe must stay up before it counts as started
+    StartupCheckInSeconds = 1
+
+    # Bytes read from a child's pipe at a time
+    ReadChunkSize = 64 * 1024
+    # Output kept in memory per pipe, and the part of it put in status reports
+    TailBytes = 16 * 1024
+    ReportTailLines = 20
+    ReportTailBytes = 2048
+    MaxSnapshots = 20
+    UsageReportIntervalInSeconds = 300
+    # Seconds stop() waits for the services to exit after SIGTERM before it kills them
+    StopTimeoutInSeconds = 10
+
+    def __init__(self, log, report, open_log=None, snapshot_dir=None):
+        """
+        report(name, operation, status, code, message) publishes the status
+        of the service 'name', e.g. StatusReporter.update. open_log(path)
+        returns an object with write(data) and close() for a service's
+        stdout_file or stderr_file, by default the file opened for appending.
+        Exit snapshots are written to snapshot_dir when it is set.
+        """
+        self._log = log
+        self._report = report
+        self._open_log = open_log or self._open_output
+        self._snapshot_dir = snapshot_dir
+        self._services = []
+        # Other children of the daemon, only waited for so they don't linger as zombies
+        self._watched = []
+        self._ready_callbacks = []
+        self._failure_callbacks = []
+        # Set once every service has started for the first time, or one failed before that
+        self._startup_done = False
+        self.loop = EventLoop(log)
+        self.loop.on_child_exit(self._reap)
+        self.loop.on_signal(signal.SIGTERM, self.stop)
+        self.loop.on_signal(signal.SIGINT, self.stop)
+
+    def add(self, service):
+        if service.liveness_probe is not None:
+            service.liveness = LivenessMonitor(self.loop, service.liveness_probe, self._log,
+                                               lambda detail: self.kill(service, 'liveness probe failed: ' + detail))
+        if service.readiness_probe is not None:
+            service.readiness = ReadinessMonitor(self.loop, service.readiness_probe, service.ready_timeout,
+                                                 lambda: self._started(service),
+                                                 lambda detail: self._ready_timeout(service, detail))
+        service.stdout_log = self._open_log(service.stdout_file)
+        service.stderr_log = self._open_log(service.stderr_file)
+        service.stdout_tail = TailBuffer(self.TailBytes)
+        service.stderr_tail = TailBuffer(self.TailBytes)
+        self._services.append(service)
+
+    def on_ready(self, callback):
+        """
+        Call callback() once, when all services have started for the first time.
+        """
+        self._ready_callbacks.append(callback)
+
+    def on_failure(self, callback):
+        """
+        Call callback(detail) once, when a service exits or misses its
+        ready_timeout before all services have started for the first time.
+        """
+        self._failure_callbacks.append(callback)
+
+    def _startup_failed(self, service, detail):
+        if self._startup_done:
+            return
+        self._startup_done = True
+        for callback in self._failure_callbacks:
+            callback('{0}: {1}'.format(service.name, detail))
+
+    def services(self):
+        return list(self._services)
+
+    def watch(self, process):
+        """
+        Wait for a Popen started outside the supervisor when it exits, it is
+        not restarted.
+        """
+        self._watched.append(process)
+
+    def _open_output(self, path):
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return open(path, 'ab', 0)
+
+    def _publish(self, service, operation, status, code, message):
+        service.status = status
+        self._report(service.name, operation, status, code, message)
+
+    def _child_setup(self, service):
+        """
+        The preexec_fn of a service: the child joins its cgroup before exec,
+        so nothing it forks or allocates is left outside the limits.
+        """
+        if service.cgroup is None and service.placement is None:
+            return None
+        def setup():
+            if service.cgroup is not None:
+                service.cgroup.join()
+            if service.placement is not None:
+                service.placement.child_setup()
+        return setup
+
+    def start(self, service):
+        self._close_pipes(service)
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        try:
+            with open(os.devnull, 'r') as infile:
+                preexec_fn = self._child_setup(service)
+                service.process = subprocess.Popen(service.args, stdin=infile, stdout=out_w, stderr=err_w, cwd=service.work_dir, close_fds=True,
+                                                   preexec_fn=preexec_fn, env=service.env)
+        except (OSError, IOError, SubprocessError) as e:
+            os.close(out_r)
+            os.close(err_r)
+            service.process = None
+            msg = 'Failed to start process {0}: {1}'.format(service.args, e)
+            self._publish(service, 'Enable', 'error', 1, msg)
+            self._on_exit(service, 1, msg, 0)
+            return
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+        if service.cgroup is not None and not service.cgroup.contains(service.process.pid):
+            self._log("{0} pid {1} did not join {2} before exec, moving it now".format(
+                service.name, service.process.pid, service.cgroup.describe()))
+            try:
+                service.cgroup.attach(service.process.pid)
+            except (IOError, OSError) as e:
+                self._log("Failed to move {0} pid {1} into {2}: {3}".format(
+                    service.name, service.process.pid, service.cgroup.describe(), e))
+        for fd, output, tail in ((out_r, service.stdout_log, service.stdout_tail), (err_r, service.stderr_log, service.stderr_tail)):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            tail.clear()
+            service.pipes[fd] = (output, tail)
+            self.loop.add_reader(fd, lambda fd=fd: self._read_output(service, fd))
+        service.start_time = time.time()
+        service.state = 'starting'
+        self._log('process {0} started {1} pid {2}{3}'.format(service.name, service.args, service.process.pid,
+                  ' on ' + service.placement.describe() if service.placement is not None else ''))
+        if service.readiness is not None:
+            service.readiness.start(service.start_time)
+        else:
+            process = service.process
+            self.loop.call_later(self.StartupCheckInSeconds, lambda: self._check_started(service, process))
+
+    def _check_started(self, service, process):
+        if service.process is process and process.returncode is None:
+            self._started(service)
+
+    def _ready_timeout(self, service, detail):
+        msg = "{0} not ready after {1:g} seconds: {2}".format(service.args, service.ready_timeout, detail)
+        self._publish(service, 'Enable', 'warning', 0, msg)
+        self._startup_failed(service, msg)
+        self._started(service, report=False)
+
+    def _started(self, service, report=True):
+        if service.state != 'starting':
+            return
+        service.state = 'running'
+        self._log('process {0} is ready after {1:.2f} seconds'.format(service.name, time.time() - service.start_time))
+        if report:
+            self._publish(service, 'Enable', 'success', 0, "")
+        if service.liveness is not None:
+            service.liveness.start()
+        if not self._startup_done and all(s.state == 'running' for s in self._services):
+            self._startup_done = True
+            for callback in self._ready_callbacks:
+                callback()
+
+    def _read_output(self, service, fd, drain=False):
+        """
+        Copy what the child wrote to the pipe into its log. Only one chunk is
+        read per call unless drain is set, so one chatty child can't starve
+        the loop.
+        """
+        while fd in service.pipes:
+            try:
+                data = os.read(fd, self.ReadChunkSize)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            if not data:
+                self._close_pipe(service, fd)
+                return
+            output, tail = service.pipes[fd]
+            tail.write(data)
+            try:
+                output.write(data)
+            except (IOError, OSError) as e:
+                self._log("Failed to write output of {0}: {1}".format(service.name, e))
+            if not drain:
+                return
+
+    def _close_pipe(self, service, fd):
+        self.loop.remove_reader(fd)
+        service.pipes.pop(fd, None)
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+    def _close_pipes(self, service):
+        for fd in list(service.pipes):
+            self._close_pipe(service, fd)
+
+    def kill(self, service, reason):
+        """
+        Kill a hung service, it is restarted like any other exit.
+        """
+        process = service.process
+        if process is None or process.returncode is not None:
+            return
+        self._log("Kill {0} pid {1}: {2}".format(service.name, process.pid, reason))
+        service.kill_reason = reason
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    def _reap(self):
+        for process in list(self._watched):
+            if process.poll() is not None:
+                self._watched.remove(process)
+                self._log("pid {0} exited with {1}".format(process.pid, process.returncode))
+        for service in self._services:
+            process = service.process
+            if process is None or process.returncode is not None:
+                continue
+            if process.poll() is not None:
+                code = process.returncode
+                # Whatever the child wrote last is still in the pipes
+                for fd in list(service.pipes):
+                    self._read_output(service, fd, drain=True)
+                for monitor in (service.liveness, service.readiness):
+                    if monitor is not None:
+                        monitor.stop()
+                if service.kill_reason:
+                    status, msg = 'error', "{0} process killed, {1}".format(service.args, service.kill_reason)
+                    service.kill_reason = None
+                elif service.state == 'running':
+                    status, msg = 'warning', "process exits: {0} {1}".format(service.args, code)
+                else:
+                    status, msg = 'error', "{0} process crashes: {1}".format(service.args, code)
+                if service.state != 'stopping':
+                    self._publish(service, 'Enable', status, code, msg + self._report_tail(service))
+                self._on_exit(service, code, msg, time.time() - service.start_time, snapshot=True)
+
+    def _report_tail(self, service):
+        """
+        The last lines of stderr, or of stdout when stderr is empty, for a
+        status message.
+        """
+        for name, tail in (('stderr', service.stderr_tail), ('stdout', service.stdout_tail)):
+            lines = tail.lines(self.ReportTailLines)
+            if lines:
+                text = '\n'.join(lines)[-self.ReportTailBytes:]
+                return "\nLast {0} output:\n{1}".format(name, text)
+        return ""
+
+    def _write_snapshot(self, service, code, msg, delay):
+        """
+        Written after the exit is recorded in the restart policy, so it has
+        the failure count including this exit and the planned delay.
+        """
+        if not self._snapshot_dir:
+            return
+        now = time.time()
+        path = os.path.join(self._snapshot_dir, '{0}-{1}-{2}.crash'.format(
+            service.name, time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)), service.process.pid))
+        try:
+            if not os.path.isdir(self._snapshot_dir):
+                os.makedirs(self._snapshot_dir)
+            content = "{0}\ntime: {1}\nexit code: {2}\nuptime: {3:.1f} seconds\nrecent failures: {4}\nrestart in: {5:.1f} seconds{6}\n".format(
+                msg, time.strftime(DateTimeFormat, time.gmtime(now)), code, now - service.start_time, service.policy.failures(),
+                delay, ' (crash loop)' if service.policy.in_crash_loop() else '')
+            if service.cgroup is not None:
+                content += "resource usage: {0}\n".format(format_usage(service.cgroup.usage()))
+            for name, tail in (('stdout', service.stdout_tail), ('stderr', service.stderr_tail)):
+                content += "\n--- last {0} ---\n".format(name)
+                content += ''.join(line + '\n' for line in tail.lines())
+            with open(path, 'wb') as F:
+                F.write(content.encode('utf-8'))
+            self._log("Wrote exit snapshot {0}".format(path))
+            self._prune_snapshots(service.name)
+        except (IOError, OSError) as e:
+            self._log("Failed to write exit snapshot {0}: {1}".format(path, e))
+
+    def _prune_snapshots(self, name):
+        # The timestamp in the names sorts them oldest first
+        snapshots = sorted(f for f in os.listdir(self._snapshot_dir) if f.startswith(name + '-') and f.endswith('.crash'))
+        for f in snapshots[:-self.MaxSnapshots]:
+            os.remove(os.path.join(self._snapshot_dir, f))
+
+    def _report_usage(self):
+        """
+        Put the cgroup usage of the running services in their status, unless
+        the status carries a warning or an error.
+        """
+        for service in self._services:
+            if service.cgroup is None or service.state != 'running':
+                continue
+            usage = format_usage(service.cgroup.usage())
+            self._log("Usage of {0}: {1}".format(service.name, usage))
+            if service.status == 'success':
+                self._publish(service, 'Enable', 'success', 0, "Resource usage: " + usage)
+        self.loop.call_later(self.UsageReportIntervalInSeconds, self._report_usage)
+
+    def _on_exit(self, service, code, msg, uptime, snapshot=False):
+        self._log(msg)
+        if service.state == 'stopping':
+            service.state = 'stopped'
+            return
+        self._startup_failed(service, msg)
+        delay = service.policy.next_delay(uptime)
+        if snapshot:
+            self._write_snapshot(service, code, msg, delay)
+        if service.policy.in_crash_loop():
+            service.state = 'crashloop'
+            loop_msg = "{0} is in a crash loop after {1} restarts, restarting every {2:.0f} seconds. Last exit: {3}".format(
+                service.args, service.policy.failures(), delay, msg)
+            self._publish(service, 'Enable', 'error', code, loop_msg)
+        else:
+            service.state = 'backoff'
+        self._log("Restart process {0} after {1:.1f} seconds".format(service.args, delay))
+        self.loop.call_later(delay, lambda: self._restart(service))
+
+    def _restart(self, service):
+        if service.state in ('backoff', 'crashloop'):
+            self.start(service)
+
+    def stop(self):
+        """
+        Terminate the services and wait up to StopTimeoutInSeconds for them to
+        exit, the ones still running then are killed.
+        """
+        self._log("Stopping supervised processes")
+        stopping = []
+        for service in self._services:
+            if service.process is not None and service.process.returncode is None:
+                service.state = 'stopping'
+                try:
+                    service.process.terminate()
+                except OSError:
+                    pass
+                stopping.append(service)
+            else:
+                service.state = 'stopped'
+        deadline = time.time() + self.StopTimeoutInSeconds
+        while time.time() < deadline and any(s.process.poll() is None for s in stopping):
+            time.sleep(0.1)
+        for service in stopping:
+            if service.process.poll() is None:
+                self._log("Kill {0} pid {1}, it did not exit after {2} seconds".format(
+                    service.name, service.process.pid, self.StopTimeoutInSeconds))
+                try:
+                    service.process.kill()
+                except OSError:
+                    pass
+                service.process.wait()
+            service.state = 'stopped'
+        self.loop.stop()
+
+    def run(self):
+        for service in self._services:
+            self.start(service)
+        if any(service.cgroup is not None for service in self._services):
+            self.loop.call_later(self.UsageReportIntervalInSeconds, self._report_usage)
+        try:
+            self.loop.run()
+        finally:
+            for service in self._services:
+                for fd in list(service.pipes):
+                    self._read_output(service, fd, drain=True)
+                self._close_pipes(service)
+                for output in (service.stdout_log, service.stderr_log):
+                    if output is not None:
+                        output.close()
@@ -0,0 +1,212 @@
+#
+# Incremental payload synchronization
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Installs a payload directory into a destination tree, writing only the
+files whose content changed.
+
+Every installed tree carries a manifest (ManifestName) recording the
+sha256, size, mtime and mode of each file. On the next sync:
+  * a source file whose size and mtime match the manifest reuses the
+    recorded hash instead of being read again;
+  * a file whose hash and mode match the installed copy is hard linked
+    from the installed tree into the new one, no data is written;
+  * other files are reflinked when the filesystem supports it, otherwise
+    copied.
+The new tree is built next to the destination and swapped in with one
+rename (RENAME_EXCHANGE when available), so the destination is never
+half-written. Entries listed in 'preserve' (e.g. logs) are moved over from
+the old tree before the swap.
+"""
+
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+
+ManifestName = '.payload-manifest.json'
+ManifestVersion = 1
+FICLONE = 0x40049409
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as F:
+        while True:
+            chunk = F.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(root):
+    try:
+        with open(os.path.join(root, ManifestName), 'r') as F:
+            manifest = json.load(F)
+        if manifest.get('version') == ManifestVersion:
+            return manifest
+    except (IOError, OSError, ValueError):
+        pass
+    return {'version': ManifestVersion, 'files': {}, 'links': {}, 'dirs': []}
+
+def build_manifest(src_dir, previous=None, executable_dirs=()):
+    """
+    Describe the source tree. Hashes from the previous manifest are reused
+    for files whose size and mtime did not change. Files directly under one
+    of executable_dirs (relative paths, '.' for the top level) get the
+    executable bits added to their mode.
+    """
+    old_files = (previous or {}).get('files', {})
+    manifest = {'version': ManifestVersion, 'files': {}, 'links': {}, 'dirs': []}
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        reldir = os.path.relpath(dirpath, src_dir)
+        for dirname in list(dirnames):
+            path = os.path.join(dirpath, dirname)
+            relpath = os.path.normpath(os.path.join(reldir, dirname))
+            if os.path.islink(path):
+                manifest['links'][relpath] = os.readlink(path)
+                dirnames.remove(dirname)
+            else:
+                manifest['dirs'].append(relpath)
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.normpath(os.path.join(reldir, filename))
+            if relpath == ManifestName:
+                continue
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                manifest['links'][relpath] = os.readlink(path)
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            mode = stat.S_IMODE(st.st_mode)
+            if reldir in executable_dirs:
+                mode |= 0o111
+            old = old_files.get(relpath)
+            if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+                digest = old['sha256']
+            else:
+                digest = _file_hash(path)
+            manifest['files'][relpath] = {'sha256': digest, 'size': st.st_size, 'mtime': st.st_mtime, 'mode': mode}
+    return manifest
+
+def _reflink_or_copy(src, dest):
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (IOError, OSError):
+            pass
+        shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
+
+def _exchange(path1, path2):
+    """
+    Atomically swap two paths with renameat2(RENAME_EXCHANGE). Return False
+    when the C library or the filesystem does not support it.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is None:
+        return False
+    path1 = path1.encode('utf-8') if not isinstance(path1, bytes) else path1
+    path2 = path2.encode('utf-8') if not isinstance(path2, bytes) else path2
+    if renameat2(AT_FDCWD, ctypes.c_char_p(path1), AT_FDCWD, ctypes.c_char_p(path2), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(err, os.strerror(err), path1)
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def sync_tree(src_dir, dest_dir, preserve=(), executable_dirs=(), remove_old=_remove):
+    """
+    Make dest_dir a copy of src_dir and return a dict of statistics.
+    remove_old is called with the path of the replaced tree.
+    """
+    dest_dir = os.path.normpath(dest_dir)
+    staging = dest_dir + '.sync'
+    old_tree = dest_dir + '.old'
+    for leftover in (staging, old_tree):
+        _remove(leftover)
+
+    installed = load_manifest(dest_dir)
+    manifest = build_manifest(src_dir, installed, executable_dirs)
+    stats = {'copied': 0, 'linked': 0, 'bytes_copied': 0, 'bytes_linked': 0}
+
+    os.makedirs(staging)
+    for relpath in sorted(manifest['dirs']):
+        os.mkdir(os.path.join(staging, relpath))
+    for relpath, target in manifest['links'].items():
+        os.symlink(target, os.path.join(staging, relpath))
+    for relpath, entry in manifest['files'].items():
+        src = os.path.join(src_dir, relpath)
+        dest = os.path.join(dest_dir, relpath)
+        new = os.path.join(staging, relpath)
+        old = installed['files'].get(relpath)
+        if old and old['sha256'] == entry['sha256'] and old['mode'] == entry['mode']:
+            try:
+                st = os.lstat(dest)
+                if stat.S_ISREG(st.st_mode) and st.st_size == old['size'] and st.st_mtime == old['mtime']:
+                    os.link(dest, new)
+                    if st.st_mtime != entry['mtime']:
+                        os.utime(new, (entry['mtime'], entry['mtime']))
+                    stats['linked'] += 1
+                    stats['bytes_linked'] += entry['size']
+                    continue
+            except OSError:
+                pass
+        _reflink_or_copy(src, new)
+        os.chmod(new, entry['mode'])
+        os.utime(new, (entry['mtime'], entry['mtime']))
+        stats['copied'] += 1
+        stats['bytes_copied'] += entry['size']
+    for relpath in manifest['dirs']:
+        src_mode = stat.S_IMODE(os.stat(os.path.join(src_dir, relpath)).st_mode)
+        os.chmod(os.path.join(staging, relpath), src_mode)
+    os.chmod(staging, stat.S_IMODE(os.stat(src_dir).st_mode))
+    with open(os.path.join(staging, ManifestName), 'w') as F:
+        json.dump(manifest, F)
+
+    if os.path.isdir(dest_dir):
+        for name in preserve:
+            path = os.path.join(dest_dir, name)
+            if os.path.lexists(path) and not os.path.lexists(os.path.join(staging, name)):
+                os.rename(path, os.path.join(staging, name))
+        if _exchange(staging, dest_dir):
+            os.rename(staging, old_tree)
+        else:
+            os.rename(dest_dir, old_tree)
+            os.rename(staging, dest_dir)
+        remove_old(old_tree)
+    else:
+        os.rename(staging, dest_dir)
+    return stats
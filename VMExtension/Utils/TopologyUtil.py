@@ -0,0 +1,281 @@
+#
+# CPU and NUMA topology, and placement of processes on it
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Topology is read from /sys/devices/system/cpu and /sys/devices/system/node:
+the online CPUs, the NUMA node of each, and the hyperthreads sharing a
+physical core.
+
+A Placement binds a process to a set of CPUs and, with the "bind" memory
+policy, its memory to the NUMA nodes of those CPUs. It is applied by the
+process to itself, sched_setaffinity and set_mempolicy are inherited across
+fork and exec, so the supervisor applies it in every child it starts, e.g.
+
+"Placement": {"CoresPerNode": 1, "MemoryPolicy": "bind"}
+
+reserves the last physical core of each NUMA node for the agent services
+(housekeeping cores) and leaves the others to the jobs. "Cpus": "0-1,64"
+gives the CPUs explicitly instead.
+
+shard_placements() spreads the instances of a sharded service over the NUMA
+nodes, each bound to the CPUs and the memory of its node.
+"""
+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import re
+
+SysRoot = '/sys/devices/system'
+MemoryPolicies = ('bind', 'none')
+# set_mempolicy is not wrapped by glibc, see <asm/unistd.h>
+SetMempolicySyscalls = {'x86_64': 238, 'aarch64': 237, 'i386': 276, 'i686': 276}
+MPOL_BIND = 2
+
+def parse_cpulist(text):
+    """
+    "0-3,8,10-11" to [0, 1, 2, 3, 8, 10, 11].
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{0}-{1}'.format(a, b) for a, b in ranges)
+
+def _read(path):
+    try:
+        with open(path, 'r') as F:
+            return F.read()
+    except (IOError, OSError):
+        return None
+
+class Topology:
+    def __init__(self, nodes, siblings):
+        """
+        nodes maps a NUMA node to its online CPUs, siblings maps a CPU to
+        the CPUs of its physical core.
+        """
+        self.nodes = nodes
+        self.siblings = siblings
+
+    @classmethod
+    def read(cls, root=None):
+        root = root or SysRoot
+        online = parse_cpulist(_read(os.path.join(root, 'cpu', 'online')) or '0')
+        nodes = {}
+        node_dir = os.path.join(root, 'node')
+        names = os.listdir(node_dir) if os.path.isdir(node_dir) else []
+        for name in names:
+            match = re.match(r'^node(\d+)$', name)
+            cpulist = _read(os.path.join(node_dir, name, 'cpulist')) if match else None
+            cpus = [cpu for cpu in parse_cpulist(cpulist or '') if cpu in online]
+            if cpus:
+                nodes[int(match.group(1))] = cpus
+        if not nodes:
+            # A kernel without NUMA support has no node directories
+            nodes[0] = online
+        siblings = {}
+        for cpu in online:
+            topology = os.path.join(root, 'cpu', 'cpu{0}'.format(cpu), 'topology')
+            text = _read(os.path.join(topology, 'core_cpus_list')) or _read(os.path.join(topology, 'thread_siblings_list'))
+            siblings[cpu] = [c for c in parse_cpulist(text or str(cpu)) if c in online]
+        return cls(nodes, siblings)
+
+    def cpus(self):
+        return sorted(cpu for cpus in self.nodes.values() for cpu in cpus)
+
+    def node_of(self, cpu):
+        for node, cpus in self.nodes.items():
+            if cpu in cpus:
+                return node
+        return None
+
+    def cores(self, node):
+        """
+        The physical cores of node, each a list of its CPUs, in CPU order.
+        """
+        cores = []
+        seen = set()
+        for cpu in self.nodes[node]:
+            if cpu in seen:
+                continue
+            core = [c for c in self.siblings.get(cpu, [cpu]) if c in self.nodes[node]] or [cpu]
+            seen.update(core)
+            cores.append(core)
+        return cores
+
+    def housekeeping(self, node, cores_per_node=1):
+        """
+        The CPUs of the last cores_per_node physical cores of node.
+        """
+        return sorted(cpu for core in self.cores(node)[-cores_per_node:] for cpu in core)
+
+class Placement:
+    def __init__(self, cpus, mem_nodes=None):
+        """
+        Run on cpus, and allocate memory only on mem_nodes unless it is None.
+        """
+        self.cpus = sorted(cpus)
+        self.mem_nodes = sorted(mem_nodes) if mem_nodes else None
+
+    def describe(self):
+        desc = 'cpus {0}'.format(format_cpulist(self.cpus))
+        if self.mem_nodes:
+            desc += ', memory on nodes {0}'.format(format_cpulist(self.mem_nodes))
+        return desc
+
+    def apply_to_self(self):
+        set_affinity(self.cpus)
+        if self.mem_nodes:
+            bind_memory(self.mem_nodes)
+
+    def check(self):
+        """
+        Apply the placement in a forked process and raise the OSError it
+        fails with there. libc is loaded here, find_library() runs ldconfig,
+        which must not happen in a preexec_fn.
+        """
+        if self.mem_nodes or not hasattr(os, 'sched_setaffinity'):
+            _get_libc()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.apply_to_self()
+            except OSError as e:
+                code = e.errno or 255
+            except Exception:
+                code = 255
+            os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 255
+        if code:
+            raise OSError(code, "placing on {0} failed: {1}".format(self.describe(), os.strerror(code)))
+
+    def child_setup(self):
+        """
+        For subprocess preexec_fn: the child can't report a failure, so the
+        placement must have been tried in the parent first, with check() or
+        apply_to_self().
+        """
+        try:
+            self.apply_to_self()
+        except Exception:
+            pass
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+def _mask(bits):
+    word_bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    words = (ctypes.c_ulong * (max(bits) // word_bits + 1))()
+    for bit in bits:
+        words[bit // word_bits] |= 1 << (bit % word_bits)
+    return words, len(words) * word_bits
+
+def set_affinity(cpus):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return
+    mask, _ = _mask(cpus)
+    if _get_libc().sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+
+def bind_memory(nodes):
+    syscall = SetMempolicySyscalls.get(platform.machine())
+    if syscall is None:
+        raise OSError(errno.ENOSYS, "set_mempolicy is not known on {0}".format(platform.machine()))
+    mask, bits = _mask(nodes)
+    # The kernel reads maxnode - 1 bits of the mask
+    if _get_libc().syscall(syscall, MPOL_BIND, ctypes.byref(mask), ctypes.c_ulong(bits + 1)) != 0:
+        raise OSError(ctypes.get_errno(), "set_mempolicy failed")
+
+def placement_from_settings(settings, topology):
+    """
+    The Placement for publicSettings 'Placement', or None when it is not set
+    or disabled with "Enabled": false. Raises ValueError for CPUs that are
+    not online.
+    """
+    if not settings or not settings.get('Enabled', True):
+        return None
+    memory_policy = settings.get('MemoryPolicy', 'bind')
+    if memory_policy not in MemoryPolicies:
+        raise ValueError("MemoryPolicy must be one of {0}".format(', '.join(MemoryPolicies)))
+    explicit = settings.get('Cpus')
+    if explicit is not None:
+        cpus = parse_cpulist(explicit) if not isinstance(explicit, list) else sorted(set(int(c) for c in explicit))
+        offline = [cpu for cpu in cpus if topology.node_of(cpu) is None]
+        if offline or not cpus:
+            raise ValueError("CPUs {0} are not online".format(format_cpulist(offline) or explicit))
+    else:
+        cores_per_node = int(settings.get('CoresPerNode', 1))
+        cpus = [cpu for node in sorted(topology.nodes) for cpu in topology.housekeeping(node, cores_per_node)]
+    mem_nodes = set(topology.node_of(cpu) for cpu in cpus)
+    # Binding to every node would change nothing
+    if memory_policy == 'none' or mem_nodes == set(topology.nodes):
+        mem_nodes = None
+    return Placement(cpus, mem_nodes)
+
+def shard_placements(topology, shards, housekeeping=None):
+    """
+    (node, Placement) for each instance of a sharded service. shards is
+    'numa' for one instance per NUMA node, or a count of instances given to
+    the nodes round robin. An instance runs on the CPUs of its node, only on
+    the housekeeping ones when a housekeeping Placement is given, and its
+    memory is bound to the node on a machine with several of them.
+    """
+    nodes = sorted(topology.nodes)
+    count = len(nodes) if shards == 'numa' else int(shards)
+    if count < 1:
+        raise ValueError("Shards must be 'numa' or a positive count")
+    placements = []
+    for index in range(count):
+        node = nodes[index % len(nodes)]
+        cpus = topology.nodes[node]
+        mem_nodes = [node] if len(nodes) > 1 else None
+        if housekeeping is not None:
+            cpus = [cpu for cpu in housekeeping.cpus if cpu in cpus]
+            if not cpus:
+                # No housekeeping CPU on this node, keep off the others anyway
+                cpus, mem_nodes = housekeeping.cpus, housekeeping.mem_nodes
+        placements.append((node, Placement(cpus, mem_nodes)))
+    return placements
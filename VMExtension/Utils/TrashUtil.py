@@ -0,0 +1,139 @@
+#
+# Deferred deletion of installed trees
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Removing a tree is split in two: move_to_trash() renames it into a trash
+directory on the same filesystem, which is a single metadata operation
+whatever the size of the tree, and reap() deletes the trash contents later
+in small batches with pauses in between so it does not compete with jobs
+for disk I/O.
+
+reap() only deletes what is left in the trash directory, so an interrupted
+reap resumes where it stopped the next time it runs. A lock file makes sure
+only one reaper works on a trash directory at a time.
+"""
+
+
+import errno
+import fcntl
+import os
+import shutil
+import time
+
+LockName = '.lock'
+
+def move_to_trash(path, trash_dir):
+    """
+    Rename path into trash_dir and return the new path. When the trash is on
+    another filesystem the path is removed synchronously and None is returned.
+    """
+    if not os.path.lexists(path):
+        return None
+    try:
+        os.makedirs(trash_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    base = '{0}.{1}.{2}'.format(os.path.basename(path.rstrip('/')), int(time.time() * 1000), os.getpid())
+    target = os.path.join(trash_dir, base)
+    suffix = 0
+    while os.path.lexists(target):
+        suffix += 1
+        target = os.path.join(trash_dir, '{0}.{1}'.format(base, suffix))
+    try:
+        os.rename(path, target)
+        return target
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return None
+
+def has_trash(trash_dir):
+    try:
+        return any(name != LockName for name in os.listdir(trash_dir))
+    except OSError:
+        return False
+
+def _throttled(entries, batch_size, pause):
+    count = 0
+    for entry in entries:
+        yield entry
+        count += 1
+        if count % batch_size == 0:
+            time.sleep(pause)
+
+def _walk_entries(path):
+    """
+    Yield ('file', path) and ('dir', path) pairs so that every directory
+    comes after its contents.
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        yield 'file', path
+        return
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for filename in filenames:
+            yield 'file', os.path.join(dirpath, filename)
+        for dirname in dirnames:
+            subdir = os.path.join(dirpath, dirname)
+            if os.path.islink(subdir):
+                yield 'file', subdir
+            else:
+                yield 'dir', subdir
+        yield 'dir', dirpath
+
+def reap(trash_dir, log, batch_size=200, pause=0.1):
+    """
+    Delete everything in trash_dir, pausing 'pause' seconds after every
+    batch_size removals. Return False if another reaper holds the lock.
+    """
+    if not os.path.isdir(trash_dir):
+        return True
+    lock = open(os.path.join(trash_dir, LockName), 'a')
+    try:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                log("Another reaper is working on {0}".format(trash_dir))
+                return False
+            raise
+        removed = 0
+        start = time.time()
+        for name in os.listdir(trash_dir):
+            if name == LockName:
+                continue
+            for kind, path in _throttled(_walk_entries(os.path.join(trash_dir, name)), batch_size, pause):
+                try:
+                    if kind == 'dir':
+                        os.rmdir(path)
+                    else:
+                        os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        log("Failed to remove {0}: {1}".format(path, e))
+        log("Reaped {0} entries from {1} in {2:.1f}s".format(removed, trash_dir, time.time() - start))
+        return True
+    finally:
+        lock.close()
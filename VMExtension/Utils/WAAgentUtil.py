@@ -21,9 +21,32 @@
 #
 
 
-import imp
+"""
+waagent is a script without a .py suffix, so Python never caches its
+bytecode and every handler command would compile thousands of lines again.
+The compiled code is kept in CacheDir instead, keyed on the script's path,
+mtime and size and the interpreter's bytecode magic.
+
+The module-level "waagent" is a proxy that only has the helpers this
+extension uses, the script is loaded when one of them is first used. When
+no waagent script exists, LocalAgent stands in with those helpers.
+"""
+
+
+import marshal
 import os
 import os.path
+import subprocess
+import sys
+import time
+import types
+
+CacheDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.waagent-cache')
+CacheVersion = 1
+# The attributes of waagent the proxy exposes
+Helpers = ('LoggerInit', 'Log', 'Error', 'Run', 'RunGetOutput', 'GetFileContents',
+           'SetFileContents', 'ReplaceFileContentsAtomic', 'LibDir',
+           'AddExtensionEvent', 'WALAEventOperation')
 
 #
 # The following code will search and load waagent code and expose
@@ -33,40 +56,190 @@ def searchWAAgent():
     agentPath = '/usr/sbin/waagent'
     if(os.path.isfile(agentPath)):
         return agentPath
-    user_paths = os.environ['PYTHONPATH'].split(os.pathsep)
+    user_paths = os.environ.get('PYTHONPATH', '').split(os.pathsep)
     for user_path in user_paths:
         agentPath = os.path.join(user_path, 'waagent')
         if(os.path.isfile(agentPath)):
             return agentPath
     return None
 
-waagent = None
-agentPath = searchWAAgent()
-if agentPath:
-    waagent = imp.load_source('waagent', agentPath)
-else:
-    raise Exception("Can't load waagent.")
+def _magic():
+    try:
+        from importlib.util import MAGIC_NUMBER
+        return MAGIC_NUMBER
+    except ImportError:
+        import imp
+        return imp.get_magic()
+
+def _cache_file(agentPath):
+    name = agentPath.strip('/').replace('/', '_')
+    return os.path.join(CacheDir, '{0}.py{1}{2}.cache'.format(name, sys.version_info[0], sys.version_info[1]))
 
-if not hasattr(waagent, "AddExtensionEvent"):
+def _compile(agentPath):
     """
-    If AddExtensionEvent is not defined, provide a dummy impl.
+    The code object of agentPath, from the cache when the script did not
+    change since it was compiled.
     """
-    def _AddExtensionEvent(*args, **kwargs):
+    st = os.stat(agentPath)
+    key = (CacheVersion, _magic(), agentPath, st.st_mtime, st.st_size)
+    cacheFile = _cache_file(agentPath)
+    try:
+        with open(cacheFile, 'rb') as F:
+            cached = marshal.load(F)
+        if cached[0] == key:
+            return cached[1]
+    except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
         pass
-    waagent.AddExtensionEvent = _AddExtensionEvent
-
-if not hasattr(waagent, "WALAEventOperation"):
-    class _WALAEventOperation:
-        HeartBeat="HeartBeat"
-        Provision = "Provision"
-        Install = "Install"
-        UnIsntall = "UnInstall"
-        Disable = "Disable"
-        Enable = "Enable"
-        Download = "Download"
-        Upgrade = "Upgrade"
-        Update = "Update"           
-    waagent.WALAEventOperation = _WALAEventOperation
+    with open(agentPath, 'rb') as F:
+        source = F.read()
+    code = compile(source, agentPath, 'exec')
+    try:
+        if not os.path.isdir(CacheDir):
+            os.makedirs(CacheDir)
+        tmp = '{0}.{1}.tmp'.format(cacheFile, os.getpid())
+        with open(tmp, 'wb') as F:
+            marshal.dump((key, code), F)
+        os.rename(tmp, cacheFile)
+    except (IOError, OSError):
+        pass
+    return code
+
+def load_waagent(agentPath):
+    """
+    Load the script as the module "waagent", the way imp.load_source did.
+    """
+    module = types.ModuleType('waagent')
+    module.__file__ = agentPath
+    sys.modules['waagent'] = module
+    try:
+        exec(_compile(agentPath), module.__dict__)
+    except:
+        del sys.modules['waagent']
+        raise
+    return module
+
+class LocalAgent:
+    """
+    The helpers of waagent used by the extension, for nodes without the
+    waagent script.
+    """
+    LibDir = '/var/lib/waagent'
+
+    def __init__(self):
+        self._log_file = None
+        self._console = None
+
+    def LoggerInit(self, log_file, con_file, verbose=False):
+        self._log_file = log_file
+        self._console = con_file
+
+    def _write(self, prefix, message):
+        line = '{0} {1}{2}\n'.format(time.strftime('%Y/%m/%d %H:%M:%S'), prefix, message)
+        for path in (self._log_file, self._console):
+            if path:
+                try:
+                    with open(path, 'a') as F:
+                        F.write(line)
+                except (IOError, OSError):
+                    pass
+
+    def Log(self, message):
+        self._write('', message)
+
+    def Error(self, message):
+        self._write('ERROR:', message)
+
+    def RunGetOutput(self, cmd, chk_err=True):
+        try:
+            output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+            rc = 0
+        except subprocess.CalledProcessError as e:
+            output, rc = e.output, e.returncode
+            if chk_err:
+                self.Error('CalledProcessError. Error Code is {0}'.format(rc))
+                self.Error('CalledProcessError. Command string was {0}'.format(cmd))
+        if not isinstance(output, str):
+            output = output.decode('latin-1')
+        return rc, output
+
+    def Run(self, cmd, chk_err=True):
+        return self.RunGetOutput(cmd, chk_err)[0]
+
+    def GetFileContents(self, filepath):
+        try:
+            with open(filepath, 'r') as F:
+                return F.read()
+        except (IOError, OSError) as e:
+            self.Error('Reading from file {0} Exception is {1}'.format(filepath, e))
+            return None
+
+    def SetFileContents(self, filepath, contents):
+        try:
+            with open(filepath, 'w') as F:
+                F.write(contents)
+        except (IOError, OSError) as e:
+            self.Error('Writing to file {0} Exception is {1}'.format(filepath, e))
+            return None
+        return 0
+
+    def ReplaceFileContentsAtomic(self, filepath, contents):
+        tmp = '{0}.{1}.tmp'.format(filepath, os.getpid())
+        if self.SetFileContents(tmp, contents) is None:
+            return None
+        os.rename(tmp, filepath)
+        return 0
+
+    def AddExtensionEvent(self, *args, **kwargs):
+        pass
+
+def _patch(agent):
+    if not hasattr(agent, "AddExtensionEvent"):
+        """
+        If AddExtensionEvent is not defined, provide a dummy impl.
+        """
+        def _AddExtensionEvent(*args, **kwargs):
+            pass
+        agent.AddExtensionEvent = _AddExtensionEvent
+
+    if not hasattr(agent, "WALAEventOperation"):
+        class _WALAEventOperation:
+            HeartBeat="HeartBeat"
+            Provision = "Provision"
+            Install = "Install"
+            UnIsntall = "UnInstall"
+            Disable = "Disable"
+            Enable = "Enable"
+            Download = "Download"
+            Upgrade = "Upgrade"
+            Update = "Update"
+        agent.WALAEventOperation = _WALAEventOperation
+    return agent
+
+_agent = None
+
+def get_waagent():
+    global _agent
+    if _agent is None:
+        agentPath = searchWAAgent()
+        if agentPath:
+            _agent = _patch(load_waagent(agentPath))
+        else:
+            _agent = _patch(LocalAgent())
+    return _agent
+
+class _WAAgentProxy:
+    """
+    The Helpers of waagent, it is loaded on the first attribute access.
+    """
+    def __getattr__(self, name):
+        if name in Helpers:
+            return getattr(get_waagent(), name)
+        raise AttributeError("waagent helper {0} is not exposed".format(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("waagent helpers are read-only")
+
+waagent = _WAAgentProxy()
 
 __ExtensionName__=None
 def InitExtensionEventLog(name):
@@ -74,9 +247,11 @@ def InitExtensionEventLog(name):
     __ExtensionName__ = name
 
 def AddExtensionEvent(name=__ExtensionName__,
-                      op=waagent.WALAEventOperation.Enable, 
+                      op=None,
                       isSuccess=False, 
                       message=None):
+    if op is None:
+        op = waagent.WALAEventOperation.Enable
     if name is not None:
         waagent.AddExtensionEvent(name=name,
                                   op=op,
@@ -0,0 +1,156 @@
+#
+# Offline installation of prebuilt wheels
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Picks a wheel shipped with the extension that matches the running
+interpreter and unpacks it into site-packages. No compiler, pip or network
+access is needed.
+
+Wheels are looked up in <wheel_dir>/<distro><major version>/ first and then
+in <wheel_dir>/, e.g. wheels/centos7/ and wheels/.
+"""
+
+
+import os
+import platform
+import re
+import shutil
+import sys
+import zipfile
+
+try:
+    import sysconfig
+except ImportError:
+    sysconfig = None
+
+def _glibc_version():
+    libc, version = platform.libc_ver()
+    if libc != 'glibc':
+        return None
+    m = re.match(r'^(\d+)\.(\d+)', version)
+    if not m:
+        return None
+    return int(m.group(1)), int(m.group(2))
+
+def supported_tags():
+    """
+    Return the set of (python, abi, platform) tags the running interpreter
+    can load, e.g. ('cp27', 'cp27mu', 'manylinux1_x86_64').
+    """
+    major, minor = sys.version_info[0], sys.version_info[1]
+    python_tag = 'cp{0}{1}'.format(major, minor)
+    if major == 2:
+        abis = ['cp27mu' if sys.maxunicode > 0xffff else 'cp27m']
+    elif minor < 8:
+        abis = ['cp{0}{1}m'.format(major, minor)]
+    else:
+        abis = ['cp{0}{1}'.format(major, minor)]
+    abis.append('none')
+
+    arch = platform.machine()
+    platforms = ['linux_' + arch]
+    glibc = _glibc_version()
+    if glibc and glibc[0] == 2:
+        for legacy, needed in (('manylinux1', 5), ('manylinux2010', 12), ('manylinux2014', 17)):
+            if glibc[1] >= needed:
+                platforms.append('{0}_{1}'.format(legacy, arch))
+        for glibc_minor in range(5, glibc[1] + 1):
+            platforms.append('manylinux_2_{0}_{1}'.format(glibc_minor, arch))
+
+    tags = set()
+    for abi in abis:
+        for plat in platforms + ['any']:
+            tags.add((python_tag, abi, plat))
+    if major == 3:
+        # abi3 wheels built for any earlier CPython 3.x also load here
+        for older_minor in range(2, minor + 1):
+            for plat in platforms:
+                tags.add(('cp3{0}'.format(older_minor), 'abi3', plat))
+    return tags
+
+def _wheel_tags(filename):
+    """
+    Expand the compressed tag sets in a wheel file name, e.g.
+    psutil-5.9.8-cp36-abi3-manylinux_2_12_x86_64.manylinux2010_x86_64.whl
+    """
+    parts = filename[:-len('.whl')].split('-')
+    if len(parts) < 5:
+        return set()
+    tags = set()
+    for python_tag in parts[-3].split('.'):
+        for abi in parts[-2].split('.'):
+            for plat in parts[-1].split('.'):
+                tags.add((python_tag, abi, plat))
+    return tags
+
+def find_wheel(wheel_dir, package, distro_name=None, distro_version=None):
+    search_dirs = []
+    if distro_name and distro_version:
+        search_dirs.append(os.path.join(wheel_dir, '{0}{1}'.format(distro_name, distro_version.split('.')[0])))
+    search_dirs.append(wheel_dir)
+    supported = supported_tags()
+    prefix = package.replace('-', '_') + '-'
+    for dirname in search_dirs:
+        if not os.path.isdir(dirname):
+            continue
+        # One version is shipped per directory; sort only to pick deterministically
+        for filename in sorted(os.listdir(dirname)):
+            if not filename.endswith('.whl') or not filename.startswith(prefix):
+                continue
+            if _wheel_tags(filename) & supported:
+                return os.path.join(dirname, filename)
+    return None
+
+def _site_packages():
+    if sysconfig is not None:
+        return sysconfig.get_paths()['platlib']
+    from distutils.sysconfig import get_python_lib
+    return get_python_lib(plat_specific=True)
+
+def install_wheel(wheel_path, target=None):
+    """
+    Unpack the wheel into site-packages. Files under <name>.data/purelib and
+    <name>.data/platlib are moved to the top level, other .data schemes are
+    not used by the wheels we ship and are ignored.
+    """
+    if not target:
+        target = _site_packages()
+    with zipfile.ZipFile(wheel_path) as whl:
+        for member in whl.namelist():
+            if member.endswith('/'):
+                continue
+            parts = member.split('/')
+            if parts[0].endswith('.data'):
+                if len(parts) < 3 or parts[1] not in ('purelib', 'platlib'):
+                    continue
+                parts = parts[2:]
+            if '..' in parts or os.path.isabs(member):
+                raise ValueError("unsafe path {0} in {1}".format(member, wheel_path))
+            destname = os.path.join(target, *parts)
+            dirname = os.path.dirname(destname)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmpname = destname + '.tmp'
+            with whl.open(member) as src, open(tmpname, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            if destname.endswith('.so'):
+                os.chmod(tmpname, 0o755)
+            os.rename(tmpname, destname)
+    return target
@@ -28,125 +28,275 @@ import time
 import traceback
 import socket
 import shutil
-import platform
-import struct
-import array
 import fcntl
-import threading
 import errno
+import select
 
 from Utils.WAAgentUtil import waagent
 import Utils.HandlerUtil as Util
+import Utils.CapabilityUtil as CapabilityUtil
+import Utils.CgroupUtil as CgroupUtil
+import Utils.HostsUtil as HostsUtil
+import Utils.HostsSyncUtil as HostsSyncUtil
+import Utils.LogUtil as LogUtil
+import Utils.NetUtil as NetUtil
+import Utils.PackageUtil as PackageUtil
+import Utils.PidUtil as PidUtil
+import Utils.ProbeUtil as ProbeUtil
+import Utils.StepUtil as StepUtil
+import Utils.SupervisorUtil as SupervisorUtil
+import Utils.SyncUtil as SyncUtil
+import Utils.TopologyUtil as TopologyUtil
+import Utils.TrashUtil as TrashUtil
+import Utils.WheelUtil as WheelUtil
 
 #Define global variables
 ExtensionShortName = 'HPCACMAgent'
+# The daemon holds an flock on its pid file while it runs, see Utils/PidUtil.py.
+# enable() and disable() serialize on DaemonPidFilePath + '.lock'
 DaemonPidFilePath = '/var/run/hpcacmdaemon.pid'
+DaemonStopTimeoutInSeconds = 10
 NMInstallRoot = '/opt/acmnodemanager'
 AgentInstallRoot = '/opt/NodeAgent'
+HostsFilePath = '/etc/hosts'
+# The daemon's netlink subscription, None in the handler commands
+NetMonitor = None
 DistroName = None
 DistroVersion = None
+# Probe results cached across handler invocations, see Utils/CapabilityUtil.py
+CapabilityCacheName = '.capabilities.json'
+NodeCaps = None
+# Entries of NMInstallRoot kept across uninstall and reinstall
+PreservedNames = ('logs', 'certs', 'filters', CapabilityCacheName)
+# publicSettings "NodeAgentInstances": {"Shards": "numa" or a count, "BasePort": ...,
+# "Args": [...], "Env": {...}} runs several NodeAgents, instance i in
+# AgentInstallRoot/instances/<i> with port BasePort + i, see _nodeagent_services()
+AgentInstancesDirName = 'instances'
+AgentPreservedNames = (AgentInstancesDirName,)
+NodeAgentBasePort = 40010
+# Removed trees are renamed here and deleted in the background by "-reap",
+# it must be on the same filesystem as NMInstallRoot and AgentInstallRoot
+TrashRoot = '/opt/.hpcacmtrash'
+ReapBatchSize = 200
+ReapPauseInSeconds = 0.1
+# Upper bound of the restart backoff, see RestartPolicy in Utils/SupervisorUtil.py
 RestartIntervalInSeconds = 60
+# Each service runs in the cgroup CgroupParentName/<name>, limited by
+# publicSettings "ResourceLimits", see Utils/CgroupUtil.py
+CgroupParentName = 'hpcacm'
+# enable() passes the daemon the write end of a pipe in this variable, the
+# daemon writes "ready" to it once all services are ready, or "failed: <detail>"
+# when one exits or misses its ReadyTimeout first
+ReadyFdEnv = 'HPCACM_READY_FD'
+EnableReadyTimeoutInSeconds = 60
+# The daemon's status is written behind, see StatusReporter in Utils/HandlerUtil.py.
+# publicSettings "StatusReport": {"Debounce": ..., "MinInterval": ..., "Fsync": ...} overrides these
+StatusDebounceInSeconds = 0.5
+StatusMinIntervalInSeconds = 2
+StatusFsyncPolicy = 'terminal'
+# Default ReadyTimeout of the readiness probes, shorter than the enable() wait
+# so a service that never gets ready is reported before enable() gives up
+ServiceReadyTimeoutInSeconds = 45
+InstallWorkers = 4
+# 'wheel' installs psutil from the bundled wheels and only builds it from source
+# when none matches, 'source' always builds it with gcc and pip
+PsutilInstallMode = 'wheel'
+PackageLockTimeoutInSeconds = 300
+# 'auto' installs OS packages from the repository bundled in ./packages when it
+# has metadata for this distro, 'local' only ever uses LocalPackageRepo (or the
+# bundled one) and 'online' always uses the distro's configured repositories
+PackageSource = 'auto'
+LocalPackageRepo = None
+PackageMgr = None
 
 def main():
     waagent.LoggerInit('/var/log/waagent.log','/dev/stdout')
     waagent.Log("%s started to handle." %(ExtensionShortName))
-    waagent.MyDistro = waagent.GetMyDistro()
-    global DistroName, DistroVersion
-    distro = platform.dist()
-    DistroName = distro[0].lower()
-    DistroVersion = distro[1]
-    for a in sys.argv[1:]:        
-        if re.match("^([-/]*)(disable)", a):
-            disable()
-        elif re.match("^([-/]*)(uninstall)", a):
-            uninstall()
-        elif re.match("^([-/]*)(install)", a):
-            install()
-        elif re.match("^([-/]*)(enable)", a):
-            enable()
-        elif re.match("^([-/]*)(daemon)", a):
-            daemon()            
-        elif re.match("^([-/]*)(update)", a):
-            update()
-
-def _is_nodemanager_daemon(pid):
-    retcode, output = waagent.RunGetOutput("ps -p {0} -o cmd=".format(pid))
-    if retcode == 0:
-        waagent.Log("The cmd for process {0} is {1}".format(pid, output))
-        pattern = r'(.*[/\s])?{0}\s+[-/]*daemon$'.format(os.path.basename(__file__))
-        if re.match(pattern, output):
+    global DistroName, DistroVersion, NodeCaps
+    NodeCaps = CapabilityUtil.NodeCapabilities(os.path.join(NMInstallRoot, CapabilityCacheName), waagent.Log)
+    DistroName, DistroVersion = NodeCaps.distro()
+    NodeCaps.save_if_changed()
+    try:
+        for a in sys.argv[1:]:
+            if re.match("^([-/]*)(disable)", a):
+                disable()
+            elif re.match("^([-/]*)(uninstall)", a):
+                uninstall()
+            elif re.match("^([-/]*)(install)", a):
+                install()
+            elif re.match("^([-/]*)(enable)", a):
+                enable()
+            elif re.match("^([-/]*)(daemon)", a):
+                daemon()
+            elif re.match("^([-/]*)(update)", a):
+                update()
+            elif re.match("^([-/]*)(reap)", a):
+                reap()
+    finally:
+        NodeCaps.save_if_changed()
+
+def _is_nodemanager_daemon(cmdline):
+    """
+    Whether an argument list read from /proc is "... hpcacmagent.py daemon".
+    """
+    name = os.path.basename(__file__)
+    for i in range(len(cmdline) - 1):
+        if os.path.basename(cmdline[i]) == name and re.match(r'^[-/]*daemon$', cmdline[i + 1]):
             return True
-    waagent.Log("The process {0} is not HPC Linux node manager daemon".format(pid))
     return False
 
-def install_package(package_name):
-    if DistroName == "centos" or DistroName == "redhat":
-        cmd = "yum -y install " + package_name
-    elif DistroName == "ubuntu":
-        cmd = "apt-get -y install " + package_name
-    elif DistroName == "suse":
-        if not os.listdir('/etc/zypp/repos.d'):
-            waagent.Run("zypper ar http://download.opensuse.org/distribution/13.2/repo/oss/suse/ opensuse")
-            cmd = "zypper -n --gpg-auto-import-keys install --force-resolution -l " + package_name
-        else:
-            cmd = "zypper -n install --force-resolution -l " + package_name
-    else:
-        raise Exception("Unsupported Linux Distro.")
-    waagent.Log("The command to install {0}: {1}".format(package_name, cmd))
-    attempt = 1
-    while(True):
-        waagent.Log("Installing package {0} (Attempt {1})".format(package_name, attempt))
-        retcode, retoutput = waagent.RunGetOutput(cmd)
-        if retcode == 0:
-            waagent.Log("package {0} installation succeeded".format(package_name))
-            break
+def _daemon_pid():
+    """
+    The pid of the running daemon, or None.
+    """
+    return PidUtil.owner(DaemonPidFilePath, _is_nodemanager_daemon)
+
+def _handler_lock():
+    lock = PidUtil.FileLock(DaemonPidFilePath + '.lock')
+    lock.acquire()
+    return lock
+
+def _get_package_manager():
+    global PackageMgr
+    if PackageMgr is None:
+        local_repo = None
+        if PackageSource != 'online':
+            repo_root = LocalPackageRepo or os.path.join(os.getcwd(), "packages")
+            local_repo = PackageUtil.find_local_repo(repo_root, DistroName, DistroVersion)
+            if not local_repo and PackageSource == 'local':
+                raise Exception("No local package repository for {0} {1} under {2}".format(DistroName, DistroVersion, repo_root))
+        PackageMgr = PackageUtil.get_package_manager(DistroName, waagent.Log, waagent.RunGetOutput, PackageLockTimeoutInSeconds, local_repo)
+    return PackageMgr
+
+def install_packages(package_names):
+    outcomes = {}
+    pending = []
+    for pkg in package_names:
+        if NodeCaps.package_installed(pkg):
+            outcomes[pkg] = PackageUtil.Present
         else:
-            waagent.Log("package {0} installation failed {1}:\n {2}".format(package_name, retcode, retoutput))
-            if attempt < 3:
-                attempt += 1
-                time.sleep(5)
-                if DistroName == 'suse' and retcode == 104:
-                    waagent.Run("zypper ar http://download.opensuse.org/distribution/13.2/repo/oss/suse/ opensuse")
-                    cmd = "zypper -n --gpg-auto-import-keys install --force-resolution -l " + package_name
-                continue
-            else:
-                raise Exception("failed to install package {0}:{1}".format(package_name, retcode))
+            pending.append(pkg)
+    if pending:
+        outcomes.update(_get_package_manager().install(pending))
+        for pkg in pending:
+            NodeCaps.set_package_installed(pkg, outcomes[pkg] != PackageUtil.Failed)
+        # The package database changed, record the state under the new fingerprint
+        NodeCaps.save()
+    failed = [pkg for pkg in package_names if outcomes[pkg] == PackageUtil.Failed]
+    if failed:
+        raise Exception("failed to install package {0}".format(", ".join(failed)))
+    return outcomes
+
+def install_package(package_name):
+    install_packages([package_name])
+
+def _move_to_trash(path):
+    trashed = TrashUtil.move_to_trash(path, TrashRoot)
+    if trashed:
+        waagent.Log("Moved {0} to {1}".format(path, trashed))
+
+def _start_reaper():
+    """
+    Delete the trash in a detached low priority process, so the caller
+    doesn't wait for it. Return its Popen, or None when there is no trash.
+    """
+    if not TrashUtil.has_trash(TrashRoot):
+        return None
+    args = [os.path.join(os.getcwd(), __file__), "reap"]
+    if _find_command("nice"):
+        args = ["nice", "-n", "19"] + args
+    if _find_command("ionice"):
+        args = ["ionice", "-c", "3"] + args
+    devnull = open(os.devnull, 'w')
+    child = subprocess.Popen(args, stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+    waagent.Log("Started reaper process {0} for {1}".format(child.pid, TrashRoot))
+    return child
 
 def _uninstall_nodemanager_files():
     if os.path.isdir(NMInstallRoot):
         for tmpname in os.listdir(NMInstallRoot):
-            if tmpname == 'logs':
-                continue
-            if tmpname == 'certs':
+            if tmpname in PreservedNames:
                 continue
-            if tmpname == 'filters':
-                continue
-            tmppath = os.path.join(NMInstallRoot, tmpname)
-            if os.path.isdir(tmppath):
-                shutil.rmtree(tmppath)
-            elif os.path.isfile(tmppath):
-                os.remove(tmppath)
+            _move_to_trash(os.path.join(NMInstallRoot, tmpname))
     if os.path.isdir(AgentInstallRoot):
-        shutil.rmtree(AgentInstallRoot)
+        _move_to_trash(AgentInstallRoot)
+
+def _find_command(cmd):
+    return NodeCaps.find_command(cmd)
 
-def _install_cgroup_tool():
-    if waagent.Run("command -v cgexec", chk_err=False) == 0:
-        waagent.Log("cgroup tools was already installed")
+def _cgroup_package_name():
+    if DistroName == "ubuntu":
+        return 'cgroup-bin'
+    elif (DistroName == "centos" or DistroName == "redhat") and re.match("^6", DistroVersion):
+        return 'libcgroup'
     else:
-        waagent.Log("Start to install cgroup tools")
-        if DistroName == "ubuntu":
-            cg_pkgname = 'cgroup-bin'
-        elif (DistroName == "centos" or DistroName == "redhat") and re.match("^6", DistroVersion):
-            cg_pkgname = 'libcgroup'
+        return 'libcgroup-tools'
+
+def _libunwind_package_name():
+    if DistroName == "ubuntu":
+        return 'libunwind8-dev'
+    else:
+        return 'libunwind'
+
+def _required_packages():
+    """
+    Return the packages install() needs. A package whose command is already
+    on the PATH is left out, the rest are checked by the package manager.
+    """
+    required = [(_cgroup_package_name(), 'cgexec'), (_libunwind_package_name(), None), ('sysstat', 'iostat')]
+    if _psutil_needs_build():
+        required += [('python-devel', None), ('gcc', 'gcc')]
+    packages = []
+    for pkg, cmd in required:
+        if cmd and _find_command(cmd):
+            waagent.Log("{0} was already installed".format(pkg))
         else:
-            cg_pkgname = 'libcgroup-tools'
-        install_package(cg_pkgname)
-        waagent.Log("cgroup tool was successfully installed")
+            packages.append(pkg)
+    return packages
+
+def _install_packages():
+    packages = _required_packages()
+    if packages:
+        install_packages(packages)
+
+def _psutil_installed():
+    if NodeCaps.package_installed('psutil'):
+        return True
+    # The interpreter the wheel was picked for and installed into
+    installed = waagent.Run("'{0}' -c 'import psutil'".format(sys.executable), chk_err=False) == 0
+    NodeCaps.set_package_installed('psutil', installed)
+    return installed
+
+def _find_psutil_wheel():
+    if PsutilInstallMode != 'wheel':
+        return None
+    return WheelUtil.find_wheel(os.path.join(os.getcwd(), "wheels"), "psutil", DistroName, DistroVersion)
+
+def _psutil_needs_build():
+    return not _psutil_installed() and not _find_psutil_wheel()
+
+def _install_psutils_from_wheel():
+    wheel = _find_psutil_wheel()
+    if not wheel:
+        waagent.Log("No prebuilt psutil wheel matches this system")
+        return False
+    target = WheelUtil.install_wheel(wheel)
+    NodeCaps.set_package_installed('psutil', True)
+    waagent.Log("psutil installed from {0} to {1}".format(wheel, target))
+    return True
 
 def _install_psutils():
+    if _psutil_installed():
+        waagent.Log("psutil was already installed")
+        return
+    if _install_psutils_from_wheel():
+        return
+    waagent.Log("Build psutil from source")
+    _install_python_devel()
     _install_gcc()
     _install_pip()
     if waagent.Run("pip install psutil", chk_err=False) == 0:
+        NodeCaps.set_package_installed('psutil', True)
         waagent.Log("psutil installed")
     else:
         waagent.Log("Error installing psutil")
@@ -166,7 +316,7 @@ def _install_pip():
 def _check_and_install_package(pkg, cmd = None):
     if not cmd:
         cmd = pkg
-    if waagent.Run("command -v {0}".format(cmd), chk_err=False) == 0:
+    if _find_command(cmd):
         waagent.Log("{0} was already installed".format(pkg))
     else:
         waagent.Log("Start to install {0}".format(pkg))
@@ -177,93 +327,55 @@ def _install_gcc():
     _check_and_install_package("gcc")
 
 def _install_python_devel():
-    _check_and_install_package("python-devel")
-
-def _install_libunwind():
-    if DistroName == "ubuntu":
-        _check_and_install_package("libunwind8-dev")
-    else:
-        _check_and_install_package("libunwind")
-
-def _install_sysstat():
-    _check_and_install_package("sysstat", "iostat")
+    # There is no command to look for, the package manager checks it
+    install_package("python-devel")
 
 def get_networkinterfaces():
     """
-    Return the interface name, and ip addr of the
-    all non loopback interfaces.
+    Return the interface name and ip address of the usable addresses of all
+    the non loopback interfaces, IPv4 before IPv6.
     """
-    expected=16 # how many devices should I expect...
-    is_64bits = sys.maxsize > 2**32
-    struct_size=40 if is_64bits else 32 # for 64bit the size is 40 bytes, for 32bits it is 32 bytes.
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    buff=array.array('B', b'\0' * (expected*struct_size))
-    retsize=(struct.unpack('iL', fcntl.ioctl(s.fileno(), 0x8912, struct.pack('iL',expected*struct_size,buff.buffer_info()[0]))))[0]
-    if retsize == (expected*struct_size) :
-        waagent.Log('SIOCGIFCONF returned more than ' + str(expected) + ' up network interfaces.')
-    nics = []
-    s=buff.tostring()
-    for i in range(0,retsize,struct_size):
-        iface=s[i:i+16].split(b'\0', 1)[0]
-        if iface == b'lo':
-            continue
-        else:
-            nics.append((iface.decode('latin-1'), socket.inet_ntoa(s[i+20:i+24])))
-    return nics
+    snapshot = NetMonitor.snapshot() if NetMonitor is not None else NetUtil.read_snapshot()
+    return snapshot.nics()
+
+def _watch_network(loop, log, hosts_sync=None):
+    """
+    Keep the interface snapshot of the daemon current from netlink events
+    and log the address changes. A change makes hosts_sync poll early, an
+    address that comes back after an outage shouldn't wait for the backoff.
+    """
+    global NetMonitor
+    NetMonitor = NetUtil.Monitor.open(log)
+    if NetMonitor is None:
+        return
+    def on_change(old, new):
+        added, removed = NetUtil.diff(old, new)
+        if added or removed:
+            log("Network addresses changed, added: {0}, removed: {1}".format(', '.join(added) or 'none', ', '.join(removed) or 'none'))
+            if hosts_sync is not None:
+                hosts_sync.wake()
+    NetMonitor.attach(loop, on_change, log)
 
 def cleanup_host_entries():
-    hostsfile = '/etc/hosts'
-    if not os.path.isfile(hostsfile):
+    if not os.path.isfile(HostsFilePath):
         return
-    try:
-        hpcentryexists = False
-        newcontent=''
-        with open(hostsfile, 'r') as F:
-            for line in F.readlines():
-                if re.match(r"^[0-9\.]+\s+[^\s#]+\s+#HPCD?\s*$", line):
-                    hpcentryexists = True
-                else:
-                    newcontent += line
-        if hpcentryexists:
-            waagent.Log("Clean all HPC related host entries from hosts file")
-            waagent.ReplaceFileContentsAtomic(hostsfile,newcontent)
-            os.chmod(hostsfile, 0o644)
-    except :
-        raise
+    hosts = HostsUtil.HostsFile.load(HostsFilePath)
+    if hosts.remove(HostsUtil.HpcTags):
+        waagent.Log("Clean all HPC related host entries from hosts file")
+        hosts.save()
 
 def init_suse_hostsfile(host_name, ipaddrs):
-    hostsfile = '/etc/hosts'
-    if not os.path.isfile(hostsfile):
+    if not os.path.isfile(HostsFilePath):
         return
-    try:
-        newhpcd_entries = ''
-        for ipaddr in ipaddrs:
-            newhpcd_entries += '{0:24}{1:30}#HPCD\n'.format(ipaddr, host_name)
-
-        curhpcd_entries = ''
-        newcontent = ''
-        hpcentryexists = False
-        with open(hostsfile, 'r') as F:
-            for line in F.readlines():
-                if re.match(r"^[0-9\.]+\s+[^\s#]+\s+#HPCD\s*$", line):
-                    curhpcd_entries += line
-                    hpcentryexists = True
-                elif re.match(r"^[0-9\.]+\s+[^\s#]+\s+#HPC\s*$", line):
-                    hpcentryexists = True
-                else:
-                    newcontent += line
-
-        if newhpcd_entries != curhpcd_entries:
-            if hpcentryexists:
-                waagent.Log("Clean the HPC related host entries from hosts file")
-            waagent.Log("Add the following HPCD host entries:\n{0}".format(newhpcd_entries))
-            if newcontent and newcontent[-1] != '\n':
-                newcontent += '\n'
-            newcontent += newhpcd_entries
-            waagent.ReplaceFileContentsAtomic(hostsfile,newcontent)
-            os.chmod(hostsfile, 0o644)
-    except :
-        raise
+    hosts = HostsUtil.HostsFile.load(HostsFilePath)
+    newhpcd_entries = [(ipaddr, host_name) for ipaddr in ipaddrs]
+    if hosts.entries(HostsUtil.HpcdTag) != newhpcd_entries:
+        if hosts.remove((HostsUtil.HpcTag,)) or hosts.entries(HostsUtil.HpcdTag):
+            waagent.Log("Clean the HPC related host entries from hosts file")
+        hosts.replace(HostsUtil.HpcdTag, newhpcd_entries)
+        waagent.Log("Add the following HPCD host entries:\n{0}".format(
+            ''.join(HostsUtil.format_entry(addr, name, HostsUtil.HpcdTag) for addr, name in newhpcd_entries)))
+        hosts.save()
 
 #def gethostname_from_configfile(configfile):
 #    config_hostname = None
@@ -324,6 +436,7 @@ def _mount_cgroup():
         waagent.Log("mount /cgroup directory {0}:{1}".format(retcode, mount_msg))
         if retcode == 0:
             waagent.Log("/cgroup directory is successfully mounted.")
+            NodeCaps.forget('cgroup_version')
         else:
             raise Exception("failed to mount /cgroup directory")
     else:
@@ -347,39 +460,256 @@ def _try_makedirs(dirname):
             raise
 
 
-def _subprocess(exec_path_args, work_dir, stdoutfile, stderrfile, logfile):
-    hutil = parse_context('Enable', logfile)
+def _nodemanager_listening_uri():
+    """
+    The scheme and the port of the nodemanager ListeningUri, or None.
+    """
+    configfile = os.path.join(NMInstallRoot, 'nodemanager.json')
+    if not os.path.isfile(configfile):
+        return None
+    try:
+        with open(configfile, 'r') as F:
+            configjson = json.load(F)
+    except ValueError:
+        return None
+    m = re.match(r'^(\w+)://[^:/]+:(\d+)', configjson.get('ListeningUri', ''))
+    if m:
+        return m.group(1).lower(), int(m.group(2))
+    return None
+
+def _probe_settings(section, name, public_settings, port=None):
+    """
+    The probe settings of the service in publicSettings section. A TCP probe
+    of a NodeAgent instance checks the instance's port unless Port is set.
+    nodemanager defaults to an HTTP GET on its ListeningUri port, answered
+    with any status, so a server that hangs fails it. An https ListeningUri
+    gets a TCP connect, which only catches a dead listener.
+    """
+    settings = (public_settings.get(section) or {}).get(name)
+    if settings is None and name == 'nodemanager':
+        uri = _nodemanager_listening_uri()
+        if uri and uri[0] == 'http':
+            settings = {'Type': 'http', 'Url': 'http://127.0.0.1:{0}/'.format(uri[1]), 'AnyStatus': True}
+        elif uri:
+            settings = {'Type': 'tcp', 'Port': uri[1]}
+    elif settings and port is not None and 'Port' not in settings and settings.get('Type', 'tcp').lower() == 'tcp':
+        settings = dict(settings, Port=port)
+    return settings
+
+def _liveness_probe(name, public_settings, port=None):
+    """
+    The probe configured in publicSettings 'LivenessProbes', by default an
+    HTTP GET on the nodemanager ListeningUri port. NodeAgent has no default.
+    """
+    return ProbeUtil.probe_from_settings(_probe_settings('LivenessProbes', name, public_settings, port))
+
+def _readiness_probe(name, public_settings, port=None):
+    """
+    The probe configured in publicSettings 'ReadinessProbes' and its
+    ReadyTimeout. By default nodemanager is ready once it answers HTTP on its
+    ListeningUri port, NodeAgent has no default.
+    """
+    settings = _probe_settings('ReadinessProbes', name, public_settings, port)
+    if not settings:
+        return None, ServiceReadyTimeoutInSeconds
+    ready_timeout = float(settings.get('ReadyTimeout', ServiceReadyTimeoutInSeconds))
+    return ProbeUtil.probe_from_settings(settings, ProbeUtil.ReadinessDefaults), ready_timeout
+
+def _service_cgroup(name, kind, resource_limits, log):
+    """
+    The cgroup of the service, with the limits in publicSettings
+    'ResourceLimits' for its kind ('nodemanager' or 'nodeagent'). None when
+    cgroups are unavailable or turned off with "ResourceLimits": {"Enabled": false}.
+    """
+    if not resource_limits.get('Enabled', True):
+        return None
+    limits = CgroupUtil.limits_from_settings(resource_limits.get(kind))
+    cgroup = CgroupUtil.create(NodeCaps.cgroup_version(), CgroupParentName, name, limits, log)
+    if cgroup:
+        log("Cgroup for {0}: {1} {2}".format(name, cgroup.describe(), limits))
+    return cgroup
+
+def _service_placement(placement_settings, topology, log):
+    """
+    The housekeeping CPUs and memory nodes from publicSettings 'Placement',
+    see Utils/TopologyUtil.py. The daemon moves there too, which also checks
+    the placement works before the services get it.
+    """
+    try:
+        placement = TopologyUtil.placement_from_settings(placement_settings, topology)
+        if placement:
+            placement.apply_to_self()
+            log("Services placed on {0}".format(placement.describe()))
+        return placement
+    except (ValueError, OSError) as e:
+        log("Ignored the placement settings {0}: {1}".format(placement_settings, e))
+        return None
+
+def _service(hutil, name, kind, args, work_dir, public_settings, placement, port=None, env=None):
+    """
+    A supervised service configured from the publicSettings entries of its
+    kind, 'nodemanager' or 'nodeagent'.
+    """
+    log_dir = hutil.get_log_dir()
+    policy = SupervisorUtil.RestartPolicy.from_settings(public_settings.get('RestartPolicy'), MaxDelay=RestartIntervalInSeconds)
+    probe = _liveness_probe(kind, public_settings, port)
+    if probe:
+        hutil.log("Liveness probe for {0}: {1}".format(name, probe.describe()))
+    ready_probe, ready_timeout = _readiness_probe(kind, public_settings, port)
+    if ready_probe:
+        hutil.log("Readiness probe for {0}: {1}".format(name, ready_probe.describe()))
+    cgroup = _service_cgroup(name, kind, public_settings.get('ResourceLimits') or {}, hutil.log)
+    return SupervisorUtil.Service(name, args, work_dir,
+                                  os.path.join(log_dir, name + ".txt"), os.path.join(log_dir, name + ".err"), policy, probe,
+                                  ready_probe, ready_timeout, cgroup, placement, env)
+
+def _nodeagent_instances(settings, topology, placement):
+    """
+    (index, node, port, work_dir, args, env, placement) of each NodeAgent
+    instance for the 'NodeAgentInstances' settings. Raises ValueError,
+    KeyError, IndexError or TypeError for bad Shards, ports or templates.
+    """
+    exe_path = os.path.join(AgentInstallRoot, "NodeAgent")
+    base_port = int(settings.get('BasePort', NodeAgentBasePort))
+    instances = []
+    for index, (node, shard_placement) in enumerate(TopologyUtil.shard_placements(topology, settings.get('Shards', 'numa'), placement)):
+        port = base_port + index
+        work_dir = os.path.join(AgentInstallRoot, AgentInstancesDirName, str(index))
+        fields = {'index': index, 'node': node, 'port': port, 'dir': work_dir}
+        args = [exe_path] + [str(arg).format(**fields) for arg in settings.get('Args', [])]
+        env = dict(os.environ)
+        env.update(dict((key, str(value).format(**fields)) for key, value in (settings.get('Env') or {}).items()))
+        env.update({'HPCACM_NODEAGENT_INSTANCE': str(index), 'HPCACM_NODEAGENT_NODE': str(node), 'HPCACM_NODEAGENT_PORT': str(port)})
+        instances.append((index, node, port, work_dir, args, env, shard_placement))
+    return instances
+
+def _nodeagent_services(hutil, public_settings, topology, placement):
+    """
+    The NodeAgent service, or with publicSettings 'NodeAgentInstances' one
+    per shard. Instance i is named nodeagent-<i>, works in its own directory
+    and logs to its own files, gets port BasePort + i and is bound to the
+    CPUs and memory of its NUMA node (see shard_placements() in
+    Utils/TopologyUtil.py). It finds its identity in the environment, and in
+    its arguments where "Args" uses {index}, {node}, {port} or {dir}.
+    Settings that can't be used fall back to a single instance.
+    """
+    settings = public_settings.get('NodeAgentInstances')
+    single = lambda: [_service(hutil, "nodeagent", "nodeagent", [os.path.join(AgentInstallRoot, "NodeAgent")], AgentInstallRoot,
+                               public_settings, placement)]
+    if not settings or not settings.get('Enabled', True):
+        return single()
+    try:
+        instances = _nodeagent_instances(settings, topology, placement)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        hutil.log("Ignored the NodeAgentInstances settings {0}: {1}".format(settings, e))
+        return single()
+    services = []
+    for index, node, port, work_dir, args, env, shard_placement in instances:
+        _try_makedirs(work_dir)
+        # A child can't report a failed placement, try it here first
+        try:
+            shard_placement.check()
+        except OSError as e:
+            hutil.log("NodeAgent instance {0} can't be placed on {1}: {2}".format(index, shard_placement.describe(), e))
+            shard_placement = placement
+        hutil.log("NodeAgent instance {0} on NUMA node {1}, port {2}, {3}".format(
+            index, node, port, shard_placement.describe() if shard_placement is not None else 'not placed'))
+        services.append(_service(hutil, "nodeagent-{0}".format(index), "nodeagent", args, work_dir, public_settings,
+                                 shard_placement, port, env))
+    return services
+
+def _wait_daemon_ready(child, ready_fd, timeout):
+    """
+    Wait for the daemon to write a line to the pipe. Return (result, detail),
+    result is 'ready', 'failed', 'exited' when the pipe was closed without a
+    line, or 'timeout'.
+    """
+    deadline = time.time() + timeout
+    received = b''
     while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return 'timeout', ''
         try:
-            dirname = os.path.dirname(stdoutfile)
-            _try_makedirs(dirname)
-            dirname = os.path.dirname(stderrfile)
-            _try_makedirs(dirname)
-
-            with open(stdoutfile, 'a') as out, open(stderrfile, 'a') as err:
-                infile = open(os.devnull, 'r')
-                child_process = subprocess.Popen(exec_path_args, stdin=infile, stdout=out, stderr=err, cwd=work_dir, shell=True)
-                if child_process.pid is None or child_process.pid < 1:
-                    exit_msg = 'Failed to start process {0}'.format(exec_path_args)
-                    hutil.do_status_report('Enable', 'error', 1, exit_msg)
-                else:
-                    #Sleep 1 second to check if the process is still running
-                    time.sleep(1)
-                    if child_process.poll() is None:
-                        hutil.do_status_report('Enable', 'success', 0, "")
-                        hutil.log('process started {0}'.format(exec_path_args))
-                        exit_code = child_process.wait()
-                        exit_msg = "process exits: {0} {1}".format(exec_path_args, exit_code)
-                        hutil.do_status_report('Enable', 'warning', exit_code, exit_msg)
-                    else:
-                        exit_msg = "{0} process crashes: {1}".format(exec_path_args, child_process.returncode)
-                        hutil.do_status_report('Enable', 'error', child_process.returncode, exit_msg)
-                hutil.log(exit_msg)
-                time.sleep(RestartIntervalInSeconds)
-        except Exception as e:
-            hutil.log("start process error {0}".format(e))
-            hutil.do_exit(4, 'Start','error','4', '{0}'.format(e))
-        hutil.log("Restart process {0} after {1} seconds".format(exec_path_args, RestartIntervalInSeconds))
+            readable = select.select([ready_fd], [], [], remaining)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not readable:
+            return 'timeout', ''
+        data = os.read(ready_fd, 4096)
+        if not data:
+            return 'exited', ''
+        received += data
+        if b'\n' in received:
+            line = received.split(b'\n', 1)[0].decode('utf-8', 'replace')
+            result, _, detail = line.partition(':')
+            return result.strip(), detail.strip()
+
+def _take_ready_fd():
+    """
+    The notify pipe inherited from enable(), or None when the daemon was
+    started some other way. It is kept away from the processes we spawn.
+    """
+    value = os.environ.pop(ReadyFdEnv, None)
+    if not value:
+        return None
+    try:
+        fd = int(value)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    except (ValueError, IOError, OSError):
+        return None
+    return fd
+
+def _cloexec_all_but(keep):
+    """
+    For a preexec_fn on Python 2, which has no pass_fds: the descriptors
+    above stderr other than keep are closed by the exec. Marking them instead
+    of closing them keeps the pipe subprocess reports exec errors through.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and fd != keep:
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            except (IOError, OSError):
+                pass
+
+def _notify_ready(fd, detail=None):
+    """
+    Tell enable() the services are ready, or that one failed when detail is
+    given. One line, short enough for a single write to the pipe.
+    """
+    line = 'ready\n' if detail is None else 'failed: {0}\n'.format(' '.join(detail.split())[:1024])
+    try:
+        os.write(fd, line.encode('utf-8'))
+    except OSError as e:
+        waagent.Log("Failed to notify enable: {0}".format(e))
+    finally:
+        os.close(fd)
+
+def _sync_payload(srcDir, destDir, **kwargs):
+    waagent.Log("sync from {0} to {1}".format(srcDir, destDir))
+    stats = SyncUtil.sync_tree(srcDir, destDir, remove_old=_move_to_trash, **kwargs)
+    waagent.Log("synced {0}: {1} files ({2} bytes) copied, {3} files ({4} bytes) unchanged".format(
+        destDir, stats['copied'], stats['bytes_copied'], stats['linked'], stats['bytes_linked']))
+
+def _install_nodeagent_files():
+    _sync_payload(os.path.join(os.getcwd(), "NodeAgent"), AgentInstallRoot, preserve=AgentPreservedNames)
+
+def _create_log_dir():
+    logDir = os.path.join(NMInstallRoot, "logs")
+    waagent.Log("Testing {0}".format(logDir))
+    _try_makedirs(logDir)
+
+def _install_nodemanager_files():
+    # The files at the top level and in lib/ are made executable
+    _sync_payload(os.path.join(os.getcwd(), "acmnodemanager"), NMInstallRoot,
+                  preserve=PreservedNames, executable_dirs=('.', 'lib'))
 
 def parse_context(operation, logfile=None):
     hutil = Util.HandlerUtility(waagent.Log, waagent.Error, ExtensionShortName)
@@ -390,36 +720,24 @@ def install():
     hutil = parse_context('Install')
     try:
         waagent.Log("Install started.")
-        cleanup_host_entries()
-        _uninstall_nodemanager_files()
-        _install_cgroup_tool()
-        _install_libunwind()
-        _install_python_devel()
-        _install_sysstat()
-        _install_psutils()
-
-        # shutil.copytree(srcDir, NMInstallRoot)
-        # install the node agent
-        srcDir = os.path.join(os.getcwd(), "NodeAgent")
-        waagent.Log("copy from {0} to {1}".format(srcDir, AgentInstallRoot))
-        shutil.copytree(srcDir, AgentInstallRoot)
-        waagent.Log("copied")
-
-        logDir = os.path.join(NMInstallRoot, "logs")
-        waagent.Log("Testing {0}".format(logDir))
-        if not os.path.isdir(logDir):
-            os.makedirs(logDir)
-        srcDir = os.path.join(os.getcwd(), "acmnodemanager")
-        waagent.RunGetOutput("chmod +x {0}/*".format(srcDir))
-        waagent.RunGetOutput("chmod +x {0}/lib/*".format(srcDir))
-        
-        for filename in os.listdir(srcDir):
-            srcname = os.path.join(srcDir, filename)
-            destname = os.path.join(NMInstallRoot, filename)
-            if os.path.isfile(srcname):
-                shutil.copy2(srcname, destname)
-            elif os.path.isdir(srcname):
-                shutil.copytree(srcname, destname)
+        global PsutilInstallMode, PackageSource, LocalPackageRepo
+        public_settings = hutil.get_public_settings() or {}
+        PsutilInstallMode = public_settings.get('PsutilInstallMode', PsutilInstallMode)
+        PackageSource = public_settings.get('PackageSource', PackageSource)
+        LocalPackageRepo = public_settings.get('LocalPackageRepo', LocalPackageRepo)
+        graph = StepUtil.StepGraph(waagent.Log, InstallWorkers)
+        graph.add('cleanup_hosts', cleanup_host_entries)
+        # The package manager holds a global lock, so package steps share the 'pkg' lock
+        graph.add('packages', _install_packages, lock='pkg')
+        graph.add('psutils', _install_psutils, deps=['packages'], lock='pkg')
+        # The payloads are synced in place, only changed files are written
+        graph.add('nodeagent_files', _install_nodeagent_files)
+        graph.add('log_dir', _create_log_dir)
+        graph.add('nodemanager_files', _install_nodemanager_files, deps=['log_dir'])
+        failed = graph.run()
+        _start_reaper()
+        if failed:
+            raise Exception("; ".join("{0}: {1}".format(step.name, step.error) for step in failed))
 
        # public_settings = hutil._context._config['runtimeSettings'][0]['handlerSettings'].get('publicSettings')
         # TODO passin the sas token
@@ -503,43 +821,73 @@ def enable():
         #Check whether monitor process is running.
         #If it does, return. Otherwise clear pid file
         hutil.log("enable() called.")
-        if os.path.isfile(DaemonPidFilePath):
-            pid = waagent.GetFileContents(DaemonPidFilePath)
-            hutil.log("Discovered daemon pid: {0}".format(pid))
-            if os.path.isdir(os.path.join("/proc", pid)) and _is_nodemanager_daemon(pid):
+        # An overlapping enable or disable waits until this one is done
+        lock = _handler_lock()
+        try:
+            pid = _daemon_pid()
+            if pid is not None:
+                hutil.log("Discovered daemon pid: {0}".format(pid))
                 if hutil.is_seq_smaller():
                     hutil.log("Sequence is smaller skip killing")
                     hutil.do_exit(0, 'Enable', 'success', '0', 
                                 'HPC Linux node manager daemon is already running')
                 else:
                     hutil.log("Stop old daemon: {0}".format(pid))
-                    os.killpg(int(pid), 9)
-            hutil.log("Remove the daemon pid file: {0}".format(DaemonPidFilePath))
-            os.remove(DaemonPidFilePath)
-
-        args = [os.path.join(os.getcwd(), __file__), "daemon"]
-        devnull = open(os.devnull, 'w')
-        hutil.log("Starting daemon process")
-        child = subprocess.Popen(args, stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
-        if child.pid is None or child.pid < 1:
-            hutil.log("failed to start the daemon process")
-            hutil.do_exit(1, 'Enable', 'error', '1',
-                        'Failed to launch HPC Linux node manager daemon')
-        else:
-            hutil.log("started the daemon process, save seq")
-            hutil.save_seq()
-            hutil.log("started the daemon process, save pid {0}".format(child.pid))
-            waagent.SetFileContents(DaemonPidFilePath, str(child.pid))
-            #Sleep 3 seconds to check if the process is still running
-            time.sleep(3)
-            if child.poll() is None:
-                hutil.log("3 seconds later, success, Daemon pid: {0}".format(child.pid))
-                hutil.do_exit(0, 'Enable', 'success', '0',
-                        'HPC Linux node manager daemon is enabled')
+                    os.killpg(pid, 9)
+                    if not PidUtil.wait_released(DaemonPidFilePath, DaemonStopTimeoutInSeconds):
+                        raise Exception("The old daemon {0} did not exit".format(pid))
+
+            args = [os.path.join(os.getcwd(), __file__), "daemon"]
+            devnull = open(os.devnull, 'w')
+            ready_r, ready_w = os.pipe()
+            fcntl.fcntl(ready_r, fcntl.F_SETFD, fcntl.fcntl(ready_r, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            env = dict(os.environ)
+            env[ReadyFdEnv] = str(ready_w)
+            # The long-lived daemon inherits nothing but the notify pipe
+            if sys.version_info[0] >= 3:
+                spawn = dict(preexec_fn=os.setsid, close_fds=True, pass_fds=(ready_w,))
+            else:
+                spawn = dict(preexec_fn=lambda: (os.setsid(), _cloexec_all_but(ready_w)), close_fds=False)
+            hutil.log("Starting daemon process")
+            try:
+                child = subprocess.Popen(args, stdout=devnull, stderr=devnull, env=env, **spawn)
+            finally:
+                os.close(ready_w)
+            if child.pid is None or child.pid < 1:
+                hutil.log("failed to start the daemon process")
+                hutil.do_exit(1, 'Enable', 'error', '1',
+                            'Failed to launch HPC Linux node manager daemon')
             else:
-                hutil.log("3 seconds later, failed, Daemon pid: None")
-                hutil.do_exit(3, 'Enable', 'error', '3',
-                        'Failed to launch HPC Linux node manager daemon')
+                hutil.log("started the daemon process, save seq")
+                hutil.save_seq()
+                hutil.log("started the daemon process, pid {0}".format(child.pid))
+                start = time.time()
+                result, detail = _wait_daemon_ready(child, ready_r, EnableReadyTimeoutInSeconds)
+                os.close(ready_r)
+                if result == 'exited':
+                    # The pipe closes when the daemon exits, give it a moment to become reapable
+                    deadline = time.time() + 1
+                    while child.poll() is None and time.time() < deadline:
+                        time.sleep(0.05)
+                if result == 'ready':
+                    hutil.log("Daemon ready after {0:.2f} seconds, Daemon pid: {1}".format(time.time() - start, child.pid))
+                    hutil.do_exit(0, 'Enable', 'success', '0',
+                            'HPC Linux node manager daemon is enabled')
+                elif result == 'failed':
+                    hutil.log("Service failed after {0:.2f} seconds, Daemon pid: {1}: {2}".format(time.time() - start, child.pid, detail))
+                    hutil.do_exit(4, 'Enable', 'error', '4',
+                            'HPC Linux node manager daemon is running but a service failed to start: {0}'.format(detail))
+                elif child.poll() is None:
+                    hutil.log("Daemon not ready after {0:.2f} seconds, Daemon pid: {1}".format(time.time() - start, child.pid))
+                    hutil.do_exit(4, 'Enable', 'error', '4',
+                            'HPC Linux node manager daemon is running but its services are not ready after {0} seconds'.format(
+                                EnableReadyTimeoutInSeconds))
+                else:
+                    hutil.log("Daemon exited with {0} before it was ready".format(child.returncode))
+                    hutil.do_exit(3, 'Enable', 'error', '3',
+                            'Failed to launch HPC Linux node manager daemon')
+        finally:
+            lock.release()
     except Exception as e:
         hutil.log("Failed to enable the extension with error: %s, stack trace: %s" %(str(e), traceback.format_exc()))
         hutil.do_exit(2, 'Enable','error','2', "Enable failed. {0} {1}".format(str(e), traceback.format_exc()))
@@ -548,6 +896,14 @@ def daemon():
     hutil = parse_context('Enable','daemon.log')
     try:
         hutil.log("Started daemon")
+        ready_fd = _take_ready_fd()
+        # Locked until this process exits, the old daemon may still be dying
+        pid_file = PidUtil.PidFile(DaemonPidFilePath)
+        if not pid_file.acquire(DaemonStopTimeoutInSeconds):
+            hutil.error("Another daemon owns {0}, exiting".format(DaemonPidFilePath))
+            sys.exit(1)
+        # Resume removing trees left over by an interrupted reaper
+        reaper = _start_reaper()
 #        public_settings = hutil._context._config['runtimeSettings'][0]['handlerSettings'].get('publicSettings')
 #        cluster_connstring = public_settings.get('ClusterConnectionString')
 #        if not cluster_connstring:
@@ -574,35 +930,56 @@ def daemon():
 #                waagent.Log("Correct the hostname from {0} to {1}".format(curhostname, confighostname))
 #                waagent.MyDistro.setHostname(confighostname)
 #                waagent.MyDistro.publishHostname(confighostname)
-#            retry = 0
-#            while True:
-#                nics = get_networkinterfaces()
-#                if len(nics) > 0:
-#                    init_suse_hostsfile(confighostname, [nic[1] for nic in nics])
-#                    break
-#                elif retry < 30:
-#                    waagent.Log("Failed to get network interfaces information, retry later ...")
-#                    time.sleep(2)
-#                    retry = retry + 1
-#                else:
-#                    waagent.Log("Failed to get network interfaces information, just clean")
-#                    break
+#            nics = NetUtil.wait_for_nics(60, waagent.Log)
+#            if len(nics) > 0:
+#                init_suse_hostsfile(confighostname, [nic[1] for nic in nics])
+#            else:
+#                waagent.Log("Failed to get network interfaces information, just clean")
         # Mount the directory /cgroup for centos 6.*
         major_version = int(DistroVersion.split('.')[0])
-        if (DistroName == 'centos' or DistroName == 'redhat') and major_version < 7:
+        if (DistroName == 'centos' or DistroName == 'redhat') and major_version < 7 and NodeCaps.cgroup_version() != 2:
             _mount_cgroup()
 
-        exe_path = os.path.join(NMInstallRoot, "nodemanager")
-
-        threadnm = threading.Thread(target=_subprocess, args=(exe_path, NMInstallRoot, os.path.join(hutil.get_log_dir(), "nodemanager.txt"), os.path.join(hutil.get_log_dir(), "nodemanager.err"), "nodemanager.log"))
-        threadagent = threading.Thread(target=_subprocess, args=(os.path.join(AgentInstallRoot, "NodeAgent"), AgentInstallRoot, os.path.join(hutil.get_log_dir(), "nodeagent.txt"), os.path.join(hutil.get_log_dir(), "nodeagent.err"), "nodeagent.log"))
-        hutil.log("Starting threads")
-        threadnm.start()
-        threadagent.start()
-        hutil.log("Started threads")
-        threadnm.join()
-        threadagent.join()
-        hutil.log("Exited join threads")
+        public_settings = hutil.get_public_settings() or {}
+        compressor = LogUtil.Compressor(hutil.log)
+        rotation = public_settings.get('LogRotation')
+        open_log = lambda path: LogUtil.RotatingLog.from_settings(path, rotation, compressor, hutil.log)
+        status_settings = public_settings.get('StatusReport') or {}
+        reporter = hutil.status_reporter(status_settings.get('Debounce', StatusDebounceInSeconds),
+                                         status_settings.get('MinInterval', StatusMinIntervalInSeconds),
+                                         status_settings.get('Fsync', StatusFsyncPolicy))
+        supervisor = SupervisorUtil.Supervisor(hutil.log, reporter.update, open_log,
+                                               os.path.join(NMInstallRoot, 'logs', 'crashes'))
+        if reaper is not None:
+            supervisor.watch(reaper)
+        topology = TopologyUtil.Topology.read()
+        placement = _service_placement(public_settings.get('Placement'), topology, hutil.log)
+        supervisor.add(_service(hutil, "nodemanager", "nodemanager", [os.path.join(NMInstallRoot, "nodemanager")], NMInstallRoot,
+                                public_settings, placement))
+        for service in _nodeagent_services(hutil, public_settings, topology, placement):
+            supervisor.add(service)
+        if ready_fd is not None:
+            supervisor.on_ready(lambda: _notify_ready(ready_fd))
+            supervisor.on_failure(lambda detail: _notify_ready(ready_fd, detail))
+        nm_config_file = os.path.join(NMInstallRoot, 'nodemanager.json')
+        hosts_sync = HostsSyncUtil.HostsSync.from_settings(public_settings.get('HostsSync'), HostsFilePath, hutil.log, nm_config_file)
+        # One writer of the #HPC entries, the node manager stops fetching them while the daemon syncs
+        if hosts_sync is not None and not HostsSyncUtil.claim_config(nm_config_file, hutil.log):
+            hutil.log("Not syncing the hosts file, the node manager still fetches it")
+            hosts_sync = None
+        if hosts_sync is not None:
+            hosts_sync.start()
+        else:
+            HostsSyncUtil.release_config(nm_config_file, hutil.log)
+        _watch_network(supervisor.loop, hutil.log, hosts_sync)
+        hutil.log("Starting supervisor")
+        try:
+            supervisor.run()
+        finally:
+            if hosts_sync is not None:
+                hosts_sync.stop()
+            reporter.close()
+        hutil.log("Supervisor exited")
         
     except Exception as e:
         hutil.error("Failed to start the daemon with error: %s, stack trace: %s" %(str(e), traceback.format_exc()))
@@ -612,6 +989,7 @@ def uninstall():
     # TODO where to kill the node manager
     hutil = parse_context('Uninstall')
     _uninstall_nodemanager_files()
+    _start_reaper()
     cleanup_host_entries()
     hutil.do_exit(0,'Uninstall','success','0', 'Uninstall succeeded')
 
@@ -620,20 +998,20 @@ def disable():
     hutil = parse_context('Disable')
     #TODO where to kill the node manager
     #Check whether monitor process is running.
-    #If it does, kill it. Otherwise clear pid file
-    if os.path.isfile(DaemonPidFilePath):
-        pid = waagent.GetFileContents(DaemonPidFilePath)
-        waagent.Log("Discovered daemon pid: {0}".format(pid))
-        if os.path.isdir(os.path.join("/proc", pid)) and _is_nodemanager_daemon(pid):
+    #If it does, kill it. The pid file is left in place, it means nothing unlocked
+    lock = _handler_lock()
+    try:
+        pid = _daemon_pid()
+        if pid is not None:
             waagent.Log(("Stop HPC node manager daemon: {0}").format(pid))
-            os.killpg(int(pid), 9)
+            os.killpg(pid, 9)
             cleanup_host_entries()
             hutil.do_exit(0, 'Disable', 'success', '0',
                           'HPC node manager daemon is disabled')
-        waagent.Log("Remove the daemon pid file: {0}".format(DaemonPidFilePath))
-        os.remove(DaemonPidFilePath)
-    else:
-        waagent.Log("No daemon pid file discovered.")
+        else:
+            waagent.Log("No running daemon discovered.")
+    finally:
+        lock.release()
 
     hutil.do_exit(0, 'Disable', 'success', '0',
                   'HPC node manager daemon disabled')
@@ -658,6 +1036,10 @@ def update():
 #                    waagent.MyDistro.publishHostname(confighostname)
     hutil.do_exit(0,'Update','success','0', 'Update Succeeded')
 
+def reap():
+    waagent.Log("reap() called.")
+    TrashUtil.reap(TrashRoot, waagent.Log, ReapBatchSize, ReapPauseInSeconds)
+
 if __name__ == '__main__' :
     main()
 
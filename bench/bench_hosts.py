@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Benchmark of the hosts file updates
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Writes a hosts file with --entries #HPC entries and times the line by line
+implementation hpcacmagent.py used before against HostsUtil, checking that
+both leave the same content:
+
+    python bench/bench_hosts.py --entries 50000 --repeat 5
+"""
+
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'VMExtension'))
+
+from Utils import HostsUtil
+
+HostName = 'node0'
+HostAddrs = ['10.0.0.4', '10.1.0.4']
+
+def _replace_atomic(path, content):
+    with open(path + '.tmp', 'w') as F:
+        F.write(content)
+    os.rename(path + '.tmp', path)
+
+def legacy_cleanup(hostsfile):
+    # cleanup_host_entries() before HostsUtil
+    hpcentryexists = False
+    newcontent = ''
+    with open(hostsfile, 'r') as F:
+        for line in F.readlines():
+            if re.match(r"^[0-9\.]+\s+[^\s#]+\s+#HPCD?\s*$", line):
+                hpcentryexists = True
+            else:
+                newcontent += line
+    if hpcentryexists:
+        _replace_atomic(hostsfile, newcontent)
+    return hpcentryexists
+
+def legacy_init_suse(hostsfile, host_name, ipaddrs):
+    # init_suse_hostsfile() before HostsUtil
+    newhpcd_entries = ''
+    for ipaddr in ipaddrs:
+        newhpcd_entries += '{0:24}{1:30}#HPCD\n'.format(ipaddr, host_name)
+    curhpcd_entries = ''
+    newcontent = ''
+    with open(hostsfile, 'r') as F:
+        for line in F.readlines():
+            if re.match(r"^[0-9\.]+\s+[^\s#]+\s+#HPCD\s*$", line):
+                curhpcd_entries += line
+            elif re.match(r"^[0-9\.]+\s+[^\s#]+\s+#HPC\s*$", line):
+                pass
+            else:
+                newcontent += line
+    if newhpcd_entries != curhpcd_entries:
+        if newcontent and newcontent[-1] != '\n':
+            newcontent += '\n'
+        newcontent += newhpcd_entries
+        _replace_atomic(hostsfile, newcontent)
+        return True
+    return False
+
+def indexed_cleanup(hostsfile):
+    hosts = HostsUtil.HostsFile.load(hostsfile)
+    hosts.remove(HostsUtil.HpcTags)
+    return hosts.save()
+
+def indexed_init_suse(hostsfile, host_name, ipaddrs):
+    hosts = HostsUtil.HostsFile.load(hostsfile)
+    pairs = [(ipaddr, host_name) for ipaddr in ipaddrs]
+    if hosts.entries(HostsUtil.HpcdTag) == pairs:
+        return False
+    hosts.remove((HostsUtil.HpcTag,))
+    hosts.replace(HostsUtil.HpcdTag, pairs)
+    return hosts.save()
+
+def indexed_replace(hostsfile, pairs):
+    hosts = HostsUtil.HostsFile.load(hostsfile)
+    hosts.replace(HostsUtil.HpcTag, pairs)
+    return hosts.save()
+
+def node_pairs(count, readdressed=0):
+    """
+    (address, name) of count nodes, the first readdressed ones moved to
+    another subnet.
+    """
+    pairs = []
+    for i in range(count):
+        net = 200 if i < readdressed else 1 + i // 65536
+        pairs.append(('10.{0}.{1}.{2}'.format(net, (i // 256) % 256, i % 256), 'node{0}'.format(i)))
+    return pairs
+
+def make_hosts(entries, hpcd_addrs):
+    lines = ['127.0.0.1   localhost localhost.localdomain\n', '::1         localhost6\n', '# managed below\n']
+    lines += [HostsUtil.format_entry(addr, name, HostsUtil.HpcTag) for addr, name in node_pairs(entries)]
+    lines += [HostsUtil.format_entry(addr, HostName, HostsUtil.HpcdTag) for addr in hpcd_addrs]
+    return ''.join(lines)
+
+def check_small(path):
+    """
+    Below SparseHits the tagged lines are found by the literal search, the
+    timed cases only take the regex path.
+    """
+    content = make_hosts(3, HostAddrs) + '# the end\n'
+    for legacy, indexed in ((legacy_cleanup, indexed_cleanup),
+                            (lambda p: legacy_init_suse(p, HostName, ['10.9.9.9']),
+                             lambda p: indexed_init_suse(p, HostName, ['10.9.9.9']))):
+        results = []
+        for func in (legacy, indexed):
+            with open(path, 'w') as F:
+                F.write(content)
+            func(path)
+            with open(path, 'r') as F:
+                results.append(F.read())
+        if results[0] != results[1]:
+            raise SystemExit('{0} and {1} left different content:\n{2}\n{3}'.format(
+                legacy.__name__, indexed.__name__, results[0], results[1]))
+    hosts = HostsUtil.HostsFile('hosts', content)
+    if hosts.remove(names=['node0', HostName]) != 3 or len(hosts.entries(HostsUtil.HpcTag)) != 2:
+        raise SystemExit('remove() by name left the wrong entries:\n' + hosts.render())
+
+def run_case(path, content, func, repeat):
+    """
+    Best time of func over repeat runs on a fresh copy of content, the
+    result of the last run and the content it left.
+    """
+    best = None
+    for _ in range(repeat):
+        with open(path, 'w') as F:
+            F.write(content)
+        start = time.time()
+        result = func(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    with open(path, 'r') as F:
+        return best, result, F.read()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench-hosts-')
+    try:
+        path = os.path.join(root, 'hosts')
+        check_small(path)
+        current = make_hosts(args.entries, HostAddrs)
+        stale = make_hosts(args.entries, ['10.9.9.9'])
+        same_nodes = node_pairs(args.entries)
+        moved_nodes = node_pairs(args.entries, args.entries // 100)
+        cases = [
+            ('cleanup', current, lambda p: legacy_cleanup(p), lambda p: indexed_cleanup(p)),
+            ('init_suse unchanged', current, lambda p: legacy_init_suse(p, HostName, HostAddrs),
+             lambda p: indexed_init_suse(p, HostName, HostAddrs)),
+            ('init_suse changed', stale, lambda p: legacy_init_suse(p, HostName, HostAddrs),
+             lambda p: indexed_init_suse(p, HostName, HostAddrs)),
+            ('replace unchanged', current, None, lambda p: indexed_replace(p, same_nodes)),
+            ('replace 1%', current, None, lambda p: indexed_replace(p, moved_nodes)),
+        ]
+        print('{0} #HPC entries, best of {1}'.format(args.entries, args.repeat))
+        print('{0:<22} {1:>12} {2:>12} {3:>8}'.format('case', 'legacy ms', 'indexed ms', 'written'))
+        for name, content, legacy, indexed in cases:
+            seconds, written, result = run_case(path, content, indexed, args.repeat)
+            legacy_ms = '-'
+            if legacy is not None:
+                legacy_seconds, _, legacy_result = run_case(path, content, legacy, args.repeat)
+                if legacy_result != result:
+                    raise SystemExit('{0}: the implementations left different content'.format(name))
+                legacy_ms = '{0:.1f}'.format(legacy_seconds * 1000)
+            print('{0:<22} {1:>12} {2:>12.1f} {3:>8}'.format(name, legacy_ms, seconds * 1000, 'yes' if written else 'no'))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Benchmark of the hosts file sync against a stand-in head node
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Serves a list of --entries hosts entries from a local HTTP server that
+answers like the head node would, with ETags, 304s and, unless --no-delta,
+RFC 3229 deltas. --nodes HostsSync workers, each with its own hosts file,
+poll it for --rounds rounds while the list changes every --change-every
+rounds; the bytes served are compared with fetching the full list every
+time, and every hosts file is checked against the list:
+
+    python bench/bench_hosts_sync.py --entries 5000 --nodes 20 --rounds 30
+
+The adaptive interval is then simulated over --hours with one change an
+hour, against the fixed HostsFetchInterval of 120 seconds. Last, one worker
+runs on its own thread with a short interval to check the polling loop.
+"""
+
+
+import argparse
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'VMExtension'))
+
+from Utils import HostsSyncUtil
+from Utils import HostsUtil
+
+FixedInterval = 120
+
+class HeadNode:
+    """
+    The versions of the list, each an ordered list of (name, address).
+    """
+    def __init__(self, entries, delta=True):
+        self.versions = [[('node{0}'.format(i), '10.{0}.{1}.{2}'.format(1 + i // 65536, (i // 256) % 256, i % 256))
+                          for i in range(entries)]]
+        self.delta = delta
+        self.bytes = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def change(self, moved):
+        """
+        Readdress moved nodes, drop one and add one.
+        """
+        version = len(self.versions)
+        current = list(self.versions[-1])
+        for i in range(moved):
+            index = (version * 7919 + i * 104729) % len(current)
+            name, _ = current[index]
+            current[index] = (name, '10.200.{0}.{1}'.format(version % 256, i % 256))
+        current.pop(version % len(current))
+        current.append(('extra{0}'.format(version), '10.201.{0}.{1}'.format(version // 256 % 256, version % 256)))
+        self.versions.append(current)
+
+    def etag(self, version):
+        return '"v{0}"'.format(version)
+
+    def full(self):
+        return {'ManagedEntry': True, 'HostEntries': [{'Name': n, 'Address': a} for n, a in self.versions[-1]]}
+
+    def diff(self, base):
+        old = dict(self.versions[base])
+        new = dict(self.versions[-1])
+        return {'Added': [{'Name': n, 'Address': a} for n, a in self.versions[-1] if old.get(n) != a],
+                'Removed': [n for n, _ in self.versions[base] if n not in new]}
+
+def make_handler(head):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with head.lock:
+                head.requests += 1
+                latest = len(head.versions) - 1
+                tag = self.headers.get('If-None-Match')
+                if tag == head.etag(latest):
+                    self.send_response(304)
+                    self.send_header('ETag', tag)
+                    self.end_headers()
+                    return
+                base = None
+                if head.delta and tag and self.headers.get('A-IM') == HostsSyncUtil.DeltaIm:
+                    for version in range(latest):
+                        if head.etag(version) == tag:
+                            base = version
+                payload = head.diff(base) if base is not None else head.full()
+                body = json.dumps(payload).encode('utf-8')
+                gzipped = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+                if gzipped:
+                    buf = io.BytesIO()
+                    with gzip.GzipFile(fileobj=buf, mode='wb') as F:
+                        F.write(body)
+                    body = buf.getvalue()
+                head.bytes += len(body)
+            self.send_response(226 if base is not None else 200)
+            if base is not None:
+                self.send_header('IM', HostsSyncUtil.DeltaIm)
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('ETag', head.etag(latest))
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def full_size(head):
+    return len(json.dumps(head.full()).encode('utf-8'))
+
+def check_hosts(path, head):
+    hosts = HostsUtil.HostsFile.load(path)
+    # Entries that stay keep their line, changed ones are appended
+    expected = sorted((a, n) for n, a in head.versions[-1])
+    if sorted(hosts.entries(HostsUtil.HpcTag)) != expected:
+        raise SystemExit('{0} does not have the entries of the head node'.format(path))
+    if hosts.entries(HostsUtil.HpcdTag) != [('10.0.0.4', 'self')]:
+        raise SystemExit('{0} lost its #HPCD entry'.format(path))
+
+def simulate_polls(hours, interval):
+    """
+    Polls of one node in hours with the list changing once an hour, for the
+    adaptive interval and for the fixed one.
+    """
+    sync = HostsSyncUtil.HostsSync('http://unused/', None, lambda msg: None, interval=interval)
+    end = hours * 3600.0
+    now = sync._rand.uniform(0, sync.jitter * sync.interval)
+    last = -1.0
+    adaptive = 0
+    while now < end:
+        adaptive += 1
+        # The changes happen on the half hour
+        changed = int((now + 1800) // 3600) != int((last + 1800) // 3600)
+        last = now
+        now += sync.next_interval('changed' if changed else 'unchanged')
+    return adaptive, int(end // interval)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--change-every', type=int, default=10)
+    parser.add_argument('--moved', type=int, default=20)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--no-delta', action='store_true')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench-hosts-sync-')
+    head = HeadNode(args.entries, delta=not args.no_delta)
+    server = Server(('127.0.0.1', 0), make_handler(head))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    uri = 'http://127.0.0.1:{0}/HpcLinux/api/hostsfile'.format(server.server_address[1])
+    try:
+        workers = []
+        for i in range(args.nodes):
+            path = os.path.join(root, 'hosts{0}'.format(i))
+            with open(path, 'w') as F:
+                F.write('127.0.0.1   localhost\n' + HostsUtil.format_entry('10.0.0.4', 'self', HostsUtil.HpcdTag))
+            workers.append(HostsSyncUtil.HostsSync(uri, path, lambda msg: None))
+        baseline = 0
+        start = time.time()
+        for round in range(args.rounds):
+            if round and round % args.change_every == 0:
+                head.change(args.moved)
+            for sync in workers:
+                sync.sync_once()
+                baseline += full_size(head)
+        elapsed = time.time() - start
+        for sync in workers:
+            check_hosts(sync.hosts_path, head)
+        stats = dict((key, sum(sync.stats[key] for sync in workers)) for key in workers[0].stats)
+        print('{0} entries, {1} nodes, {2} rounds, {3} changes, deltas {4}'.format(
+            args.entries, args.nodes, args.rounds, len(head.versions) - 1, 'off' if args.no_delta else 'on'))
+        print('requests {0}: {1} not modified, {2} full, {3} delta'.format(
+            stats['requests'], stats['not_modified'], stats['full'], stats['delta']))
+        print('served {0:.1f} KB, full list every time {1:.1f} KB ({2:.1f}x less), {3:.1f} ms a request'.format(
+            head.bytes / 1024.0, baseline / 1024.0, baseline / float(max(1, head.bytes)),
+            elapsed * 1000 / max(1, stats['requests'])))
+
+        adaptive, fixed = simulate_polls(args.hours, FixedInterval)
+        print('{0} hours with a change an hour: {1} polls adaptive, {2} polls every {3}s'.format(
+            args.hours, adaptive, fixed, FixedInterval))
+
+        path = os.path.join(root, 'hosts-thread')
+        with open(path, 'w') as F:
+            F.write(HostsUtil.format_entry('10.0.0.4', 'self', HostsUtil.HpcdTag))
+        sync = HostsSyncUtil.HostsSync(uri, path, lambda msg: None, interval=0.2)
+        sync.start()
+        deadline = time.time() + 10
+        while sync.stats['full'] < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        head.change(args.moved)
+        while sync.stats['full'] + sync.stats['delta'] < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        sync.stop()
+        check_hosts(path, head)
+        print('polling thread: {0} requests, hosts file up to date'.format(sync.stats['requests']))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
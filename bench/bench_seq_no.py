@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark of the sequence number discovery
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Fills a temporary config folder with --files settings files and times the
+old os.walk based lookup, a single scandir pass and the indexed lookup:
+
+    python bench/bench_seq_no.py --files 5000 --repeat 200
+"""
+
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'VMExtension'))
+
+from Utils import SeqUtil
+
+def walk_seq_no(config_folder):
+    # The lookup HandlerUtility used before the index
+    seq_no = -1
+    freshest_time = None
+    for subdir, dirs, files in os.walk(config_folder):
+        for file in files:
+            try:
+                cur_seq_no = int(os.path.basename(file).split('.')[0])
+                mtime = os.path.getmtime(os.path.join(config_folder, file))
+                if freshest_time is None or mtime > freshest_time:
+                    freshest_time = mtime
+                    seq_no = cur_seq_no
+            except ValueError:
+                continue
+    return seq_no
+
+def make_config_folder(root, count):
+    config_folder = os.path.join(root, 'config')
+    os.makedirs(config_folder)
+    base = 1500000000
+    for seq in range(count):
+        path = os.path.join(config_folder, '{0}.settings'.format(seq))
+        with open(path, 'w') as F:
+            F.write('{}')
+        os.utime(path, (base + seq, base + seq))
+    # Old enough for the index to be written
+    os.utime(config_folder, (base + count, base + count))
+    return config_folder
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench-seq-')
+    try:
+        config_folder = make_config_folder(root, args.files)
+        index_file = os.path.join(root, 'seqindex.json')
+        expected = args.files - 1
+        cases = [
+            ('os.walk', lambda: walk_seq_no(config_folder)),
+            ('scandir', lambda: SeqUtil.scan_seq_no(config_folder)),
+            ('indexed', lambda: SeqUtil.current_seq_no(config_folder, index_file)),
+        ]
+        print('{0} settings files, {1} lookups each'.format(args.files, args.repeat))
+        for name, func in cases:
+            if func() != expected:
+                raise SystemExit('{0} returned {1}, expected {2}'.format(name, func(), expected))
+            seconds = min(timeit.repeat(func, number=args.repeat, repeat=3)) / args.repeat
+            print('{0:<10} {1:10.1f} us/lookup'.format(name, seconds * 1e6))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Latency benchmark of the handler commands
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Times the hpcacmagent.py commands end to end, each in a fresh interpreter
+like the agent runs them, and the HandlerUtility hot paths in process. Every
+iteration gets a new sandbox (see sandbox.py), nothing outside of it is
+touched and no network is needed.
+
+    python bench/handler_bench.py --iterations 5 --output results.json
+    python bench/handler_bench.py --baseline results.json --fail-on-regression
+
+A metric regresses when its median is more than --threshold (a fraction)
+and more than --min-delta-ms above the baseline median.
+"""
+
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sandbox
+
+Runner = os.path.join(sandbox.BenchDir, 'handler_runner.py')
+
+# (metric, command, expected exit code), run in this order in every sandbox
+Commands = [
+    ('install_cold', '-install', 0),
+    ('install_warm', '-install', 0),
+    ('enable', '-enable', 0),
+    ('enable_running', '-enable', 0),
+    ('update', '-update', 0),
+    ('disable', '-disable', 0),
+    ('uninstall', '-uninstall', 0),
+    ('reap', '-reap', None),
+]
+
+def run_command(root, ext, command):
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, Runner, command], cwd=ext, env=sandbox.sandbox_env(root),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return time.time() - start, proc.returncode, output
+
+def stop_daemon(root):
+    pid_file = os.path.join(root, 'opt', 'hpcacmdaemon.pid')
+    try:
+        with open(pid_file, 'r') as F:
+            os.killpg(int(F.read().split()[0]), signal.SIGKILL)
+    except (IOError, OSError, ValueError):
+        pass
+
+def bench_commands(work_dir, iterations, settings_files):
+    samples = {}
+    for i in range(iterations):
+        root = os.path.join(work_dir, 'sandbox{0}'.format(i))
+        ext = sandbox.create_sandbox(root, settings_files)
+        try:
+            for metric, command, expected in Commands:
+                seconds, code, output = run_command(root, ext, command)
+                if expected is not None and code != expected:
+                    raise SystemExit("{0} exited with {1}, expected {2}:\n{3}".format(
+                        command, code, expected, output.decode('utf-8', 'replace')))
+                samples.setdefault(metric, []).append(seconds)
+        finally:
+            stop_daemon(root)
+    return samples
+
+def bench_hot_paths(work_dir, repeat, settings_files):
+    """
+    HandlerUtility calls a command makes, timed in this process.
+    """
+    root = os.path.join(work_dir, 'inprocess')
+    ext = sandbox.create_sandbox(root, settings_files)
+    sandbox.load_waagent(root)
+    import Utils.HandlerUtil as HandlerUtil
+    from Utils.WAAgentUtil import waagent
+    cwd = os.getcwd()
+    os.chdir(ext)
+    try:
+        hutil = HandlerUtil.HandlerUtility(waagent.Log, waagent.Error, 'HPCACMAgent')
+        hutil.do_parse_context('Enable')
+        config_dir = os.path.join(ext, 'config')
+        reporter = HandlerUtil.StatusReporter(hutil.do_status_report, waagent.Log, debounce=3600, min_interval=3600)
+        cases = [
+            ('parse_context', lambda: HandlerUtil.HandlerUtility(waagent.Log, waagent.Error, 'HPCACMAgent').do_parse_context('Enable')),
+            ('get_current_seq_no', lambda: hutil._get_current_seq_no(config_dir)),
+            ('is_seq_smaller', lambda: hutil.is_seq_smaller()),
+            ('do_status_report', lambda: hutil.do_status_report('Enable', 'success', 0, 'bench')),
+            ('status_reporter_update', lambda: reporter.update('nodeagent', 'Enable', 'success', 0, 'bench')),
+        ]
+        samples = {}
+        for name, func in cases:
+            func()
+            samples[name] = [t / repeat for t in timeit.repeat(func, number=repeat, repeat=5)]
+        reporter.close()
+        return samples
+    finally:
+        os.chdir(cwd)
+
+def summarize(samples):
+    results = {}
+    for metric, values in samples.items():
+        values = sorted(values)
+        results[metric] = {
+            'median_ms': values[len(values) // 2] * 1000,
+            'min_ms': values[0] * 1000,
+            'max_ms': values[-1] * 1000,
+            'runs': len(values),
+        }
+    return results
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """
+    Print the results next to the baseline and return the regressed metrics.
+    """
+    regressed = []
+    print('{0:<24} {1:>12} {2:>12} {3:>8}'.format('metric', 'baseline ms', 'current ms', 'ratio'))
+    for metric in sorted(results):
+        current = results[metric]['median_ms']
+        if metric not in baseline:
+            print('{0:<24} {1:>12} {2:>12.2f} {3:>8}'.format(metric, '-', current, 'new'))
+            continue
+        base = baseline[metric]['median_ms']
+        ratio = current / base if base else float('inf')
+        flag = ''
+        if current - base > min_delta_ms and ratio > 1 + threshold:
+            regressed.append(metric)
+            flag = ' REGRESSED'
+        print('{0:<24} {1:>12.2f} {2:>12.2f} {3:>8.2f}{4}'.format(metric, base, current, ratio, flag))
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=3, help='sandboxes to run the command sequence in')
+    parser.add_argument('--repeat', type=int, default=200, help='calls per in-process measurement')
+    parser.add_argument('--settings-files', type=int, default=100, help='settings files in the config folder')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-delta-ms', type=float, default=1.0)
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='handler-bench-')
+    try:
+        samples = bench_commands(work_dir, args.iterations, args.settings_files)
+        samples.update(bench_hot_paths(work_dir, args.repeat, args.settings_files))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'iterations': args.iterations,
+            'repeat': args.repeat,
+            'settings_files': args.settings_files,
+        },
+        'results': summarize(samples),
+    }
+    if args.output:
+        with open(args.output, 'w') as F:
+            json.dump(report, F, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as F:
+            baseline = json.load(F)['results']
+        regressed = compare(report['results'], baseline, args.threshold, args.min_delta_ms)
+        if regressed and args.fail_on_regression:
+            sys.exit(1)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
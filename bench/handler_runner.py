@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# Runs one hpcacmagent command inside a benchmark sandbox
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+Usage: HPCACM_BENCH_SANDBOX=<root> handler_runner.py -enable
+
+Same arguments as hpcacmagent.py, the sandbox is the one created by
+sandbox.create_sandbox(). The daemon started by -enable runs through this
+script too.
+"""
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sandbox
+
+if __name__ == '__main__':
+    sandbox.load_agent(os.environ[sandbox.SandboxEnv], os.path.abspath(__file__)).main()
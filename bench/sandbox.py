@@ -0,0 +1,222 @@
+#
+# Sandboxed handler environment for the benchmarks
+#
+# Copyright 2018 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+
+
+"""
+create_sandbox() lays out everything a handler command touches under one
+directory, so the commands run on a box without the Azure agent, root or
+network:
+
+  ext/        the extension directory (cwd of the commands), with
+              HandlerEnvironment.json, config/, status/, logs/ and the
+              acmnodemanager/ and NodeAgent/ payloads (stub binaries)
+  stubs/      a stub waagent script and a stub psutil package
+  bin/        python, cgexec and iostat stand-ins, first on the PATH
+  opt/        the install roots, the trash and the daemon pid file
+  cgroup/     stands in for /sys/fs/cgroup, no v1 hierarchy is seen
+  etc/hosts   the hosts file the handler cleans up
+  lib/        waagent's LibDir, with a certificate when openssl exists
+
+load_agent() imports hpcacmagent with its paths pointed into the sandbox
+and a stub package manager, it is what handler_runner.py runs.
+"""
+
+
+import json
+import os
+import stat
+import subprocess
+import sys
+
+BenchDir = os.path.dirname(os.path.abspath(__file__))
+ExtensionDir = os.path.join(BenchDir, '..', 'VMExtension')
+SandboxEnv = 'HPCACM_BENCH_SANDBOX'
+Thumbprint = 'BENCHCERT'
+
+StubWAAgent = '''
+import os, subprocess, sys, time
+LibDir = os.path.join(os.environ['HPCACM_BENCH_SANDBOX'], 'lib')
+_log_file = None
+def LoggerInit(log_file, con_file, verbose=False):
+    global _log_file
+    _log_file = log_file
+def _write(prefix, message):
+    if _log_file:
+        with open(_log_file, 'a') as F:
+            F.write('{0} {1}{2}\\n'.format(time.strftime('%Y/%m/%d %H:%M:%S'), prefix, message))
+def Log(message):
+    _write('', message)
+def Error(message):
+    _write('ERROR:', message)
+def RunGetOutput(cmd, chk_err=True):
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    return p.returncode, out.decode('latin-1')
+def Run(cmd, chk_err=True):
+    return RunGetOutput(cmd, chk_err)[0]
+def GetFileContents(path):
+    try:
+        with open(path, 'r') as F:
+            return F.read()
+    except IOError:
+        return None
+def SetFileContents(path, contents):
+    with open(path, 'w') as F:
+        F.write(contents)
+    return 0
+def ReplaceFileContentsAtomic(path, contents):
+    SetFileContents(path + '.tmp', contents)
+    os.rename(path + '.tmp', path)
+    return 0
+def GetMyDistro():
+    return None
+'''
+
+StubService = '#!/bin/sh\nexec sleep 3600\n'
+
+class StubPackageManager:
+    """
+    Reports every package as installed without touching the system.
+    """
+    def __init__(self, log):
+        self._log = log
+
+    def install(self, pkgs):
+        self._log("stub package manager: install {0}".format(' '.join(pkgs)))
+        from Utils import PackageUtil
+        return dict((pkg, PackageUtil.Installed) for pkg in pkgs)
+
+def _write(path, content, mode=None):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as F:
+        F.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+def _executable(path, content):
+    _write(path, content, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+def _protected_settings(root):
+    """
+    Encrypt a small protected setting with a fresh certificate in LibDir,
+    or return None when openssl is not available.
+    """
+    lib = os.path.join(root, 'lib')
+    cert = os.path.join(lib, Thumbprint + '.crt')
+    key = os.path.join(lib, Thumbprint + '.prv')
+    devnull = open(os.devnull, 'w')
+    try:
+        if subprocess.call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                            '-subj', '/CN=bench', '-days', '1'], stdout=devnull, stderr=devnull) != 0:
+            return None
+        openssl = subprocess.Popen(['openssl', 'smime', '-encrypt', '-outform', 'DER', cert],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+        der = openssl.communicate(json.dumps({'ClusterName': 'bench'}).encode('ascii'))[0]
+        if openssl.returncode != 0:
+            return None
+    except OSError:
+        return None
+    finally:
+        devnull.close()
+    import base64
+    return base64.b64encode(der).decode('ascii')
+
+def create_sandbox(root, settings_files=1, public_settings=None):
+    ext = os.path.join(root, 'ext')
+    for dirname in ('config', 'status', 'logs'):
+        os.makedirs(os.path.join(ext, dirname))
+    os.makedirs(os.path.join(root, 'lib'))
+    _write(os.path.join(ext, 'HandlerEnvironment.json'), json.dumps([{
+        'name': 'Microsoft.HpcPack.HPCAcmAgent',
+        'seqNo': '0',
+        'version': '1.0',
+        'handlerEnvironment': {
+            'logFolder': os.path.join(ext, 'logs'),
+            'configFolder': os.path.join(ext, 'config'),
+            'statusFolder': os.path.join(ext, 'status'),
+            'heartbeatFile': os.path.join(ext, 'heartbeat.log'),
+        },
+    }]))
+    handler_settings = {'publicSettings': public_settings or {}}
+    protected = _protected_settings(root)
+    if protected:
+        handler_settings['protectedSettingsCertThumbprint'] = Thumbprint
+        handler_settings['protectedSettings'] = protected
+    settings = json.dumps({'runtimeSettings': [{'handlerSettings': handler_settings}]})
+    # Older configurations first, the newest one is the current sequence
+    for seq in range(settings_files):
+        path = os.path.join(ext, 'config', '{0}.settings'.format(seq))
+        _write(path, settings)
+        os.utime(path, (1500000000 + seq, 1500000000 + seq))
+
+    _executable(os.path.join(ext, 'acmnodemanager', 'nodemanager'), StubService)
+    for i in range(50):
+        _write(os.path.join(ext, 'acmnodemanager', 'lib', 'lib{0}.so'.format(i)), 'x' * 4096)
+    _executable(os.path.join(ext, 'NodeAgent', 'NodeAgent'), StubService)
+    for i in range(50):
+        _write(os.path.join(ext, 'NodeAgent', 'lib{0}.dll'.format(i)), 'x' * 4096)
+
+    _write(os.path.join(root, 'stubs', 'waagent'), StubWAAgent)
+    _write(os.path.join(root, 'stubs', 'psutil', '__init__.py'), '')
+    _executable(os.path.join(root, 'bin', 'python'), '#!/bin/sh\nexec {0} "$@"\n'.format(sys.executable))
+    for cmd in ('cgexec', 'iostat'):
+        _executable(os.path.join(root, 'bin', cmd), '#!/bin/sh\nexit 0\n')
+    _write(os.path.join(root, 'etc', 'hosts'), '127.0.0.1 localhost\n10.0.0.4 node1 #HPC\n')
+    os.makedirs(os.path.join(root, 'opt'))
+    return ext
+
+def sandbox_env(root):
+    env = dict(os.environ)
+    env[SandboxEnv] = root
+    env['PATH'] = os.path.join(root, 'bin') + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = os.path.join(root, 'stubs')
+    return env
+
+def load_waagent(root):
+    """
+    Install the stub waagent, even where a real one is found on the box.
+    """
+    os.environ[SandboxEnv] = root
+    if ExtensionDir not in sys.path:
+        sys.path.insert(0, ExtensionDir)
+    from Utils import WAAgentUtil
+    WAAgentUtil.CacheDir = os.path.join(root, 'waagent-cache')
+    WAAgentUtil._agent = WAAgentUtil._patch(WAAgentUtil.load_waagent(os.path.join(root, 'stubs', 'waagent')))
+    import Utils.HandlerUtil as HandlerUtil
+    HandlerUtil.ExtensionLogFile = os.path.join(root, 'var', 'log', 'hpcacmagent.log')
+    return WAAgentUtil.waagent
+
+def load_agent(root, runner_path):
+    waagent = load_waagent(root)
+    import hpcacmagent
+    # The daemon and the reaper are started as "<__file__> daemon", they have to come back here
+    hpcacmagent.__file__ = runner_path
+    opt = os.path.join(root, 'opt')
+    hpcacmagent.DaemonPidFilePath = os.path.join(opt, 'hpcacmdaemon.pid')
+    hpcacmagent.NMInstallRoot = os.path.join(opt, 'acmnodemanager')
+    hpcacmagent.AgentInstallRoot = os.path.join(opt, 'NodeAgent')
+    hpcacmagent.TrashRoot = os.path.join(opt, '.hpcacmtrash')
+    hpcacmagent.HostsFilePath = os.path.join(root, 'etc', 'hosts')
+    hpcacmagent.PackageMgr = StubPackageManager(waagent.Log)
+    from Utils import CgroupUtil
+    CgroupUtil.CgroupRoot = os.path.join(root, 'cgroup')
+    CgroupUtil.MountsFile = os.path.join(root, 'mounts')
+    return hpcacmagent